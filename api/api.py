@@ -3,16 +3,89 @@ import threading
 import sqlite3
 import functools
 import os
+import time
 from flask import send_file
+from werkzeug.exceptions import HTTPException
 import io
 from arlo.device_db import DeviceDB, DB_PATH
 from arlo.device import Device
 from arlo.camera import Camera
+from arlo.command_queue import CommandQueueFull
+from api.jobs import Job, JobQueueFull, job_manager
+from arlo.telemetry import telemetry_store, TIER_ORDER
+from arlo.presence import presence_tracker
+from arlo.activity_zones import validate_zones, zone_analytics
+from arlo.event_log import event_log, DEFAULT_PAGE_SIZE
+from arlo.rtsp_relay import rtsp_relay
+from arlo.audio_doorbell import AudioDoorbell
+from arlo.doorbell_audio import doorbell_audio, CallError, parse_address
+from arlo.stream_leases import stream_leases
+from arlo.adaptive_quality import adaptive_quality
+from helpers.metrics import metrics
+from helpers.log import get_logger
 
 app = flask.Flask(__name__)
 app.config["DEBUG"] = False
 app.use_reloader = False
 
+api_log = get_logger('api')
+
+
+@app.errorhandler(CommandQueueFull)
+def command_queue_full(e):
+    return flask.jsonify({"result": False, "error": "Too many commands queued for this device"}), 503
+
+
+@app.errorhandler(CallError)
+def call_failed(e):
+    return flask.jsonify({"result": False, "error": str(e)}), 503
+
+
+@app.errorhandler(JobQueueFull)
+def job_queue_full(e):
+    return flask.jsonify({"result": False, "error": "Too many jobs pending"}), 503
+
+
+def wants_async():
+    if flask.request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'respond-async' in flask.request.headers.get('Prefer', '')
+
+
+def asynchronous(f):
+    """Run the command as a background job when the client asks for it (?async=1 or Prefer: respond-async).
+
+    Goes below validate_device_request, validate_device_type and validate_body, so a bad
+    request is answered with 400 before anything is queued. A valid one is answered with
+    202 and the job, whose outcome is at GET /jobs/<id> and is also posted to the optional
+    ?callback= URL.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not wants_async():
+            return f(*args, **kwargs)
+
+        @flask.copy_current_request_context
+        def run():
+            try:
+                response = flask.make_response(f(*args, **kwargs))
+            except HTTPException as e:
+                return {"result": False, "error": e.description}, e.code
+            return response.get_json(), response.status_code
+
+        job = Job(kwargs.get('serial'), flask.request.method, flask.request.path, flask.request.args.get('callback'))
+        job_manager.submit(job, run)
+        response = flask.jsonify(job.to_dict())
+        response.status_code = 202
+        response.headers['Location'] = f"/jobs/{job.id}"
+        return response
+    return wrapper
+
+
+def config_changed(device: Device, *steps):
+    """The device no longer holds what its initial configuration applied, push `steps` (all if none) on the next registration"""
+    DeviceDB.forget_applied_config(device.serial_number, steps or None)
+
 
 def validate_device_request(body_required=True):
     def decorator(f):
@@ -34,18 +107,63 @@ def validate_device_request(body_required=True):
     return decorator
 
 
+def validate_device_type(device_class):
+    """Answer 400 unless the device is a `device_class`"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not isinstance(kwargs['device'], device_class):
+                flask.abort(400)
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def validate_body(validator, body_required=True):
+    """Replace the request body with `validator(req_body)` before the command runs or is
+    queued, a ValueError is answered with 400 and its message. Without `body_required`
+    a missing body is validated as {}."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            req_body = kwargs['req_body'] if body_required else flask.request.get_json(silent=True) or {}
+            try:
+                kwargs['req_body'] = validator(req_body)
+            except ValueError as e:
+                return flask.jsonify({"result": False, "error": str(e)}), 400
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def required_fields(*names):
+    """Validator for validate_body: the body is an object with a value for each of `names`"""
+    def validator(req_body):
+        if not isinstance(req_body, dict):
+            raise ValueError("Expected an object")
+        missing = [name for name in names if req_body.get(name) is None]
+        if missing:
+            raise ValueError(f"Missing {', '.join(missing)}")
+        return req_body
+    return validator
+
+
 @app.route('/', methods=['GET'])
 def home():
     return "PING"
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return flask.jsonify(metrics.snapshot(flask.request.args.get('prefix')))
+
+
 @app.route('/device', methods=['GET'])
 def list():
     with sqlite3.connect(DB_PATH) as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM devices")
         rows = c.fetchall()
-        print(f"[API] Query returned {len(rows) if rows else 0} rows from database")
         devices = []
         if rows is not None:
             for row in rows:
@@ -58,17 +176,18 @@ def list():
                     registered = 0
                     last_seen = None
                 
+                presence = presence_tracker.get(serial_number) or {"online": False, "last_seen": last_seen}
                 devices.append({
                     "ip": ip,
                     "hostname": hostname,
                     "serial_number": serial_number,
                     "friendly_name": friendly_name,
-                    "registered": registered,
-                    "last_seen": last_seen
+                    "registered": DeviceDB.is_registered(registered),
+                    "last_seen": presence["last_seen"],
+                    "online": presence["online"]
                 })
-                print(f"[API] Device found: {serial_number}")
 
-        print(f"[API] Returning {len(devices)} devices")
+        api_log.debug("Returning %d devices", len(devices))
         return flask.jsonify(devices)
 
 
@@ -92,8 +211,59 @@ def registration(serial, device: Device):
         return flask.jsonify(device.registration.dictionary)
 
 
+@app.route('/device/<serial>/presence', methods=['GET'])
+@validate_device_request(body_required=False)
+def presence(serial, device: Device):
+    return flask.jsonify(presence_tracker.get(serial) or {"online": False, "last_seen": device.last_seen})
+
+
+@app.route('/device/<serial>/telemetry', methods=['GET'])
+@validate_device_request(body_required=False)
+def telemetry(serial, device: Device):
+    args = flask.request.args
+    fields = args.get('fields')
+    fields = fields.split(',') if fields else telemetry_store.fields_for(serial)
+    resolution = args.get('resolution', 'auto')
+    if resolution != 'auto' and resolution not in TIER_ORDER:
+        flask.abort(400)
+    try:
+        end = float(args.get('end', time.time()))
+        start = float(args.get('start', end - 86400))
+    except ValueError:
+        flask.abort(400)
+    return flask.jsonify(telemetry_store.query(serial, fields, start, end, resolution))
+
+
+@app.route('/events/history', methods=['GET'])
+def event_history():
+    args = flask.request.args
+    types = args.get('type')
+    try:
+        page = event_log.query(serial=args.get('serial'),
+                               types=types.split(',') if types else None,
+                               start=float(args['start']) if 'start' in args else None,
+                               end=float(args['end']) if 'end' in args else None,
+                               cursor=args.get('cursor'),
+                               limit=int(args.get('limit', DEFAULT_PAGE_SIZE)),
+                               ascending=args.get('order', 'desc') == 'asc')
+    except ValueError:
+        flask.abort(400)
+    return flask.jsonify(page)
+
+
+@app.route('/relay', methods=['GET'])
+def relay():
+    return flask.jsonify({"enabled": rtsp_relay.enabled, "port": rtsp_relay.port, "streams": rtsp_relay.status()})
+
+
+@app.route('/streams', methods=['GET'])
+def streams():
+    return flask.jsonify(dict(rtsp_relay.health(), enabled=rtsp_relay.enabled))
+
+
 @app.route('/device/<serial>/statusrequest', methods=['POST'])
 @validate_device_request(body_required=False)
+@asynchronous
 def status_request(serial, device: Device):
     result = device.status_request()
     return flask.jsonify({"result": result})
@@ -101,95 +271,214 @@ def status_request(serial, device: Device):
 
 @app.route('/device/<serial>/userstreamactive', methods=['POST'])
 @validate_device_request()
+@validate_device_type(Camera)
+@validate_body(required_fields('active'))
+@asynchronous
 def user_stream_active(serial, req_body, device: Camera):
-    # active = req_body["active"]
-    # if active is None:
-    #     flask.abort(400)
+    result = stream_leases.override(device, req_body['active'])
+    return flask.jsonify({"result": result})
+
 
-    # result = device.set_user_stream_active(int(active))
+@app.route('/device/<serial>/streamlease', methods=['POST'])
+@validate_device_request(body_required=False)
+def acquire_stream_lease(serial, device: Camera):
+    if not isinstance(device, Camera):
+        flask.abort(400)
+    req_body = flask.request.get_json(silent=True) or {}
+    try:
+        lease = stream_leases.acquire(serial, req_body.get('holder'), req_body.get('ttl'))
+    except (TypeError, ValueError) as e:
+        return flask.jsonify({"result": False, "error": str(e)}), 400
+    response = flask.jsonify(lease.to_dict())
+    response.status_code = 201
+    response.headers['Location'] = f"/streamleases/{lease.id}"
+    return response
+
+
+@app.route('/streamleases', methods=['GET'])
+def stream_lease_table():
+    return flask.jsonify(stream_leases.status(flask.request.args.get('serial')))
+
+
+@app.route('/streamleases/<lease_id>', methods=['GET', 'PUT', 'DELETE'])
+def stream_lease(lease_id):
+    if flask.request.method == 'DELETE':
+        if not stream_leases.release(lease_id):
+            flask.abort(404)
+        return flask.jsonify({"result": True})
+    if flask.request.method == 'PUT':
+        req_body = flask.request.get_json(silent=True) or {}
+        try:
+            lease = stream_leases.heartbeat(lease_id, req_body.get('ttl'))
+        except (TypeError, ValueError) as e:
+            return flask.jsonify({"result": False, "error": str(e)}), 400
+        lease = lease.to_dict() if lease is not None else None
+    else:
+        lease = stream_leases.get(lease_id)
+    if lease is None:
+        flask.abort(404)
+    return flask.jsonify(lease)
+
+
+def consumer_from_body(req_body):
+    if not isinstance(req_body, dict):
+        raise ValueError("Expected an object")
+    if req_body.get('consumer'):
+        parse_address(req_body['consumer'])
+    return req_body
+
+
+@app.route('/device/<serial>/call', methods=['POST', 'DELETE'])
+@validate_device_request(body_required=False)
+@validate_device_type(AudioDoorbell)
+@validate_body(consumer_from_body, body_required=False)
+@asynchronous
+def call(serial, req_body, device: AudioDoorbell):
+    if flask.request.method == 'DELETE':
+        return flask.jsonify({"result": doorbell_audio.hang_up(serial, 'hung_up')})
+    audio_call = doorbell_audio.call(device, req_body.get('consumer'))
+    return flask.jsonify(dict(audio_call.to_dict(), result=True))
+
+
+@app.route('/calls', methods=['GET'])
+def calls():
+    return flask.jsonify(doorbell_audio.status())
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        flask.abort(404)
+    return flask.jsonify(job.to_dict())
+
+
+@app.route('/device/<serial>/reconfigure', methods=['POST'])
+@validate_device_request(body_required=False)
+def reconfigure(serial, device: Device):
+    config_changed(device)
     return flask.jsonify({"result": True})
 
 
 @app.route('/device/<serial>/arm', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('PIRTargetState'))
+@asynchronous
 def arm(serial, req_body, device: Device):
     result = device.arm(req_body)
+    config_changed(device, 'arm')
     return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/pirled', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('enabled', 'sensitivity'))
+@asynchronous
 def pir_led(serial, req_body, device: Camera):
     result = device.pir_led(req_body)
+    config_changed(device, 'pir_led')
     return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/nightmodeligthsourcealert', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('enabled'))
+@asynchronous
 def night_mode_light_source_alert(serial, req_body, device: Camera):
     result = device.night_mode_light_source_alert(req_body)
+    config_changed(device, 'register_set')
     return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/videoflip', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('enabled'))
+@asynchronous
 def video_flip(serial, req_body, device: Camera):
     result = device.video_flip(req_body)
+    config_changed(device, 'register_set')
     return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/videomirror', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('enabled'))
+@asynchronous
 def video_mirror(serial, req_body, device: Camera):
     result = device.video_mirror(req_body)
+    config_changed(device, 'register_set')
     return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/nightmodegrey', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('value'))
+@asynchronous
 def night_mode_grey(serial, req_body, device: Camera):
     result = device.night_mode_grey(req_body)
+    config_changed(device, 'register_set')
     return flask.jsonify({"result": result})
 
 
+def quality_from_body(req_body):
+    req_body = required_fields('quality')(req_body)
+    if not isinstance(req_body['quality'], str):
+        raise ValueError("Expected the quality as a string")
+    return req_body
+
+
 @app.route('/device/<serial>/quality', methods=['POST'])
 @validate_device_request()
+@validate_body(quality_from_body)
+@asynchronous
 def set_quality(serial, req_body, device: Camera):
-    if req_body['quality'] is None:
+    result = device.set_quality(req_body)
+    config_changed(device, 'quality')
+    if result:
+        adaptive_quality.set_manually(serial, req_body['quality'])
+    return flask.jsonify({"result": result})
+
+
+@app.route('/quality', methods=['GET'])
+def quality_controller():
+    return flask.jsonify({"enabled": adaptive_quality.enabled,
+                          "cameras": adaptive_quality.status(flask.request.args.get('serial'))})
+
+
+@app.route('/quality/audit', methods=['GET'])
+def quality_audit():
+    try:
+        limit = int(flask.request.args.get('limit', 100))
+    except ValueError:
         flask.abort(400)
-    else:
-        result = device.set_quality(req_body)
-        return flask.jsonify({"result": result})
+    return flask.jsonify(adaptive_quality.audit_trail(flask.request.args.get('serial'), limit))
 
 
 @app.route('/device/<serial>/snapshot', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('url'))
+@asynchronous
 def request_snapshot(serial, req_body, device: Camera):
-    if req_body['url'] is None:
-        flask.abort(400)
-    else:
-        result = device.snapshot_request(req_body['url'])
-        return flask.jsonify({"result": result})
+    result = device.snapshot_request(req_body['url'])
+    return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/audiomic', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('enabled'))
+@asynchronous
 def request_mic(serial, req_body, device: Camera):
-    if req_body['enabled'] is None:
-        flask.abort(400)
-    else:
-        result = device.mic_request(req_body['enabled'])
-        return flask.jsonify({"result": result})
+    result = device.mic_request(req_body['enabled'])
+    return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/audiospeaker', methods=['POST'])
 @validate_device_request()
+@validate_body(required_fields('enabled'))
+@asynchronous
 def request_speaker(serial, req_body, device: Device):
-    if req_body['enabled'] is None:
-        flask.abort(400)
-    else:
-        result = device.speaker_request(req_body['enabled'])
-        return flask.jsonify({"result": result})
+    result = device.speaker_request(req_body['enabled'])
+    return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/friendlyname', methods=['POST'])
@@ -203,17 +492,55 @@ def set_friendlyname(serial, req_body, device: Device):
         return flask.jsonify({"result": True})
 
 
-@app.route('/device/<serial>/activityzones', methods=['POST', 'DELETE'])
+def zones_from_body(req_body):
+    if not isinstance(req_body, dict):
+        raise ValueError("Expected an object with 'zones'")
+    return validate_zones(req_body.get('zones'))
+
+
+@app.route('/device/<serial>/activityzones', methods=['GET'])
+@validate_device_request(body_required=False)
+@validate_device_type(Camera)
+def get_activity_zones(serial, device: Camera):
+    return flask.jsonify(DeviceDB.activity_zones(serial) or [])
+
+
+@app.route('/device/<serial>/activityzones', methods=['POST'])
 @validate_device_request()
+@validate_device_type(Camera)
+@validate_body(zones_from_body)
+@asynchronous
 def set_activity_zones(serial, req_body, device: Camera):
-    if flask.request.method == 'DELETE':
-        result = device.unset_activity_zones()
-    else:
-        result = device.set_activity_zones(req_body)
+    result = device.set_activity_zones(req_body)
+    if result:
+        DeviceDB.save_activity_zones(serial, req_body)
+    return flask.jsonify({"result": result, "zones": req_body})
+
 
+@app.route('/device/<serial>/activityzones', methods=['DELETE'])
+@validate_device_request(body_required=False)
+@validate_device_type(Camera)
+@asynchronous
+def unset_activity_zones(serial, device: Camera):
+    result = device.unset_activity_zones()
+    if result:
+        DeviceDB.save_activity_zones(serial, [])
     return flask.jsonify({"result": result})
 
 
+@app.route('/device/<serial>/zonestats', methods=['GET', 'DELETE'])
+@validate_device_request(body_required=False)
+@validate_device_type(Camera)
+def zone_stats(serial, device: Camera):
+    if flask.request.method == 'DELETE':
+        zone_analytics.reset(serial)
+        return flask.jsonify({"result": True})
+    stats = zone_analytics.query(serial, DeviceDB.activity_zones(serial))
+    if stats is None:
+        return flask.jsonify({})
+    return flask.jsonify(stats)
+
+
 @app.route('/snapshot/<identifier>/', methods=['POST'])
 def receive_snapshot(identifier):
     if 'file' not in flask.request.files:
@@ -255,22 +582,28 @@ def get_snapshot(identifier):
 
 @app.route('/device/<serial>/message', methods=['POST'])
 @validate_device_request()
+@asynchronous
 def message(serial, req_body, device: Device):
     result = device.send_message_dict(req_body)
+    config_changed(device)
     return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/registerset', methods=['POST'])
 @validate_device_request()
+@asynchronous
 def register_set(serial, req_body, device: Device):
     result = device.register_set(req_body)
+    config_changed(device)
     return flask.jsonify({"result": result})
 
 
 @app.route('/device/<serial>/settings', methods=['POST'])
 @validate_device_request()
+@asynchronous
 def update_settings(serial, req_body, device: Camera):
     result = device.update_settings(req_body)
+    config_changed(device)
     return flask.jsonify({"result": result})
 
 
@@ -0,0 +1,138 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+job_log = get_logger('jobs')
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_PENDING = 64
+DEFAULT_HISTORY = 256
+CALLBACK_TIMEOUT = 5
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, serial, method, path, callback_url=None):
+        self.id = uuid.uuid4().hex
+        self.serial = serial
+        self.method = method
+        self.path = path
+        self.callback_url = callback_url
+        self.status = 'queued'
+        self.http_status = None
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "serial": self.serial,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "http_status": self.http_status,
+            "result": self.result,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "queue_seconds": self.started - self.submitted if self.started else None,
+            "run_seconds": self.finished - self.started if self.finished and self.started else None,
+        }
+
+
+class JobManager:
+    """Runs device commands in the background for clients that opted into async mode.
+
+    At most `workers` jobs run at once and `max_pending` may be queued or running,
+    beyond that new jobs are refused. The last `history` finished jobs are kept so
+    their outcome can be fetched, older ones are forgotten.
+    """
+
+    def __init__(self):
+        self.workers = DEFAULT_WORKERS
+        self.max_pending = DEFAULT_MAX_PENDING
+        self.history = DEFAULT_HISTORY
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.finished = OrderedDict()
+        self.executor = None
+
+    def configure(self, config):
+        self.workers = max(int(config.get('JobWorkers', DEFAULT_WORKERS)), 1)
+        self.max_pending = max(int(config.get('JobMaxPending', DEFAULT_MAX_PENDING)), 1)
+        self.history = max(int(config.get('JobHistory', DEFAULT_HISTORY)), 1)
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+
+    def submit(self, job, function):
+        """Queue `function()`, which returns (json body, http status), and return the job"""
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                metrics.increment('jobs_rejected')
+                raise JobQueueFull()
+            self.pending[job.id] = job
+            metrics.set_gauge('jobs_pending', len(self.pending))
+        if self.executor is None:
+            self.start()
+        self.executor.submit(self.run, job, function)
+        return job
+
+    def run(self, job, function):
+        job.started = time.time()
+        job.status = 'running'
+        try:
+            job.result, job.http_status = function()
+            job.status = 'succeeded' if job.http_status < 400 else 'failed'
+        except Exception as e:
+            job_log.exception("Job %s failed: %s", job.id, e, serial=job.serial)
+            job.error = str(e)
+            job.http_status = getattr(e, 'code', 500)
+            job.status = 'failed'
+        job.finished = time.time()
+
+        with self.lock:
+            self.pending.pop(job.id, None)
+            self.finished[job.id] = job
+            while len(self.finished) > self.history:
+                self.finished.popitem(last=False)
+            metrics.set_gauge('jobs_pending', len(self.pending))
+        metrics.increment('jobs', outcome=job.status)
+        metrics.observe('job_seconds', job.finished - job.submitted)
+        job_log.info("Job %s %s %s in %.2fs", job.id, job.path, job.status, job.finished - job.submitted, serial=job.serial)
+
+        if job.callback_url:
+            self.callback(job)
+
+    def callback(self, job):
+        try:
+            requests.post(job.callback_url, json=job.to_dict(), timeout=CALLBACK_TIMEOUT)
+        except requests.RequestException as e:
+            metrics.increment('job_callbacks_failed')
+            job_log.warning("Job callback to %s failed: %s", job.callback_url, e, serial=job.serial)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.pending.get(job_id) or self.finished.get(job_id)
+
+    def stop(self):
+        """Cancel the queued jobs, the running ones finish on their own"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+job_manager = JobManager()
@@ -0,0 +1,270 @@
+import array
+import bisect
+import itertools
+import json
+import numbers
+import sqlite3
+import threading
+import time
+import uuid
+
+from arlo.device_db import DB_PATH
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+zone_log = get_logger('zones')
+
+MAX_ZONES = 3
+MIN_POINTS = 3
+MAX_POINTS = 16
+MAX_NAME_LENGTH = 32
+# Colours the Arlo app uses for its first three zones
+DEFAULT_COLORS = (8524960, 41210, 15790130)
+
+# A pirMotionAlert reports z0 (the whole frame) to z3 in PIRMotion, with MdZones as bitmask
+SLOTS = 4
+INTENSITY_BINS = 101
+HOURS = 24
+DEFAULT_FLUSH_INTERVAL = 300
+
+# Per slot row in ZoneStats.data: [alerts, counter sum, intensity histogram (0-100), alerts per hour of day]
+HITS = 0
+COUNTER_SUM = 1
+HISTOGRAM = 2
+HOURLY = HISTOGRAM + INTENSITY_BINS
+ROW = HOURLY + HOURS
+
+
+class InvalidZones(ValueError):
+    pass
+
+
+def _coordinate(point, axis, where):
+    value = point.get(axis) if isinstance(point, dict) else None
+    if not isinstance(value, numbers.Real) or isinstance(value, bool):
+        raise InvalidZones(f"{where}: '{axis}' must be a number")
+    if not 0 <= value <= 1:
+        raise InvalidZones(f"{where}: '{axis}' must be between 0 and 1")
+    return round(float(value), 6)
+
+
+def _area(coords):
+    # Shoelace formula, zero for collinear or repeated points
+    total = 0.0
+    for a, b in zip(coords, coords[1:] + coords[:1]):
+        total += a['x'] * b['y'] - b['x'] * a['y']
+    return abs(total) / 2
+
+
+def validate_zone(zone, index):
+    where = f"zone {index}"
+    if not isinstance(zone, dict):
+        raise InvalidZones(f"{where}: expected an object")
+
+    name = zone.get('name', f"Zone {index + 1}")
+    if not isinstance(name, str) or not name.strip() or len(name) > MAX_NAME_LENGTH:
+        raise InvalidZones(f"{where}: 'name' must be a non-empty string of at most {MAX_NAME_LENGTH} characters")
+
+    zone_id = zone.get('id')
+    if zone_id is None:
+        zone_id = str(uuid.uuid4())
+    else:
+        try:
+            zone_id = str(uuid.UUID(str(zone_id)))
+        except ValueError:
+            raise InvalidZones(f"{where}: 'id' must be a UUID") from None
+
+    points = zone.get('coords')
+    if not isinstance(points, list) or not MIN_POINTS <= len(points) <= MAX_POINTS:
+        raise InvalidZones(f"{where}: 'coords' must be a list of {MIN_POINTS} to {MAX_POINTS} points")
+    coords = [{"x": _coordinate(point, 'x', f"{where} point {i}"), "y": _coordinate(point, 'y', f"{where} point {i}")}
+              for i, point in enumerate(points)]
+    if _area(coords) == 0:
+        raise InvalidZones(f"{where}: 'coords' do not enclose an area")
+
+    color = zone.get('color', DEFAULT_COLORS[index % len(DEFAULT_COLORS)])
+    if not isinstance(color, int) or isinstance(color, bool) or not 0 <= color <= 0xFFFFFF:
+        raise InvalidZones(f"{where}: 'color' must be an RGB integer")
+
+    return {"name": name.strip(), "id": zone_id, "coords": coords, "color": color}
+
+
+def validate_zones(zones):
+    """Zone definitions as sent in a motionZone message, missing ids and colours filled in.
+    Raises InvalidZones with the first problem found."""
+    if not isinstance(zones, list):
+        raise InvalidZones("'zones' must be a list")
+    if len(zones) > MAX_ZONES:
+        raise InvalidZones(f"At most {MAX_ZONES} zones are supported")
+    zones = [validate_zone(zone, index) for index, zone in enumerate(zones)]
+    ids = [zone['id'] for zone in zones]
+    if len(set(ids)) != len(ids):
+        raise InvalidZones("Zone ids must be unique")
+    return zones
+
+
+class ZoneStats:
+    """Motion statistics of one camera, every counter lives in a single flat array"""
+
+    def __init__(self, since):
+        self.since = since
+        self.last_alert = None
+        self.alerts = 0
+        self.data = array.array('Q', bytes(8 * SLOTS * ROW))
+        self.zone_hits = {}
+        self.dirty = False
+
+    def record(self, motion, timestamp):
+        mask = motion.get('MdZones') or 0
+        hour = time.localtime(timestamp).tm_hour
+        data = self.data
+        for slot in range(SLOTS):
+            intensity = motion.get(f"z{slot}Intensity") or 0
+            if not (mask >> slot) & 1 and intensity <= 0:
+                continue
+            base = slot * ROW
+            data[base + HITS] += 1
+            data[base + COUNTER_SUM] += max(int(motion.get(f"z{slot}Counter") or 0), 0)
+            data[base + HISTOGRAM + min(max(int(intensity), 0), INTENSITY_BINS - 1)] += 1
+            data[base + HOURLY + hour] += 1
+        for zone_id in motion.get('zones') or []:
+            self.zone_hits[zone_id] = self.zone_hits.get(zone_id, 0) + 1
+        self.alerts += 1
+        self.last_alert = timestamp
+        self.dirty = True
+
+    @staticmethod
+    def percentiles(histogram, total, points=(50, 90, 99)):
+        cumulative = list(itertools.accumulate(histogram))
+        return {f"p{p}": bisect.bisect_left(cumulative, total * p / 100) for p in points}
+
+    def slot_summary(self, slot):
+        base = slot * ROW
+        hits = self.data[base + HITS]
+        histogram = self.data[base + HISTOGRAM:base + HOURLY]
+        summary = {
+            "slot": slot,
+            "alerts": hits,
+            "counter_mean": self.data[base + COUNTER_SUM] / hits if hits else None,
+            "hourly": self.data[base + HOURLY:base + ROW].tolist(),
+            "intensity": None,
+        }
+        if hits:
+            intensity = self.percentiles(histogram, hits)
+            intensity['mean'] = sum(value * count for value, count in enumerate(histogram)) / hits
+            intensity['max'] = max(value for value, count in enumerate(histogram) if count)
+            summary['intensity'] = intensity
+        return summary
+
+    def to_dict(self, zones):
+        names = {zone['id']: zone['name'] for zone in zones or []}
+        known = [{"id": zone_id, "name": name, "alerts": self.zone_hits.get(zone_id, 0)} for zone_id, name in names.items()]
+        unknown = [{"id": zone_id, "name": None, "alerts": hits} for zone_id, hits in self.zone_hits.items() if zone_id not in names]
+        return {
+            "since": self.since,
+            "last_alert": self.last_alert,
+            "alerts": self.alerts,
+            "slots": [self.slot_summary(slot) for slot in range(SLOTS)],
+            "zones": known + unknown,
+        }
+
+    def to_row(self, serial):
+        return (serial, self.since, self.last_alert, self.alerts, json.dumps(self.zone_hits), self.data.tobytes())
+
+    @classmethod
+    def from_row(cls, row):
+        (_, since, last_alert, alerts, zone_hits, data) = row
+        if len(data) != 8 * SLOTS * ROW:
+            return None
+        stats = cls(since)
+        stats.last_alert = last_alert
+        stats.alerts = alerts
+        stats.zone_hits = json.loads(zone_hits)
+        stats.data = array.array('Q')
+        stats.data.frombytes(data)
+        return stats
+
+
+class ZoneAnalytics:
+    """Per camera motion statistics from pirMotionAlert frames, flushed to SQLite"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def configure(self, config):
+        self.flush_interval = config.get('ZoneStatsFlushInterval', DEFAULT_FLUSH_INTERVAL)
+
+    def record(self, serial, motion, timestamp=None):
+        if not isinstance(motion, dict):
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            stats = self.stats.get(serial)
+            if stats is None:
+                stats = self.stats[serial] = ZoneStats(timestamp)
+            stats.record(motion, timestamp)
+        metrics.increment('motion_alerts')
+
+    def query(self, serial, zones=None):
+        with self.lock:
+            stats = self.stats.get(serial)
+            return stats.to_dict(zones) if stats is not None else None
+
+    def reset(self, serial):
+        with self.lock:
+            self.stats.pop(serial, None)
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.execute("DELETE FROM zone_stats WHERE serialnumber = ?", (serial,))
+            conn.commit()
+
+    ### PERSISTENCE ###
+
+    def load(self):
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT serialnumber, since, last_alert, alerts, zone_hits, data FROM zone_stats")
+            with self.lock:
+                for row in c.fetchall():
+                    stats = ZoneStats.from_row(row)
+                    if stats is None:
+                        zone_log.warning("Ignoring stored zone statistics with an unexpected layout", serial=row[0])
+                        continue
+                    self.stats[row[0]] = stats
+        zone_log.info("Loaded zone statistics of %d camera(s)", len(self.stats))
+
+    def flush(self):
+        with self.lock:
+            rows = []
+            for serial, stats in self.stats.items():
+                if stats.dirty:
+                    rows.append(stats.to_row(serial))
+                    stats.dirty = False
+        if not rows:
+            return
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.executemany("REPLACE INTO zone_stats VALUES (?,?,?,?,?,?)", rows)
+            conn.commit()
+        zone_log.debug("Flushed zone statistics of %d camera(s)", len(rows))
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                zone_log.error("Zone statistics flush failed: %s", e)
+
+    def start(self):
+        self.load()
+        self.thread = threading.Thread(target=self.run, name='zone-stats', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.flush()
+
+
+zone_analytics = ZoneAnalytics()
@@ -0,0 +1,212 @@
+import collections
+import queue
+import threading
+import time
+
+from arlo.device_db import DeviceDB
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+quality_log = get_logger('quality')
+
+DEFAULT_MIN_INTERVAL = 900
+DEFAULT_SAMPLES = 3
+DEFAULT_SIGNAL_LOW = 2
+DEFAULT_SIGNAL_HIGH = 4
+DEFAULT_BATTERY_LOW = 20
+DEFAULT_AUDIT_SIZE = 500
+
+DOWN = -1
+HOLD = 0
+UP = 1
+
+
+class QualityState:
+    """What the controller knows about one camera"""
+
+    def __init__(self, serial):
+        self.serial = serial
+        # Tier the camera is on, None until the first status after a registration
+        self.tier = None
+        self.last_change = 0
+        self.direction = HOLD
+        self.streak = 0
+        self.pending = False
+        self.reason = None
+
+    def to_dict(self):
+        return {
+            "serial": self.serial,
+            "tier": self.tier,
+            "last_change": self.last_change or None,
+            "direction": self.direction,
+            "streak": self.streak,
+            "pending": self.pending,
+            "reason": self.reason,
+        }
+
+
+def charging(status):
+    return status.get('ChargingState', 'Off') not in ('Off', None) or status.get('ChargerTech', 'None') not in ('None', None)
+
+
+class AdaptiveQuality:
+    """Optional controller stepping each camera's quality tier (raParams and the matching
+    registerSet) down on a weak link or a low battery and back up once they recover.
+
+    Every status report is a sample. A step needs `samples` reports in a row asking for it,
+    signal strengths between `signal_low` and `signal_high` ask for nothing, and a camera is
+    stepped at most once every `min_interval` seconds, one tier at a time. The tiers are the
+    model's quality table in order, bounded by MinVideoQuality and MaxVideoQuality from the
+    device's DeviceSettings, the ceiling defaults to its configured VideoQuality. Changes are
+    sent from a dedicated thread and kept in an audit trail.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.min_interval = DEFAULT_MIN_INTERVAL
+        self.samples = DEFAULT_SAMPLES
+        self.signal_low = DEFAULT_SIGNAL_LOW
+        self.signal_high = DEFAULT_SIGNAL_HIGH
+        self.battery_low = DEFAULT_BATTERY_LOW
+        self.lock = threading.Lock()
+        self.states = {}
+        self.audit = collections.deque(maxlen=DEFAULT_AUDIT_SIZE)
+        self.changes = queue.SimpleQueue()
+        self.worker = threading.Thread(target=self.run, name='adaptive-quality', daemon=True)
+
+    def configure(self, config):
+        self.enabled = bool(config.get('AdaptiveQuality', False))
+        self.min_interval = config.get('AdaptiveQualityMinInterval', DEFAULT_MIN_INTERVAL)
+        self.samples = max(int(config.get('AdaptiveQualitySamples', DEFAULT_SAMPLES)), 1)
+        self.signal_low = config.get('AdaptiveQualitySignalLow', DEFAULT_SIGNAL_LOW)
+        self.signal_high = config.get('AdaptiveQualitySignalHigh', DEFAULT_SIGNAL_HIGH)
+        self.battery_low = config.get('AdaptiveQualityBatteryLow', DEFAULT_BATTERY_LOW)
+        size = max(int(config.get('AdaptiveQualityAuditSize', DEFAULT_AUDIT_SIZE)), 1)
+        if size != self.audit.maxlen:
+            with self.lock:
+                self.audit = collections.deque(self.audit, maxlen=size)
+
+    def start(self):
+        self.worker.start()
+
+    def tiers(self, device, profile):
+        """(tiers in order, lowest allowed index, highest allowed index, configured tier)"""
+        tiers = list(device.model.quality)
+        configured = profile.video_quality
+        if configured == 'default':
+            configured = device.model.default_quality
+        configured = configured.lower() if configured else None
+        low, high = (quality.lower() if quality else None for quality in profile.quality_range)
+        floor = tiers.index(low) if low in tiers else 0
+        ceiling = tiers.index(high) if high in tiers else tiers.index(configured) if configured in tiers else len(tiers) - 1
+        return tiers, floor, max(ceiling, floor), configured if configured in tiers else None
+
+    def direction(self, status):
+        signal = status.get('SignalStrengthIndicator')
+        battery = status.get('BatPercent')
+        battery_low = battery is not None and battery <= self.battery_low and not charging(status)
+        if battery_low:
+            return DOWN, f"battery {battery}%"
+        if signal is None:
+            return HOLD, None
+        if signal <= self.signal_low:
+            return DOWN, f"signal {signal}"
+        if signal >= self.signal_high:
+            return UP, f"signal {signal}"
+        return HOLD, None
+
+    def observe(self, device, status, profile):
+        """Take one status report of `device` into account, called for every status frame"""
+        if not self.enabled or not device.model.quality:
+            return
+        tiers, floor, ceiling, configured = self.tiers(device, profile)
+        direction, reason = self.direction(status)
+        now = time.time()
+        with self.lock:
+            state = self.states.get(device.serial_number)
+            if state is None:
+                state = self.states[device.serial_number] = QualityState(device.serial_number)
+            if state.tier not in tiers:
+                state.tier = configured
+            if state.tier is None or state.pending:
+                return
+            current = tiers.index(state.tier)
+            if current > ceiling or current < floor:
+                # The allowed range changed, move into it straight away
+                target, reason = min(max(current, floor), ceiling), "outside MinVideoQuality/MaxVideoQuality"
+            else:
+                if direction != state.direction:
+                    state.direction, state.streak = direction, 0
+                state.streak += 1
+                target = min(max(current + direction, floor), ceiling)
+                if (target == current or state.streak < self.samples
+                        or now - state.last_change < self.min_interval):
+                    return
+            state.pending = True
+            state.reason = reason
+        self.changes.put((device, state, tiers[current], tiers[target], reason))
+
+    def run(self):
+        while True:
+            device, state, old, new, reason = self.changes.get()
+            try:
+                self.change(device, state, old, new, reason)
+            except Exception as e:
+                quality_log.exception("Quality change failed: %s", e, serial=device.serial_number)
+                with self.lock:
+                    state.pending = False
+
+    def change(self, device, state, old, new, reason):
+        result = device.set_quality({'quality': new})
+        now = time.time()
+        if result:
+            # The configured quality is pushed again on the next registration
+            DeviceDB.forget_applied_config(device.serial_number, ['quality'])
+        with self.lock:
+            state.pending = False
+            state.streak = 0
+            state.last_change = now
+            if result:
+                state.tier = new
+            self.audit.append({"time": now, "serial": device.serial_number, "from": old, "to": new,
+                               "reason": reason, "source": "controller", "result": result})
+        tiers = list(device.model.quality)
+        step = 'up' if tiers.index(new) > tiers.index(old) else 'down'
+        metrics.increment('adaptive_quality_changes', outcome=step if result else 'failed')
+        quality_log.info("Quality %s -> %s (%s)%s", old, new, reason, "" if result else " not acknowledged",
+                         ip=device.ip, serial=device.serial_number)
+
+    def set_manually(self, serial, tier):
+        """A quality set through the API, the controller carries on from there"""
+        with self.lock:
+            state = self.states.get(serial)
+            previous = state.tier if state is not None else None
+            if state is not None:
+                state.tier = tier.lower()
+                state.streak = 0
+                state.last_change = time.time()
+            self.audit.append({"time": time.time(), "serial": serial, "from": previous, "to": tier.lower(),
+                               "reason": "set through the API", "source": "api", "result": True})
+
+    def registered(self, serial):
+        """The device registered and gets its configured quality again"""
+        with self.lock:
+            state = self.states.get(serial)
+            if state is not None and not state.pending:
+                state.tier = None
+                state.streak = 0
+
+    def status(self, serial=None):
+        with self.lock:
+            states = [self.states[serial]] if serial in self.states else [] if serial else list(self.states.values())
+            return [state.to_dict() for state in states]
+
+    def audit_trail(self, serial=None, limit=100):
+        """Newest first"""
+        with self.lock:
+            entries = [entry for entry in reversed(self.audit) if serial is None or entry['serial'] == serial]
+        return entries[:limit]
+
+
+adaptive_quality = AdaptiveQuality()
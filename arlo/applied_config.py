@@ -0,0 +1,82 @@
+import hashlib
+import json
+import time
+
+from arlo.device_db import DeviceDB
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+registration_log = get_logger('register')
+
+DEFAULT_MAX_AGE = 86400
+
+
+def fingerprint(messages):
+    """Stable hash of what a configuration step sends, the per-send message ID is left out"""
+    payload = []
+    for message, port in messages:
+        values = {key: value for key, value in message.dictionary.items() if key != 'ID'}
+        payload.append([port, values])
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class AppliedConfig:
+    """Pushes the initial configuration of a device, skipping steps it already has.
+
+    A fingerprint of every step is stored once all of its messages were acked. When the
+    device registers again only steps whose fingerprint is missing, different (templates,
+    DeviceSettings, quality, country or flicker rate changed) or older than `max_age` are
+    sent. `force` pushes everything regardless.
+    """
+
+    def __init__(self):
+        self.force = False
+        self.max_age = DEFAULT_MAX_AGE
+
+    def configure(self, config):
+        self.force = bool(config.get('ForceFullConfigPush', False))
+        self.max_age = config.get('AppliedConfigMaxAge', DEFAULT_MAX_AGE)
+
+    def is_current(self, applied, step, step_fingerprint, now):
+        if step not in applied:
+            return False
+        applied_fingerprint, applied_at = applied[step]
+        if applied_fingerprint != step_fingerprint:
+            return False
+        return not self.max_age or now - applied_at < self.max_age
+
+    def apply(self, device, steps, force=False):
+        """Send the steps of `device.initial_config(...)` that are not applied yet, returns True if nothing failed"""
+        return device.run_exclusive(self.apply_steps, device, steps, force)
+
+    def apply_steps(self, device, steps, force):
+        force = force or self.force
+        applied = {} if force else DeviceDB.applied_config(device.serial_number)
+        now = time.time()
+        sent, skipped, failed = [], [], []
+        for step, messages in steps:
+            step_fingerprint = fingerprint(messages)
+            if self.is_current(applied, step, step_fingerprint, now):
+                skipped.append(step)
+                continue
+            ok = True
+            for message, port in messages:
+                ok = device.send_message(message, port) and ok
+            if ok:
+                DeviceDB.record_applied_config(device.serial_number, step, step_fingerprint, time.time())
+                sent.append(step)
+            else:
+                # Whatever part of it landed, the step is sent again on the next registration
+                DeviceDB.forget_applied_config(device.serial_number, [step])
+                failed.append(step)
+
+        for outcome, names in (('sent', sent), ('skipped', skipped), ('failed', failed)):
+            if names:
+                metrics.increment('initial_config_steps', len(names), outcome=outcome)
+        registration_log.info("Initial configuration%s: sent %s, skipped %s, failed %s", " (forced)" if force else "",
+                              sent or '-', skipped or '-', failed or '-', ip=device.ip, serial=device.serial_number)
+        return not failed
+
+
+applied_config = AppliedConfig()
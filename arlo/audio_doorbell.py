@@ -4,23 +4,14 @@ from arlo.messages import Message
 import arlo.messages
 from arlo.device import Device
 
-DEVICE_PREFIXES = [
-    'AAD'
-]
-
-
 class AudioDoorbell(Device):
-    @property
-    def port(self):
-        return 4100
-
-    def send_initial_register_set(self, wifi_country_code, video_anti_flicker_rate=None):
-        registerSet = Message(copy.deepcopy(arlo.messages.AUDIO_DOORBELL_INITIAL_REGISTER_SET))
-        self.send_message(registerSet)
+    def initial_config(self, profile):
+        (first_template, first_port), (template, port) = self.model.initial_register_sets
+        firstRegisterSet = Message(copy.deepcopy(first_template))
 
-        registerSet = Message(copy.deepcopy(arlo.messages.AUDIO_DOORBELL_SECOND_REGISTER_SET))
-        registerSet['SetValues']['WifiCountryCode'] = wifi_country_code
-        self.send_message(registerSet)
+        registerSet = Message(copy.deepcopy(template))
+        registerSet['SetValues']['WifiCountryCode'] = profile.wifi_country_code
+        return [('register_set', [(firstRegisterSet, first_port), (registerSet, port)])]
 
     def arm(self, args):
         register_set = Message(copy.deepcopy(arlo.messages.REGISTER_SET))
@@ -34,3 +25,16 @@ class AudioDoorbell(Device):
         }
 
         return self.send_message(register_set)
+
+    def rtp_invite_message(self):
+        """Two-way audio, step one: the doorbell answers with the port it receives audio on"""
+        return Message(copy.deepcopy(arlo.messages.AUDIO_DOORBELL_RTP_INVITE))
+
+    def rtp_request_message(self, port):
+        """Two-way audio, step two: `port` is where the doorbell sends its microphone audio"""
+        rtp_request = Message(copy.deepcopy(arlo.messages.AUDIO_DOORBELL_RTP_REQUEST))
+        rtp_request['AudioStream']['Port'] = port
+        return rtp_request
+
+    def rtp_bye_message(self):
+        return Message(copy.deepcopy(arlo.messages.AUDIO_DOORBELL_END_OF_CALL_1))
@@ -4,52 +4,34 @@ from arlo.messages import Message
 import arlo.messages
 from arlo.device import Device
 
-DEVICE_PREFIXES = [
-    'VMC',
-    'VML',
-    'ABC',
-    'FB'
-]
-
-
 class Camera(Device):
-    @property
-    def port(self):
-        return 4000
-
-    def send_initial_register_set(self, wifi_country_code, video_anti_flicker_rate=None, video_quality_default='default', device_settings=None):
-        if self.model_number.startswith('VMC5040'):
-            registerSet = Message(copy.deepcopy(arlo.messages.REGISTER_SET_INITIAL_ULTRA))
-        elif self.model_number.startswith('FB1001'):
-            registerSet = Message(copy.deepcopy(arlo.messages.REGISTER_SET_INITIAL_FLOODLIGHT))
-        else:
-            registerSet = Message(copy.deepcopy(arlo.messages.REGISTER_SET_INITIAL_SUBSCRIPTION))
-            self.arm({"PIRTargetState": "Armed"})
-        registerSet['SetValues']['WifiCountryCode'] = wifi_country_code
-        registerSet['SetValues']['VideoAntiFlickerRate'] = video_anti_flicker_rate
-        
-        # Extract quality and PIR LED settings if provided in device_settings
-        quality = video_quality_default
-        pir_enabled = None
-        pir_sensitivity = None
-        if device_settings and isinstance(device_settings, dict):
-            quality = device_settings.pop('VideoQuality', video_quality_default)
-            pir_enabled = device_settings.pop('PIREnableLED', None)
-            pir_sensitivity = device_settings.pop('PIRLEDSensitivity', None)
-            registerSet['SetValues'].update(device_settings)
-        
-        self.send_message(registerSet)
-
+    def initial_config(self, profile):
+        steps = []
+        if self.model.arm_on_register:
+            steps.append(('arm', [(self.arm_message({"PIRTargetState": "Armed"}), None)]))
+        template, port = self.model.initial_register_sets[0]
+        registerSet = Message(copy.deepcopy(template))
+        registerSet['SetValues']['WifiCountryCode'] = profile.wifi_country_code
+        registerSet['SetValues']['VideoAntiFlickerRate'] = profile.video_anti_flicker_rate
+        registerSet['SetValues'].update(profile.register_set_values())
+        steps.append(('register_set', [(registerSet, port)]))
+
+        quality = profile.video_quality
         if quality == 'default':
-            quality = 'insane'
+            quality = self.model.default_quality
+
+        quality_messages = self.quality_messages(quality)
+        if quality_messages is not None:
+            steps.append(('quality', [(message, None) for message in quality_messages]))
 
-        self.set_quality({'quality': quality})
-        
         # Apply PIR LED settings if provided
-        if pir_enabled is not None and pir_sensitivity is not None:
-            self.pir_led({'enabled': pir_enabled, 'sensitivity': pir_sensitivity})
+        if profile.pir_led is not None:
+            pir_enabled, pir_sensitivity = profile.pir_led
+            steps.append(('pir_led', [(self.pir_led_message({'enabled': pir_enabled, 'sensitivity': pir_sensitivity}), None)]))
 
-    def pir_led(self, args):
+        return steps
+
+    def pir_led_message(self, args):
         register_set = Message(copy.deepcopy(arlo.messages.REGISTER_SET))
         enabled = args['enabled']
         sensitivity = args['sensitivity']
@@ -59,7 +41,10 @@ class Camera(Device):
             "PIRLEDSensitivity": sensitivity
         }
 
-        return self.send_message(register_set)
+        return register_set
+
+    def pir_led(self, args):
+        return self.send_message(self.pir_led_message(args))
 
     def night_mode_light_source_alert(self, args):
         register_set = Message(copy.deepcopy(arlo.messages.REGISTER_SET))
@@ -111,58 +96,35 @@ class Camera(Device):
         register_set["SetValues"] = settings
         return self.send_message(register_set)
 
-    def set_activity_zones(self, args):
-        activity_zones = Message(copy.deepcopy(arlo.messages.ACTIVITY_ZONE_ALL))
-        # TODO:Set The Co-ordinates
-        return self.send_message(activity_zones)
-
-    def unset_activity_zones(self, args):
+    def activity_zones_message(self, zones):
         activity_zones = Message(copy.deepcopy(arlo.messages.ACTIVITY_ZONE_DELETE))
-        return self.send_message(activity_zones)
+        activity_zones['intrZone'] = zones
+        return activity_zones
+
+    def set_activity_zones(self, zones):
+        """Program the motion zones, validated with arlo.activity_zones.validate_zones()"""
+        return self.send_message(self.activity_zones_message(zones))
+
+    def unset_activity_zones(self):
+        return self.send_message(self.activity_zones_message([]))
+
+    def quality_messages(self, quality):
+        templates = self.model.quality.get(quality.lower())
+        if templates is None:
+            return None
+
+        ra_params, registerSet = templates
+        return [Message(copy.deepcopy(ra_params)), Message(copy.deepcopy(registerSet))]
 
     def set_quality(self, args):
-        quality = args["quality"].lower()
-        if quality == "low":
-            ra_params = Message(copy.deepcopy(
-                arlo.messages.RA_PARAMS_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.RA_PARAMS_LOW_QUALITY))
-            registerSet = Message(copy.deepcopy(
-                arlo.messages.REGISTER_SET_LOW_QUALITY_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.REGISTER_SET_LOW_QUALITY))
-        elif quality == "medium":
-            ra_params = Message(copy.deepcopy(
-                arlo.messages.RA_PARAMS_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.RA_PARAMS_MEDIUM_QUALITY))
-            registerSet = Message(copy.deepcopy(
-                arlo.messages.REGISTER_SET_MEDIUM_QUALITY_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.REGISTER_SET_MEDIUM_QUALITY))
-        elif quality == "high":
-            ra_params = Message(copy.deepcopy(
-                arlo.messages.RA_PARAMS_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.RA_PARAMS_HIGH_QUALITY))
-            registerSet = Message(copy.deepcopy(
-                arlo.messages.REGISTER_SET_HIGH_QUALITY_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.REGISTER_SET_HIGH_QUALITY))
-        elif quality == "subscription":
-            ra_params = Message(copy.deepcopy(
-                arlo.messages.RA_PARAMS_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.RA_PARAMS_SUBSCRIPTION_QUALITY))
-            registerSet = Message(copy.deepcopy(
-                arlo.messages.REGISTER_SET_HIGH_QUALITY_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.REGISTER_SET_SUBSCRIPTION_QUALITY))
-        elif quality == "insane":
-            ra_params = Message(copy.deepcopy(
-                arlo.messages.RA_PARAMS_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.RA_PARAMS_INSANE_QUALITY))
-            registerSet = Message(copy.deepcopy(
-                arlo.messages.REGISTER_SET_HIGH_QUALITY_FLOODLIGHT if self.model_number.startswith('FB1001')
-                else arlo.messages.REGISTER_SET_INSANE_QUALITY))
-        else:
+        messages = self.quality_messages(args["quality"])
+        if messages is None:
             return False
 
-        return self.send_message(ra_params) and self.send_message(registerSet)
+        ra_params, registerSet = messages
+        return self.run_exclusive(lambda: self.send_message(ra_params) and self.send_message(registerSet))
 
-    def arm(self, args):
+    def arm_message(self, args):
         register_set = Message(copy.deepcopy(arlo.messages.REGISTER_SET))
 
         pir_target_state = args['PIRTargetState']
@@ -182,7 +144,10 @@ class Camera(Device):
             "DefaultMotionStreamTimeLimit": 10
         }
 
-        return self.send_message(register_set)
+        return register_set
+
+    def arm(self, args):
+        return self.send_message(self.arm_message(args))
 
     def set_user_stream_active(self, active):
         register_set = Message(copy.deepcopy(arlo.messages.REGISTER_SET))
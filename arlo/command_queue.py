@@ -0,0 +1,151 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+command_log = get_logger('command')
+
+DEFAULT_MAX_LENGTH = 32
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_ID_BLOCK = 100
+DEFAULT_CONNECT_RETRIES = 2
+DEFAULT_CONNECT_BACKOFF = 0.5
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_HEADER_TIMEOUT = 5
+DEFAULT_BODY_TIMEOUT = 5
+DEFAULT_TIMEOUT = 20
+MAX_MESSAGE_ID = 2 ** 31 - 1
+
+
+class CommandQueueFull(Exception):
+    pass
+
+
+class DeviceActor:
+    """Runs every command for one device, in order, on a single thread"""
+
+    def __init__(self, serial, max_length):
+        self.serial = serial
+        self.queue = queue.Queue(max_length)
+        self.next_id = 0
+        self.id_limit = 0
+        self.thread = threading.Thread(target=self.run, name=f'device-{serial}', daemon=True)
+
+    def run(self):
+        command_queues.local.actor = self
+        while True:
+            try:
+                enqueued, future, function, args = self.queue.get(timeout=command_queues.idle_timeout)
+            except queue.Empty:
+                if command_queues.retire(self):
+                    return
+                continue
+            metrics.observe('command_queue_wait_seconds', time.monotonic() - enqueued, serial=self.serial)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def message_id(self):
+        """Next message ID, reserved from the database a block at a time so it survives restarts"""
+        if self.next_id >= self.id_limit:
+            # Imported here, device_db needs the device classes which need this module
+            from arlo.device_db import DeviceDB
+            block = command_queues.id_block
+            self.next_id = DeviceDB.reserve_message_ids(self.serial, block, MAX_MESSAGE_ID)
+            self.id_limit = self.next_id + block
+        message_id = self.next_id
+        self.next_id += 1
+        return message_id
+
+
+class CommandQueues:
+    """One ordered, bounded command queue per device serial.
+
+    Commands for the same device never overlap, so a sleepy camera is not handed a
+    second socket while it is still answering the first. A device's thread exits
+    after `idle_timeout` seconds without work and is recreated on the next command.
+    """
+
+    def __init__(self):
+        self.max_length = DEFAULT_MAX_LENGTH
+        self.idle_timeout = DEFAULT_IDLE_TIMEOUT
+        self.id_block = DEFAULT_ID_BLOCK
+        self.connect_retries = DEFAULT_CONNECT_RETRIES
+        self.connect_backoff = DEFAULT_CONNECT_BACKOFF
+        # Budgets of one exchange with a device, see Device.exchange
+        self.connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        self.header_timeout = DEFAULT_HEADER_TIMEOUT
+        self.body_timeout = DEFAULT_BODY_TIMEOUT
+        self.timeout = DEFAULT_TIMEOUT
+        self.lock = threading.Lock()
+        self.actors = {}
+        self.local = threading.local()
+
+    def configure(self, config):
+        self.max_length = max(int(config.get('CommandQueueMaxLength', DEFAULT_MAX_LENGTH)), 1)
+        self.idle_timeout = config.get('CommandQueueIdleTimeout', DEFAULT_IDLE_TIMEOUT)
+        self.connect_retries = max(int(config.get('CommandConnectRetries', DEFAULT_CONNECT_RETRIES)), 0)
+        self.connect_backoff = config.get('CommandConnectBackoff', DEFAULT_CONNECT_BACKOFF)
+        self.connect_timeout = config.get('CommandConnectTimeout', DEFAULT_CONNECT_TIMEOUT)
+        self.header_timeout = config.get('CommandHeaderTimeout', DEFAULT_HEADER_TIMEOUT)
+        self.body_timeout = config.get('CommandBodyTimeout', DEFAULT_BODY_TIMEOUT)
+        self.timeout = config.get('CommandTimeout', DEFAULT_TIMEOUT)
+
+    def current(self):
+        """The actor whose thread we are on, if any"""
+        return getattr(self.local, 'actor', None)
+
+    def run(self, serial, function, *args):
+        """Run `function(*args)` on the device's queue and wait for its result.
+
+        Called from the device's own thread (e.g. a composite command sending several
+        messages) it runs straight away. Raises CommandQueueFull when the device already
+        has `max_length` commands waiting.
+        """
+        actor = self.current()
+        if actor is not None and actor.serial == serial:
+            return function(*args)
+        return self.submit(serial, function, *args).result()
+
+    def submit(self, serial, function, *args):
+        """Queue `function(*args)` on the device's queue and return its Future without waiting.
+
+        Raises CommandQueueFull like run().
+        """
+        future = Future()
+        with self.lock:
+            actor = self.actors.get(serial)
+            if actor is None:
+                actor = self.actors[serial] = DeviceActor(serial, self.max_length)
+                actor.thread.start()
+            try:
+                actor.queue.put_nowait((time.monotonic(), future, function, args))
+            except queue.Full:
+                metrics.increment('command_queue_rejected', serial=serial)
+                command_log.warning("Command queue full (%d waiting)", self.max_length, serial=serial)
+                raise CommandQueueFull(serial) from None
+            metrics.set_gauge('command_queue_depth', actor.queue.qsize(), serial=serial)
+        return future
+
+    def retire(self, actor):
+        """Drop an idle actor, unless a command slipped in since it timed out"""
+        with self.lock:
+            if not actor.queue.empty():
+                return False
+            if self.actors.get(actor.serial) is actor:
+                del self.actors[actor.serial]
+            return True
+
+    def depth(self, serial):
+        with self.lock:
+            actor = self.actors.get(serial)
+            return actor.queue.qsize() if actor is not None else 0
+
+
+command_queues = CommandQueues()
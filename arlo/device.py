@@ -1,22 +1,28 @@
 import socket
-import sys
 import copy
 import time
 
-from abc import ABC, abstractproperty, abstractmethod
+from abc import ABC, abstractmethod
 from arlo.messages import Message
-from arlo.socket import ArloSocket
+from arlo.socket import ArloSocket, Deadline, IoTimeout
 import arlo.messages
-from helpers.safe_print import s_print
+from arlo.presence import presence_tracker
+from arlo.command_queue import command_queues
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+command_log = get_logger('command')
 
 
 class Device(ABC):
 
-    @abstractproperty
+    @property
     def port(self):
-        pass
+        return self.model.port
 
-    def __init__(self, ip, registration):
+    def __init__(self, ip, registration, model):
+        # ModelProfile of this model number, see arlo.model_profiles
+        self.model = model
         self.registration = registration
         self.ip = ip
         self.id = 0
@@ -30,39 +36,108 @@ class Device(ABC):
         return self.registration[key]
 
     def send_message(self, message: Message, port=None):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-
-            sock.settimeout(5.0)
+        return command_queues.run(self.serial_number, self.deliver, message, port)
+
+    def post_message(self, message: Message, port=None):
+        """Queue `message` without waiting, returns the Future of whether it was acknowledged"""
+        return command_queues.submit(self.serial_number, self.deliver, message, port)
+
+    def request(self, message: Message, port=None):
+        """Send `message` and return the device's Ack, None when it failed or was refused"""
+        return command_queues.run(self.serial_number, self.exchange, message, port)
+
+    def run_exclusive(self, function, *args):
+        """Run `function(*args)` on this device's command queue, no other command is sent to it meanwhile"""
+        return command_queues.run(self.serial_number, function, *args)
+
+    def connect(self, port, deadline=None):
+        """Connect to the device, retrying with backoff while it is waking up or briefly unreachable.
+        Each attempt gets `CommandConnectTimeout` seconds, all of them together no more than what
+        is left of `deadline`."""
+        deadline = deadline or Deadline()
+        retries = command_queues.connect_retries
+        for attempt in range(retries + 1):
+            timeout, stage = deadline.timeout(command_queues.connect_timeout, 'connect')
+            if timeout is not None and timeout <= 0:
+                self.timed_out(stage)
+                return None
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
             try:
-                sock.connect((self.ip, port or self.port))
+                sock.connect((self.ip, port))
+                return sock
             except OSError as msg:
-                print('Connection to camera failed: {msg}')
-                return False
-
-            result = False
+                sock.close()
+                left = deadline.remaining()
+                backoff = command_queues.connect_backoff * 2 ** attempt
+                if attempt == retries or (left is not None and left <= backoff):
+                    if isinstance(msg, socket.timeout):
+                        self.timed_out(stage)
+                    command_log.warning("Connection to camera failed: %s", msg, ip=self.ip, serial=self.serial_number)
+                    return None
+                metrics.increment('command_connect_retries', serial=self.serial_number)
+                command_log.info("Connection to camera failed: %s, retrying", msg, ip=self.ip, serial=self.serial_number)
+                time.sleep(backoff)
+
+    def timed_out(self, stage):
+        metrics.increment('command_timeouts', serial=self.serial_number, stage=stage)
+
+    def deliver(self, message: Message, port=None):
+        """Send `message` and wait for its ack, only ever called on the device's command queue"""
+        return self.exchange(message, port) is not None
+
+    def exchange(self, message: Message, port=None):
+        """Send `message` and return its Ack, only ever called on the device's command queue.
+
+        The whole exchange, connecting included, gets `CommandTimeout` seconds and the ack
+        `CommandHeaderTimeout` for its length plus `CommandBodyTimeout` for the rest. A device
+        that does not answer in time is given up on, so it holds its queue no longer than that."""
+        deadline = Deadline(command_queues.timeout)
+        sock = self.connect(port or self.port, deadline)
+        if sock is None:
+            return None
+
+        with sock:
+            result = None
             try:
                 arloSock = ArloSocket(sock)
-                self.id += 1
+                self.id = command_queues.current().message_id()
                 message['ID'] = self.id
-                s_print(f">[{self.ip}][{self.id}] {message.toNetworkMessage()}")
-                arloSock.send(message)
-                ack = arloSock.receive()
+                command_log.info("> %r", message, ip=self.ip, serial=self.serial_number, msg_id=self.id)
+                arloSock.send(message, deadline)
+                ack = arloSock.receive(command_queues.header_timeout, command_queues.body_timeout, deadline)
                 if (ack != None):
                     if (ack['ID'] == message['ID']):
-                        s_print(f"<[{self.ip}][{self.id}] {ack.toNetworkMessage()}")
+                        command_log.info("< %r", ack, ip=self.ip, serial=self.serial_number, msg_id=self.id)
+                        presence_tracker.touch(self.serial_number, self.ip)
                         if ('Response' in ack and ack['Response'] != "Ack"):
-                            result = False
+                            result = None
                         else:
-                            result = True
+                            result = ack
+            except IoTimeout as e:
+                self.timed_out(e.stage)
+                command_log.warning("No ack within the %s budget", e.stage, ip=self.ip, serial=self.serial_number,
+                                    msg_id=self.id)
             except:
-                print(f'Exception: {sys.exc_info()}')
+                command_log.exception("Exception while sending message", ip=self.ip, serial=self.serial_number)
             finally:
                 return result
 
     @abstractmethod
-    def send_initial_register_set(self, wifi_country_code, video_anti_flicker_rate=None):
+    def initial_config(self, profile):
+        """Configuration pushed after registration for a DeviceProfile, as ordered (step, [(message, port), ...]) pairs"""
         ...
 
+    def send_initial_register_set(self, profile):
+        return self.run_exclusive(self.send_all_steps, profile)
+
+    def send_all_steps(self, profile):
+        result = True
+        for _, messages in self.initial_config(profile):
+            for message, port in messages:
+                result = self.send_message(message, port) and result
+        return result
+
     def status_request(self):
         _status_request = Message(copy.deepcopy(arlo.messages.STATUS_REQUEST))
         return self.send_message(_status_request)
@@ -97,6 +172,11 @@ class Device(ABC):
         return self.send_message(message)
 
     def send_epoch_bs_time(self):
+        """Queue the basestation time without waiting for the device, returns the Future of its
+        delivery. The time is taken when the command is sent, not when it was queued."""
+        return command_queues.submit(self.serial_number, self.deliver_epoch_bs_time)
+
+    def deliver_epoch_bs_time(self):
         register_set = Message(copy.deepcopy(arlo.messages.REGISTER_SET))
         set_values = {
             'EpochBsTime': int(time.time())
@@ -1,11 +1,16 @@
 import threading
 import sqlite3
 import functools
+import json
 import os
+import time
 
 from arlo.messages import Message
 from arlo.device_factory import DeviceFactory
 from arlo.device import Device
+from helpers.log import get_logger
+
+persist_log = get_logger('persist')
 
 # Database path - use /data for Home Assistant addon, fallback to arlo.db
 DB_PATH = os.getenv('DB_PATH', '/data/arlo.db')
@@ -15,6 +20,9 @@ if not os.path.exists(os.path.dirname(DB_PATH)):
 
 class DeviceDB:
     sqliteLock = threading.Lock()
+    # Boot generation of this run, set by migrate() at startup. The registered column
+    # holds the generation a device last registered in.
+    boot = 0
 
     def synchronized(wrapped):
         @functools.wraps(wrapped)
@@ -41,6 +49,11 @@ class DeviceDB:
             result = c.fetchone()
             return DeviceDB.from_db_row(result)
 
+    @staticmethod
+    def is_registered(registered):
+        """Whether a registered column value means the device registered since this boot"""
+        return 1 if registered and registered == DeviceDB.boot else 0
+
     @staticmethod
     def from_db_row(row):
         if row is not None:
@@ -62,12 +75,11 @@ class DeviceDB:
 
                 device.status = Message.from_json(status)
                 device.friendly_name = friendly_name
-                device.registered = registered
+                device.registered = DeviceDB.is_registered(registered)
                 device.last_seen = last_seen
                 return device
             except Exception as e:
-                print(f"Error loading device from database: {e}")
-                print(f"Row data: {row}")
+                persist_log.error("Error loading device from database: %s, row data: %s", e, row)
                 return None
         else:
             return None
@@ -80,17 +92,109 @@ class DeviceDB:
             # Remove the IP for any redundant device that has the same IP...
             c.execute("UPDATE devices SET ip = 'UNKNOWN' WHERE ip = ? AND serialnumber <> ?",
                       (device.ip, device.serial_number))
-            registered = getattr(device, 'registered', 0)
+            registered = DeviceDB.boot if getattr(device, 'registered', 0) else 0
             last_seen = getattr(device, 'last_seen', None)
             status_json = device.status.toJSON() if device.status else None
             registration_json = device.registration.toJSON() if device.registration else None
-            print(f"[DeviceDB] Persisting device: {device.serial_number} at {device.ip}")
-            print(f"[DeviceDB] Status JSON: {status_json is not None}")
-            print(f"[DeviceDB] Registration JSON: {registration_json is not None}")
             c.execute("REPLACE INTO devices VALUES (?,?,?,?,?,?,?,?)", (device.ip, device.serial_number,
                       device.hostname, status_json, registration_json, device.friendly_name, registered, last_seen))
             conn.commit()
-            print(f"[DeviceDB] Device persisted successfully")
+            persist_log.info("Device persisted (status: %s, registration: %s)", status_json is not None,
+                             registration_json is not None, ip=device.ip, serial=device.serial_number)
+
+    @staticmethod
+    @synchronized
+    def update_status(device: Device):
+        """Write only the ip and status columns of an already persisted device"""
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("UPDATE devices SET ip = 'UNKNOWN' WHERE ip = ? AND serialnumber <> ?",
+                      (device.ip, device.serial_number))
+            status_json = device.status.toJSON() if device.status else None
+            c.execute("UPDATE devices SET ip = ?, status = ? WHERE serialnumber = ?",
+                      (device.ip, status_json, device.serial_number))
+            conn.commit()
+            persist_log.info("Device status persisted", ip=device.ip, serial=device.serial_number)
+
+    @staticmethod
+    @synchronized
+    def update_last_seen(serial, last_seen):
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("UPDATE devices SET last_seen = ? WHERE serialnumber = ?", (last_seen, serial))
+            conn.commit()
+
+    @staticmethod
+    @synchronized
+    def applied_config(serial):
+        """Fingerprints of the initial configuration steps last applied to a device, as {step: (fingerprint, applied_at)}"""
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT step, fingerprint, applied_at FROM applied_config WHERE serialnumber = ?", (serial,))
+            return {step: (fingerprint, applied_at) for (step, fingerprint, applied_at) in c.fetchall()}
+
+    @staticmethod
+    @synchronized
+    def record_applied_config(serial, step, fingerprint, applied_at):
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("REPLACE INTO applied_config VALUES (?,?,?,?)", (serial, step, fingerprint, applied_at))
+            conn.commit()
+
+    @staticmethod
+    @synchronized
+    def forget_applied_config(serial, steps=None):
+        """Drop the fingerprints of `steps` (all when None) so they are pushed again on the next registration"""
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            if steps is None:
+                c.execute("DELETE FROM applied_config WHERE serialnumber = ?", (serial,))
+            else:
+                c.executemany("DELETE FROM applied_config WHERE serialnumber = ? AND step = ?",
+                              [(serial, step) for step in steps])
+            conn.commit()
+
+    @staticmethod
+    @synchronized
+    def reserve_message_ids(serial, count, limit):
+        """Reserve `count` message IDs for a device and return the first, wrapping to 1 before `limit`"""
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT next_id FROM message_ids WHERE serialnumber = ?", (serial,))
+            row = c.fetchone()
+            first = row[0] if row is not None else 1
+            if first + count > limit:
+                first = 1
+            c.execute("REPLACE INTO message_ids VALUES (?,?)", (serial, first + count))
+            conn.commit()
+            return first
+
+    @staticmethod
+    @synchronized
+    def activity_zones(serial):
+        """Zones last programmed into a camera, None if never set"""
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT zones FROM activity_zones WHERE serialnumber = ?", (serial,))
+            row = c.fetchone()
+            return json.loads(row[0]) if row is not None else None
+
+    @staticmethod
+    @synchronized
+    def save_activity_zones(serial, zones):
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("REPLACE INTO activity_zones VALUES (?,?,?)", (serial, json.dumps(zones), time.time()))
+            conn.commit()
+
+    @staticmethod
+    @synchronized
+    def list_summaries():
+        """(serial, hostname, ip, friendly name) of every device, without parsing the stored messages"""
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT serialnumber, hostname, ip, friendlyname FROM devices")
+            return c.fetchall()
 
     @staticmethod
     @synchronized
@@ -108,6 +212,16 @@ class DeviceDB:
                         devices.append(device)
             return devices
 
+    @staticmethod
+    @synchronized
+    def close():
+        """Fold the write-ahead log back into the database file, used on shutdown"""
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+
     @staticmethod
     @synchronized
     def delete(device: Device):
@@ -116,5 +230,7 @@ class DeviceDB:
             # Remove the IP for any redundant device that has the same IP...
             c.execute("DELETE FROM devices WHERE ip = ? AND serialnumber = ?",
                       (device.ip, device.serial_number))            
+            c.execute("DELETE FROM applied_config WHERE serialnumber = ?", (device.serial_number,))
+            c.execute("DELETE FROM activity_zones WHERE serialnumber = ?", (device.serial_number,))
             conn.commit()
             return True
\ No newline at end of file
@@ -0,0 +1,285 @@
+import asyncio
+import collections
+import concurrent.futures
+import socket
+import threading
+import time
+
+from arlo.device_db import DeviceDB
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+audio_log = get_logger('audio')
+
+DEFAULT_PORT_RANGE = '53000-53099'
+DEFAULT_CONSUMER = '127.0.0.1:5004'
+DEFAULT_IDLE_TIMEOUT = 30
+START_TIMEOUT = 5
+IDLE_CHECK_INTERVAL = 1
+
+
+class CallError(Exception):
+    pass
+
+
+def parse_port_range(value):
+    """'53000-53099' -> (53000, 53099)"""
+    first, _, last = str(value).partition('-')
+    first, last = int(first), int(last or first)
+    if not 0 < first <= last < 65536:
+        raise ValueError(f"Invalid port range {value!r}")
+    return first, last
+
+
+def parse_address(value):
+    """'host:port' -> (host, port)"""
+    host, _, port = str(value).rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"Invalid address {value!r}, expected host:port")
+    return host, int(port)
+
+
+class PortPool:
+    """The UDP ports calls receive on. A port goes back to the end of the pool when its call
+    ends, so a late datagram of the old call is unlikely to reach the next one."""
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.lock = threading.Lock()
+        self.free = collections.deque(range(first, last + 1))
+        self.in_use = set()
+
+    def bind(self, host=''):
+        """A UDP socket bound to a free port of the pool, ports taken by other programs are skipped"""
+        with self.lock:
+            for _ in range(len(self.free)):
+                port = self.free.popleft()
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                try:
+                    sock.bind((host, port))
+                except OSError:
+                    sock.close()
+                    self.free.append(port)
+                    continue
+                self.in_use.add(port)
+                metrics.set_gauge('audio_ports_in_use', len(self.in_use))
+                return sock
+        metrics.increment('audio_port_pool_exhausted')
+        raise CallError(f"No free port in {self.first}-{self.last}")
+
+    def release(self, port):
+        with self.lock:
+            if port in self.in_use:
+                self.in_use.discard(port)
+                self.free.append(port)
+            metrics.set_gauge('audio_ports_in_use', len(self.in_use))
+
+
+class AudioRelayProtocol(asyncio.DatagramProtocol):
+    """Copies datagrams between the doorbell and the local consumer on the call's port: what the
+    doorbell sends goes to the consumer, anything else goes to the doorbell. The payload is
+    forwarded as received, it is never decoded or copied into a new buffer."""
+
+    def __init__(self, call):
+        self.call = call
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        call = self.call
+        if address[0] == call.ip:
+            call.from_doorbell += 1
+            self.transport.sendto(data, call.consumer)
+        elif call.doorbell_port is not None:
+            call.to_doorbell += 1
+            self.transport.sendto(data, (call.ip, call.doorbell_port))
+        else:
+            return
+        call.last_packet = time.time()
+
+    def error_received(self, exc):
+        # ICMP port unreachable while the consumer is not listening yet, the next datagram is tried anyway
+        self.call.errors += 1
+
+
+class AudioCall:
+    def __init__(self, serial, ip, consumer, pool, sock):
+        self.serial = serial
+        self.ip = ip
+        self.consumer = consumer
+        # The pool the port came from, it goes back there even after AudioPortRange changed
+        self.pool = pool
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.doorbell_port = None
+        self.transport = None
+        self.started = self.last_packet = time.time()
+        self.from_doorbell = 0
+        self.to_doorbell = 0
+        self.errors = 0
+
+    def to_dict(self):
+        return {
+            "serial": self.serial,
+            "doorbell": f"{self.ip}:{self.doorbell_port}" if self.doorbell_port else None,
+            "port": self.port,
+            "consumer": f"{self.consumer[0]}:{self.consumer[1]}",
+            "started": self.started,
+            "last_packet": self.last_packet,
+            "packets_from_doorbell": self.from_doorbell,
+            "packets_to_doorbell": self.to_doorbell,
+            "send_errors": self.errors,
+        }
+
+
+class DoorbellAudio:
+    """Two-way audio calls with audio doorbells.
+
+    A call takes a receive port from the pool and starts relaying on it, then sends the
+    doorbell an rtpInvite (its answer names the port the doorbell listens on) and an
+    rtpRequest with the pool port. The doorbell's OPUS RTP goes to the configured consumer
+    and whatever the consumer sends to the pool port goes to the doorbell. The relays run on
+    one asyncio loop thread. A call ends with rtpBye, from either side, or after
+    `idle_timeout` seconds without a datagram, and its port returns to the pool.
+    """
+
+    def __init__(self):
+        self.pool = PortPool(*parse_port_range(DEFAULT_PORT_RANGE))
+        self.consumer = parse_address(DEFAULT_CONSUMER)
+        self.idle_timeout = DEFAULT_IDLE_TIMEOUT
+        self.call_on_button_press = False
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.loop = None
+        self.thread = None
+
+    def configure(self, config):
+        try:
+            first, last = parse_port_range(config.get('AudioPortRange', DEFAULT_PORT_RANGE))
+            if (first, last) != (self.pool.first, self.pool.last):
+                # Ports of calls in progress go back to their call's pool, which is then dropped
+                self.pool = PortPool(first, last)
+            self.consumer = parse_address(config.get('AudioConsumer', DEFAULT_CONSUMER))
+        except ValueError as e:
+            audio_log.error("Audio configuration ignored: %s", e)
+        self.idle_timeout = config.get('AudioCallIdleTimeout', DEFAULT_IDLE_TIMEOUT)
+        self.call_on_button_press = bool(config.get('AudioCallOnButtonPress', False))
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name='doorbell-audio', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self.expire_idle())
+        self.loop.run_forever()
+
+    def stop(self, timeout=None):
+        """Hang up every call and stop the relay loop. The rtpByes go out at once and are
+        given up on when not acknowledged within `timeout` seconds."""
+        with self.lock:
+            calls = list(self.calls.values())
+        byes = {}
+        for call in calls:
+            if not self.hang_up(call.serial, 'shutdown', notify=False):
+                continue
+            try:
+                device = DeviceDB.from_db_serial(call.serial)
+                if device is not None:
+                    byes[device.post_message(device.rtp_bye_message())] = call
+            except Exception as e:
+                audio_log.error("rtpBye failed: %s", e, ip=call.ip, serial=call.serial)
+        done, abandoned = concurrent.futures.wait(byes, timeout)
+        for future in done:
+            if future.exception() is not None or not future.result():
+                audio_log.warning("rtpBye was not acknowledged", ip=byes[future].ip, serial=byes[future].serial)
+        for future in abandoned:
+            audio_log.warning("rtpBye abandoned, shutdown timeout reached", ip=byes[future].ip, serial=byes[future].serial)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def expire_idle(self):
+        while True:
+            await asyncio.sleep(IDLE_CHECK_INTERVAL)
+            now = time.time()
+            with self.lock:
+                idle = [call.serial for call in self.calls.values() if now - call.last_packet > self.idle_timeout]
+            for serial in idle:
+                # Hanging up sends rtpBye, which blocks, so not on the loop
+                self.loop.run_in_executor(None, self.hang_up, serial, 'idle')
+
+    async def open_relay(self, call):
+        call.transport, _ = await self.loop.create_datagram_endpoint(lambda: AudioRelayProtocol(call), sock=call.sock)
+
+    def call(self, device, consumer=None):
+        """Start a call with an audio doorbell, returns the AudioCall"""
+        if self.loop is None:
+            raise CallError("Doorbell audio is not running")
+        consumer = parse_address(consumer) if consumer else self.consumer
+        with self.lock:
+            if device.serial_number in self.calls:
+                raise CallError("A call is already in progress")
+            pool = self.pool
+            call = self.calls[device.serial_number] = AudioCall(device.serial_number, device.ip, consumer, pool,
+                                                                pool.bind())
+        try:
+            asyncio.run_coroutine_threadsafe(self.open_relay(call), self.loop).result(START_TIMEOUT)
+            ack = device.request(device.rtp_invite_message())
+            if ack is None:
+                raise CallError("The doorbell did not accept the rtpInvite")
+            call.doorbell_port = ack['AudioStream']['Port']
+            if not device.send_message(device.rtp_request_message(call.port)):
+                raise CallError("The doorbell did not accept the rtpRequest")
+        except Exception as e:
+            metrics.increment('audio_calls', outcome='failed')
+            audio_log.warning("Call failed: %s", e, ip=device.ip, serial=device.serial_number)
+            with self.lock:
+                if self.calls.get(device.serial_number) is call:
+                    del self.calls[device.serial_number]
+            self.end(call)
+            raise CallError(str(e)) from e
+        metrics.increment('audio_calls', outcome='started')
+        audio_log.info("Call started, doorbell port %s, relaying on port %d to %s:%d", call.doorbell_port, call.port,
+                       consumer[0], consumer[1], ip=device.ip, serial=device.serial_number)
+        return call
+
+    def end(self, call):
+        if call.transport is not None:
+            # The transport closes its socket
+            self.loop.call_soon_threadsafe(call.transport.close)
+        else:
+            call.sock.close()
+        call.pool.release(call.port)
+        metrics.increment('audio_packets', call.from_doorbell, direction='from_doorbell')
+        metrics.increment('audio_packets', call.to_doorbell, direction='to_doorbell')
+
+    def hang_up(self, serial, reason, notify=True):
+        """End the call with a doorbell, `notify` sends it an rtpBye. False when there was no call."""
+        with self.lock:
+            call = self.calls.pop(serial, None)
+        if call is None:
+            return False
+        self.end(call)
+        if notify:
+            try:
+                device = DeviceDB.from_db_serial(serial)
+                if device is not None and not device.send_message(device.rtp_bye_message()):
+                    audio_log.warning("rtpBye was not acknowledged", ip=call.ip, serial=serial)
+            except Exception as e:
+                # The port is back in the pool anyway
+                audio_log.error("rtpBye failed: %s", e, ip=call.ip, serial=serial)
+        metrics.increment('audio_calls', outcome=reason)
+        audio_log.info("Call ended (%s) after %d packets from and %d to the doorbell", reason, call.from_doorbell,
+                       call.to_doorbell, ip=call.ip, serial=serial)
+        return True
+
+    def status(self):
+        with self.lock:
+            return [call.to_dict() for call in self.calls.values()]
+
+
+doorbell_audio = DoorbellAudio()
@@ -0,0 +1,185 @@
+import base64
+import json
+import sqlite3
+import threading
+import time
+
+from arlo.device_db import DB_PATH
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+event_log_log = get_logger('events')
+
+# AlertType -> event type in the history, other alert types are stored as they come
+EVENT_TYPES = {
+    'pirMotionAlert': 'motion',
+    'motionTimeoutAlert': 'motion_timeout',
+    'buttonPressAlert': 'button',
+    'audioAlert': 'audio',
+    'audioTimeoutAlert': 'audio_timeout',
+}
+# Header fields, not part of the stored event data
+HEADER_FIELDS = ('Type', 'ID', 'AlertType')
+
+DEFAULT_FLUSH_INTERVAL = 1
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_RETENTION = 90 * 86400
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+PRUNE_INTERVAL = 3600
+PRUNE_CHUNK = 10000
+
+
+def encode_cursor(timestamp, event_id):
+    return base64.urlsafe_b64encode(f"{timestamp!r}:{event_id:d}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(time, id) of the last event of the previous page, ValueError if the cursor is not one of ours"""
+    try:
+        timestamp, event_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split(':')
+        return float(timestamp), int(event_id)
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor") from None
+
+
+class EventLog:
+    """Append-only history of device alerts.
+
+    Events are buffered in memory and written in one transaction per batch, every
+    `flush_interval` seconds or as soon as `batch_size` are pending. Queries use keyset
+    pagination on (time, id), which the (serial, time) and (type, time) indexes serve
+    without scanning skipped rows.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = []
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.retention = DEFAULT_RETENTION
+        self.last_prune = 0
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def configure(self, config):
+        self.flush_interval = config.get('EventLogFlushInterval', DEFAULT_FLUSH_INTERVAL)
+        self.batch_size = max(int(config.get('EventLogBatchSize', DEFAULT_BATCH_SIZE)), 1)
+        self.retention = config.get('EventLogRetention', DEFAULT_RETENTION)
+
+    def record(self, serial, message, timestamp=None):
+        """Queue an alert frame for the history"""
+        timestamp = time.time() if timestamp is None else timestamp
+        alert_type = message['AlertType']
+        data = {key: value for key, value in message.dictionary.items() if key not in HEADER_FIELDS}
+        row = (serial, EVENT_TYPES.get(alert_type, alert_type), timestamp, json.dumps(data, separators=(',', ':')))
+        with self.lock:
+            self.pending.append(row)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        # write_lock keeps batches in order when a query flushes while the writer thread does
+        with self.write_lock:
+            with self.lock:
+                rows, self.pending = self.pending, []
+            if not rows:
+                return
+            started = time.perf_counter()
+            try:
+                with sqlite3.connect(DB_PATH) as conn:
+                    conn.executemany("INSERT INTO events (serialnumber, type, time, data) VALUES (?,?,?,?)", rows)
+                    conn.commit()
+            except sqlite3.Error:
+                # Keep the batch for the next attempt
+                with self.lock:
+                    self.pending[:0] = rows
+                raise
+        metrics.increment('events_written', len(rows))
+        metrics.observe('event_flush_seconds', time.perf_counter() - started)
+        event_log_log.debug("Wrote %d event(s)", len(rows))
+
+    def prune(self, now):
+        if not self.retention:
+            return
+        cutoff = now - self.retention
+        removed = 0
+        with sqlite3.connect(DB_PATH) as conn:
+            types = [event_type for (event_type,) in conn.execute("SELECT DISTINCT type FROM events")]
+            # Per type so the (type, time) index finds old rows, in chunks so the write lock is not held for long
+            for event_type in types:
+                while True:
+                    with self.write_lock:
+                        c = conn.execute("DELETE FROM events WHERE id IN (SELECT id FROM events WHERE type = ? AND time < ? LIMIT ?)",
+                                         (event_type, cutoff, PRUNE_CHUNK))
+                        conn.commit()
+                    removed += c.rowcount
+                    if c.rowcount < PRUNE_CHUNK:
+                        break
+        if removed:
+            event_log_log.info("Removed %d event(s) older than %ds", removed, self.retention)
+
+    def query(self, serial=None, types=None, start=None, end=None, cursor=None, limit=DEFAULT_PAGE_SIZE, ascending=False):
+        """One page of events, newest first unless `ascending`, and the cursor of the next page (None on the last)"""
+        self.flush()
+        clauses = []
+        params = []
+        if serial is not None:
+            clauses.append("serialnumber = ?")
+            params.append(serial)
+        if types:
+            clauses.append(f"type IN ({','.join('?' * len(types))})")
+            params.extend(types)
+        if start is not None:
+            clauses.append("time >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("time < ?")
+            params.append(end)
+        if cursor is not None:
+            clauses.append("(time, id) > (?, ?)" if ascending else "(time, id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        order = "ASC" if ascending else "DESC"
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(limit + 1)
+
+        with sqlite3.connect(DB_PATH) as conn:
+            rows = conn.execute(f"SELECT id, serialnumber, type, time, data FROM events {where} "
+                                f"ORDER BY time {order}, id {order} LIMIT ?", params).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][3], rows[-1][0])
+        events = [{"id": event_id, "serial": serial, "type": event_type, "time": timestamp, "data": json.loads(data)}
+                  for (event_id, serial, event_type, timestamp, data) in rows]
+        return {"events": events, "next_cursor": next_cursor}
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+                now = time.time()
+                if now - self.last_prune >= PRUNE_INTERVAL:
+                    self.last_prune = now
+                    self.prune(now)
+            except Exception as e:
+                event_log_log.error("Event log write failed: %s", e)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='event-log', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+        self.flush()
+
+
+event_log = EventLog()
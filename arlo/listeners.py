@@ -0,0 +1,460 @@
+import argparse
+import collections
+import json
+import os
+import queue
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Connection
+
+import arlo.messages
+from arlo.messages import LazyMessage, Message
+from arlo.socket import ArloSocket, ConnectionClosed, Deadline, IoTimeout
+from helpers.log import configure_logging, get_logger
+from helpers.metrics import metrics
+
+LISTEN_PORTS = (4000, 4100)
+DEFAULT_BACKLOG = 128
+DEFAULT_HANDLERS = 16
+DEFAULT_QUEUE_LENGTH = 64
+DEFAULT_MAX_PER_IP = 4
+DEFAULT_RATE_PER_IP = 5
+DEFAULT_BURST_PER_IP = 20
+DEFAULT_IDLE_TIMEOUT = 5
+DEFAULT_HEADER_TIMEOUT = 5
+DEFAULT_BODY_TIMEOUT = 10
+DEFAULT_FRAME_TIMEOUT = 15
+PRUNE_THRESHOLD = 256
+WORKER_CONFIG_KEYS = ('LogLevel', 'LogRateLimitInterval', 'ListenerHandlers', 'ListenerQueueLength', 'ListenerBacklog',
+                      'ListenerIdleTimeout', 'ListenerHeaderTimeout', 'ListenerBodyTimeout', 'ListenerFrameTimeout',
+                      'ListenerMaxPerIP', 'ListenerRatePerIP', 'ListenerBurstPerIP')
+WORKER_RESTART_DELAY = 1
+WORKER_STOP_TIMEOUT = 5
+ACCEPT_POLL_INTERVAL = 0.5
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ack_log = get_logger('ack')
+frame_log = get_logger('frame')
+listener_log = get_logger('listener')
+
+
+def listening_socket(port, backlog=DEFAULT_BACKLOG, reuse_port=False):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker binds the same port and the kernel spreads the connections over them
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind(('', port))
+    server.listen(backlog)
+    # Another worker may take a connection between select and accept
+    server.setblocking(False)
+    return server
+
+
+def acknowledge(connection, msg, ip, deadline=None):
+    # Only the header fields are decoded at this point, the body is parsed on first use
+    ack = Message(dict(arlo.messages.RESPONSE))
+    ack['ID'] = msg['ID']
+    ack_log.info("Ack", ip=ip, msg_id=msg['ID'])
+    connection.send(ack, deadline)
+
+
+def serve_connection(connection, ip, handle):
+    """Reads frames from one inbound connection until the device closes it or sends nothing for
+    the pool's `idle_timeout` seconds. Every frame is acked, then passed to `handle(ip, msg)`,
+    in the order they arrived, so a device with several frames to deliver needs one connection.
+
+    From its first byte until its ack is sent a frame has `frame_timeout` seconds, of which
+    `header_timeout` for its length and `body_timeout` for the rest. A device that stalls
+    past any of them is dropped and counted in `listener_timeouts`, freeing the handler."""
+    pool = connection_pool
+    connection = ArloSocket(connection)
+    frames = 0
+    try:
+        pool.opened(connection)
+        while True:
+            try:
+                connection.wait(pool.idle_timeout)
+            except ConnectionClosed:
+                break
+            except IoTimeout:
+                metrics.increment('listener_idle_timeouts')
+                break
+            deadline = Deadline(pool.frame_timeout)
+            try:
+                msg = connection.receive(pool.header_timeout, pool.body_timeout, deadline)
+                if msg != None:
+                    acknowledge(connection, msg, ip, deadline)
+            except IoTimeout as e:
+                metrics.increment('listener_timeouts', stage=e.stage)
+                frame_log.warning("Frame not received within its %s budget, connection dropped", e.stage, ip=ip)
+                break
+            if msg != None:
+                frames += 1
+                try:
+                    handle(ip, msg)
+                except Exception as e:
+                    frame_log.exception("Handling the frame failed: %s", e, ip=ip, msg_id=msg['ID'])
+    finally:
+        pool.closed(connection)
+        connection.close()
+        metrics.observe('listener_frames_per_connection', frames)
+
+
+class SourceLimits:
+    """Connections per source IP: at most `max_concurrent` queued or being handled at once, and
+    new ones from a token bucket refilled at `rate` per second holding up to `burst`. An IP is
+    forgotten once it has nothing open and a full bucket again, a scanner walking through the
+    network leaves nothing behind."""
+
+    def __init__(self):
+        self.max_concurrent = DEFAULT_MAX_PER_IP
+        self.rate = DEFAULT_RATE_PER_IP
+        self.burst = DEFAULT_BURST_PER_IP
+        self.sources = {}
+
+    def admit(self, ip, now):
+        """None when a connection from `ip` may go ahead, otherwise the reason it may not"""
+        active, tokens, updated = self.sources.get(ip, (0, self.burst, now))
+        tokens = min(tokens + (now - updated) * self.rate, self.burst)
+        if self.max_concurrent and active >= self.max_concurrent:
+            self.sources[ip] = (active, tokens, now)
+            return 'ip_concurrency'
+        if self.rate and tokens < 1:
+            self.sources[ip] = (active, tokens, now)
+            return 'ip_rate'
+        self.sources[ip] = (active + 1, tokens - 1 if self.rate else tokens, now)
+        return None
+
+    def release(self, ip, now):
+        active, tokens, updated = self.sources[ip]
+        self.sources[ip] = (active - 1, tokens, updated)
+        self.prune(now)
+
+    def prune(self, now):
+        if len(self.sources) < PRUNE_THRESHOLD:
+            return
+        for ip, (active, tokens, updated) in list(self.sources.items()):
+            if active == 0 and (not self.rate or tokens + (now - updated) * self.rate >= self.burst):
+                del self.sources[ip]
+
+
+class ConnectionPool:
+    """Handles accepted connections on a fixed set of threads.
+
+    Accepted connections wait in a queue of at most `queue_length` for one of `handlers`
+    threads. A connection is closed straight away, without an ack, when the queue is full
+    or its source IP is over its limits (see SourceLimits), so a camera in a reconnect loop
+    or a scanner cannot take the handlers from the other devices. Rejections are counted
+    per reason in `listener_rejected`.
+    """
+
+    def __init__(self):
+        self.handlers = DEFAULT_HANDLERS
+        self.queue_length = DEFAULT_QUEUE_LENGTH
+        self.backlog = DEFAULT_BACKLOG
+        self.idle_timeout = DEFAULT_IDLE_TIMEOUT
+        self.header_timeout = DEFAULT_HEADER_TIMEOUT
+        self.body_timeout = DEFAULT_BODY_TIMEOUT
+        self.frame_timeout = DEFAULT_FRAME_TIMEOUT
+        self.limits = SourceLimits()
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        self.busy = 0
+        self.handle = None
+        self.threads = []
+        self.connections = set()
+
+    def configure(self, config):
+        self.handlers = max(int(config.get('ListenerHandlers', DEFAULT_HANDLERS)), 1)
+        self.backlog = max(int(config.get('ListenerBacklog', DEFAULT_BACKLOG)), 1)
+        # Without an idle timeout a device that never sends would hold its handler for good
+        self.idle_timeout = config.get('ListenerIdleTimeout') or DEFAULT_IDLE_TIMEOUT
+        self.header_timeout = config.get('ListenerHeaderTimeout', DEFAULT_HEADER_TIMEOUT)
+        self.body_timeout = config.get('ListenerBodyTimeout', DEFAULT_BODY_TIMEOUT)
+        self.frame_timeout = config.get('ListenerFrameTimeout', DEFAULT_FRAME_TIMEOUT)
+        with self.condition:
+            self.queue_length = max(int(config.get('ListenerQueueLength', DEFAULT_QUEUE_LENGTH)), 0)
+            self.limits.max_concurrent = int(config.get('ListenerMaxPerIP', DEFAULT_MAX_PER_IP))
+            self.limits.rate = float(config.get('ListenerRatePerIP', DEFAULT_RATE_PER_IP))
+            self.limits.burst = max(float(config.get('ListenerBurstPerIP', DEFAULT_BURST_PER_IP)), 1)
+
+    def start(self, handle):
+        self.handle = handle
+        for index in range(self.handlers):
+            thread = threading.Thread(target=self.run, name=f'listener-handler-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def offer(self, connection, ip):
+        """Queue an accepted connection, False when it was rejected and closed"""
+        now = time.monotonic()
+        with self.condition:
+            if len(self.pending) >= self.queue_length and self.busy + len(self.pending) >= self.handlers:
+                reason = 'queue_full'
+            else:
+                reason = self.limits.admit(ip, now)
+            if reason is None:
+                self.pending.append((connection, ip, now))
+                metrics.set_gauge('listener_queue_depth', len(self.pending))
+                self.condition.notify()
+                return True
+        metrics.increment('listener_rejected', reason=reason)
+        listener_log.debug("Connection rejected (%s)", reason, ip=ip)
+        connection.close()
+        return False
+
+    def take(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            connection, ip, queued = self.pending.popleft()
+            self.busy += 1
+            metrics.set_gauge('listener_queue_depth', len(self.pending))
+            metrics.set_gauge('listener_handlers_busy', self.busy)
+        metrics.observe('listener_queue_wait_seconds', time.monotonic() - queued)
+        return connection, ip
+
+    def run(self):
+        while True:
+            connection, ip = self.take()
+            try:
+                serve_connection(connection, ip, self.handle)
+            except Exception as e:
+                frame_log.warning("Connection failed: %s", e, ip=ip)
+                connection.close()
+            finally:
+                with self.condition:
+                    self.busy -= 1
+                    self.limits.release(ip, time.monotonic())
+                    metrics.set_gauge('listener_handlers_busy', self.busy)
+                    if not self.busy and not self.pending:
+                        self.condition.notify_all()
+
+    def opened(self, connection):
+        with self.condition:
+            self.connections.add(connection)
+
+    def closed(self, connection):
+        with self.condition:
+            self.connections.discard(connection)
+
+    def cancel_idle(self):
+        """Close the connections waiting for their next frame, so their handlers need not sit
+        out the idle timeout once no more connections are accepted"""
+        with self.condition:
+            idle = [connection for connection in self.connections if connection.idle]
+        for connection in idle:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return len(idle)
+
+    def drain(self, timeout):
+        """Wait for the queued and running connections to be handled, False when `timeout` ran out first"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+    def status(self):
+        with self.condition:
+            return {"handlers": self.handlers, "busy": self.busy, "queued": len(self.pending),
+                    "queue_length": self.queue_length, "sources": len(self.limits.sources)}
+
+
+class ServerThread(threading.Thread):
+    """Accepts the connections of the devices on 4000 and 4100 and hands them to the ConnectionPool"""
+
+    def __init__(self, handle, ports=LISTEN_PORTS, reuse_port=False):
+        threading.Thread.__init__(self, name='listener')
+        self.handle = handle
+        self.ports = ports
+        self.reuse_port = reuse_port
+        self.stop_event = threading.Event()
+
+    def run(self):
+        servers = [listening_socket(port, connection_pool.backlog, self.reuse_port) for port in self.ports]
+        connection_pool.start(self.handle)
+
+        while not self.stop_event.is_set():
+            try:
+                # Wait for any of the listening servers to get a client connection attempt, then
+                # take one from each ready listener so a busy port cannot starve the other
+                readable, _, _ = select.select(servers, [], [], ACCEPT_POLL_INTERVAL)
+                for ready_server in readable:
+                    try:
+                        connection, (ip, port) = ready_server.accept()
+                    except BlockingIOError:
+                        continue
+                    connection.setblocking(True)
+                    connection_pool.offer(connection, ip)
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                frame_log.error("Accept failed: %s", e)
+
+        for server in servers:
+            server.close()
+        connection_pool.cancel_idle()
+
+    def stop(self, timeout):
+        """Stop accepting, then wait up to `timeout` seconds for the accepted connections"""
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(ACCEPT_POLL_INTERVAL * 2)
+        return connection_pool.drain(timeout)
+
+
+connection_pool = ConnectionPool()
+
+
+class ListenerWorkers(threading.Thread):
+    """Runs the listeners in `count` worker processes instead of this one.
+
+    Every worker binds 4000 and 4100 with SO_REUSEPORT, reads and acks the frames of the
+    connections the kernel gives it and forwards each frame over its own socketpair as
+    "<ip> <json>". Frames are handled here, by `handle(ip, msg)`, so every device's state
+    and every outbound command stays in this process and the command queues keep their
+    per-device order. Every source IP is handled by the same one of the ConnectionPool's
+    handler threads, so a device's frames are handled in the order it sent them, e.g. its
+    registration before its status. Each handler thread has its own share of the pool's
+    queue length, once that is full the workers' sends block until their own pools reject
+    connections. A worker that exits is started again, and it exits once this process is gone.
+    """
+
+    def __init__(self, handle, count, config, ports=LISTEN_PORTS):
+        threading.Thread.__init__(self, name='listener-workers')
+        self.handle = handle
+        self.count = count
+        # Logging and ConnectionPool settings of the workers, read when a worker starts
+        self.config = {key: config.get(key) for key in WORKER_CONFIG_KEYS if config.get(key) is not None}
+        self.ports = ports
+        self.frames = [queue.Queue(max(connection_pool.queue_length // connection_pool.handlers, 1))
+                       for _ in range(connection_pool.handlers)]
+        self.processes = {}
+        self.stopping = False
+
+    def run(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError("ListenerWorkers needs SO_REUSEPORT, which this platform does not have")
+        for index, frames in enumerate(self.frames):
+            threading.Thread(target=self.dispatch, args=(frames,), name=f'listener-handler-{index}',
+                             daemon=True).start()
+        supervisors = [threading.Thread(target=self.supervise, args=(index,), name=f'listener-worker-{index}',
+                                        daemon=True) for index in range(self.count)]
+        for supervisor in supervisors:
+            supervisor.start()
+        for supervisor in supervisors:
+            supervisor.join()
+
+    def spawn(self, index):
+        ours, theirs = socket.socketpair()
+        command = [sys.executable, '-m', 'arlo.listeners', '--worker', str(index),
+                   '--channel-fd', str(theirs.fileno()), '--ports', ','.join(str(port) for port in self.ports),
+                   '--config', json.dumps(self.config)]
+        try:
+            process = subprocess.Popen(command, pass_fds=(theirs.fileno(),), cwd=ROOT)
+        finally:
+            theirs.close()
+        return process, Connection(ours.detach())
+
+    def supervise(self, index):
+        while not self.stopping:
+            process, channel = self.spawn(index)
+            self.processes[index] = process
+            listener_log.info("Listener worker %d started, pid %d", index, process.pid)
+            frames = 0
+            try:
+                while True:
+                    ip, _, raw = channel.recv_bytes().decode('utf-8').partition(' ')
+                    frames += 1
+                    metrics.increment('listener_frames', worker=str(index))
+                    self.frames[hash(ip) % len(self.frames)].put((ip, LazyMessage(raw)))
+            except (EOFError, OSError):
+                pass
+            channel.close()
+            code = process.wait()
+            if self.stopping:
+                break
+            metrics.increment('listener_worker_restarts')
+            listener_log.error("Listener worker %d exited with %s after %d frame(s), restarting", index, code, frames)
+            time.sleep(WORKER_RESTART_DELAY)
+
+    def dispatch(self, frames):
+        while True:
+            ip, msg = frames.get()
+            try:
+                self.handle(ip, msg)
+            except Exception as e:
+                frame_log.exception("Handling the frame failed: %s", e, ip=ip, msg_id=msg['ID'])
+            finally:
+                frames.task_done()
+
+    def stop(self, timeout=WORKER_STOP_TIMEOUT):
+        """Stop the workers, each handles the connections it accepted first, then wait for their
+        frames to be handled here. False when `timeout` ran out first."""
+        deadline = time.monotonic() + timeout
+        self.stopping = True
+        processes = list(self.processes.values())
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                process.kill()
+        while any(frames.unfinished_tasks for frames in self.frames):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+def run_worker(index, channel, ports):
+    """Entry point of a worker process"""
+    lock = threading.Lock()
+
+    def forward(ip, msg):
+        with lock:
+            channel.send_bytes(f"{ip} {msg.raw}".encode('utf-8'))
+
+    def watch_parent():
+        # Nothing is ever sent to the worker, the channel only closes when the main process is gone
+        try:
+            channel.recv_bytes()
+        except (EOFError, OSError):
+            pass
+        os._exit(0)
+
+    threading.Thread(target=watch_parent, name='parent-watch', daemon=True).start()
+    server = ServerThread(forward, ports, reuse_port=True)
+    # The main process stops a worker with SIGTERM, the connections it accepted are handled first
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop_event.set())
+    # Ctrl+C reaches the whole process group, the main process stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    listener_log.info("Listener worker %d accepting on %s", index, ', '.join(str(port) for port in ports))
+    server.run()
+    if not connection_pool.drain(WORKER_STOP_TIMEOUT - 1):
+        listener_log.warning("Listener worker %d stopped with connections still open", index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Listener worker process, started by ListenerWorkers")
+    parser.add_argument('--worker', type=int, required=True)
+    parser.add_argument('--channel-fd', type=int, required=True)
+    parser.add_argument('--ports', default=','.join(str(port) for port in LISTEN_PORTS))
+    parser.add_argument('--config', default='{}', help='JSON object with the logging and ConnectionPool settings')
+    args = parser.parse_args()
+    config = json.loads(args.config)
+    configure_logging(config)
+    connection_pool.configure(config)
+    run_worker(args.worker, Connection(args.channel_fd), [int(port) for port in args.ports.split(',')])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import json
+import re
 
 
 class Message:
@@ -14,6 +15,10 @@ class Message:
     def __contains__(self, item):
         return item in self.dictionary
 
+    def peek(self, key):
+        """Value of `key` or None"""
+        return self.dictionary.get(key)
+
     def toNetworkMessage(self):
         msgJson = json.dumps(self.dictionary, separators=(',', ':'))
         length = len(msgJson)
@@ -37,6 +42,77 @@ class Message:
             return None
 
 
+_HEADER_FIELD = re.compile(r'"(Type|ID|SystemSerialNumber|AlertType)"\s*:\s*(?:"([^"\\]*)"|(-?\d+))')
+
+# Header fields, besides Type and ID, needed to dispatch a frame without decoding its body
+_DISPATCH_FIELD = {
+    'alert': 'AlertType',
+    'registration': 'SystemSerialNumber',
+    'status': 'SystemSerialNumber',
+}
+
+
+class LazyMessage(Message):
+    """Inbound frame that only decodes the full JSON body when a non-header field is accessed.
+
+    Type, ID, SystemSerialNumber and AlertType are picked out of the raw text up front so a
+    frame can be acked and dispatched without paying for json.loads on large status payloads.
+    """
+
+    def __init__(self, json_data):
+        self.raw = json_data
+        self._dictionary = None
+        self.header = {}
+        for match in _HEADER_FIELD.finditer(json_data):
+            key = match.group(1)
+            if key in self.header:
+                continue
+            # Only top level keys count, e.g. AudioStream carries a nested ID
+            prefix = json_data[:match.start()]
+            if prefix.count('{') != 1 or '}' in prefix:
+                continue
+            value = match.group(2)
+            self.header[key] = value if value is not None else int(match.group(3))
+            if 'ID' in self.header and 'Type' in self.header \
+                    and _DISPATCH_FIELD.get(self.header['Type'], 'ID') in self.header:
+                break
+
+    @property
+    def dictionary(self):
+        if self._dictionary is None:
+            self._dictionary = json.loads(self.raw)
+        return self._dictionary
+
+    @dictionary.setter
+    def dictionary(self, value):
+        self._dictionary = value
+
+    @property
+    def materialized(self):
+        return self._dictionary is not None
+
+    def __getitem__(self, key):
+        if self._dictionary is None and key in self.header:
+            return self.header[key]
+        return self.dictionary[key]
+
+    def __contains__(self, item):
+        if self._dictionary is None and item in self.header:
+            return True
+        return item in self.dictionary
+
+    def peek(self, key):
+        """Value of `key` if it is already known, never triggers the full parse"""
+        if self._dictionary is None:
+            return self.header.get(key)
+        return self._dictionary.get(key)
+
+    def toJSON(self):
+        if self._dictionary is None:
+            return self.raw
+        return super().toJSON()
+
+
 # ID is an incrementing number
 # FROM CAMERA
 REGISTRATION = {
@@ -0,0 +1,115 @@
+import sqlite3
+import time
+
+from helpers.log import get_logger
+
+migration_log = get_logger('migrate')
+
+
+def _legacy_and_devices(c):
+    # Databases from before the rename have a 'camera' table
+    tables = c.execute("SELECT tbl_name FROM sqlite_master WHERE type='table' AND tbl_name='camera'").fetchall()
+    if tables != []:
+        c.execute('DROP INDEX IF EXISTS idx_device_serialnumber')
+        c.execute('DROP INDEX IF EXISTS idx_device_ip')
+        c.execute('DROP INDEX IF EXISTS idx_device_friendlyname')
+        c.execute('DROP INDEX IF EXISTS idx_device_hostname')
+        c.execute('ALTER TABLE camera RENAME TO devices')
+
+    c.execute("CREATE TABLE IF NOT EXISTS devices (ip text, serialnumber text, hostname text, status text, register_set text, friendlyname text, registered integer DEFAULT 0, last_seen text)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_serialnumber ON devices (serialnumber)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_ip ON devices (ip)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_friendlyname ON devices (friendlyname)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_hostname ON devices (hostname)")
+
+    # Add 'registered' and 'last_seen' columns if they don't exist
+    columns = [col[1] for col in c.execute("PRAGMA table_info(devices)").fetchall()]
+    if 'registered' not in columns:
+        c.execute("ALTER TABLE devices ADD COLUMN registered integer DEFAULT 0")
+    if 'last_seen' not in columns:
+        c.execute("ALTER TABLE devices ADD COLUMN last_seen text")
+
+
+def _telemetry(c):
+    c.execute("CREATE TABLE IF NOT EXISTS telemetry_segments (serialnumber text, field text, tier text, start_time real, end_time real, data blob, PRIMARY KEY (serialnumber, field, tier, start_time))")
+
+
+def _applied_config(c):
+    c.execute("CREATE TABLE IF NOT EXISTS applied_config (serialnumber text, step text, fingerprint text, applied_at real, PRIMARY KEY (serialnumber, step))")
+
+
+def _message_ids(c):
+    c.execute("CREATE TABLE IF NOT EXISTS message_ids (serialnumber text PRIMARY KEY, next_id integer)")
+
+
+def _boot_generation(c):
+    # devices.registered now holds the boot generation the device last registered in,
+    # so nothing has to be reset on startup. Boot 1 is never current, old flags read as
+    # not registered.
+    c.execute("CREATE TABLE IF NOT EXISTS server_state (key text PRIMARY KEY, value integer)")
+    c.execute("INSERT OR IGNORE INTO server_state VALUES ('boot', 1)")
+
+
+def _activity_zones(c):
+    c.execute("CREATE TABLE IF NOT EXISTS activity_zones (serialnumber text PRIMARY KEY, zones text, updated_at real)")
+    c.execute("CREATE TABLE IF NOT EXISTS zone_stats (serialnumber text PRIMARY KEY, since real, last_alert real, alerts integer, zone_hits text, data blob)")
+
+
+def _events(c):
+    # id is the rowid, so both indexes also order events within the same time
+    c.execute("CREATE TABLE IF NOT EXISTS events (id integer PRIMARY KEY, serialnumber text, type text, time real, data text)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_events_serial_time ON events (serialnumber, time)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_events_type_time ON events (type, time)")
+
+
+def _telemetry_buckets(c):
+    # The open 1m and 1h buckets, so a restart does not drop up to an hour of the 1h tier
+    c.execute("CREATE TABLE IF NOT EXISTS telemetry_buckets (serialnumber text, field text, tier text, start_time real, total real, count integer, minimum real, maximum real, PRIMARY KEY (serialnumber, field, tier))")
+
+
+# (version, description, step), applied in order to databases whose user_version is lower.
+# Append new steps at the end, never change or reorder released ones.
+MIGRATIONS = [
+    (1, "devices table", _legacy_and_devices),
+    (2, "telemetry segments", _telemetry),
+    (3, "applied config fingerprints", _applied_config),
+    (4, "persistent message IDs", _message_ids),
+    (5, "boot generation", _boot_generation),
+    (6, "activity zones and zone statistics", _activity_zones),
+    (7, "event history", _events),
+    (8, "open telemetry buckets", _telemetry_buckets),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(db_path):
+    """Bring the schema up to date and start a new boot generation, which is returned"""
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        c = conn.cursor()
+        # Write-ahead logging, kept by the database file: readers (the API, tools, another process
+        # with the same database) no longer wait for a write to finish, nor writers for readers
+        c.execute("PRAGMA journal_mode=WAL")
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for step_version, description, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            # Every step commits on its own, an interrupted upgrade resumes where it stopped
+            c.execute("BEGIN")
+            try:
+                step(c)
+                c.execute(f"PRAGMA user_version = {step_version:d}")
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                raise
+            migration_log.info("Applied schema migration %d: %s", step_version, description)
+
+        c.execute("UPDATE server_state SET value = value + 1 WHERE key = 'boot'")
+        boot = c.execute("SELECT value FROM server_state WHERE key = 'boot'").fetchone()[0]
+    finally:
+        conn.close()
+    migration_log.info("Schema version %d, boot %d (%.1f ms)", SCHEMA_VERSION, boot, (time.perf_counter() - started) * 1000)
+    return boot
@@ -0,0 +1,118 @@
+import threading
+import types
+from collections import namedtuple
+
+import arlo.messages
+from arlo.camera import Camera
+from arlo.audio_doorbell import AudioDoorbell
+from arlo.video_doorbell import VideoDoorbell
+
+
+class ModelProfile(namedtuple('ModelProfile', ['name', 'device_class', 'port', 'initial_register_sets',
+                                               'arm_on_register', 'default_quality', 'quality', 'rtsp_port'],
+                              defaults=(554,))):
+    """What differs between device models, resolved once per model number.
+
+    `initial_register_sets` are (template, port) pairs, `quality` maps a quality name to its
+    (raParams, registerSet) templates. `rtsp_port` serves /live, None for models without video. Templates are shared, they are copied into a new
+    Message before being changed or sent.
+    """
+    __slots__ = ()
+
+
+def _quality_table(table):
+    return types.MappingProxyType(table)
+
+
+CAMERA_QUALITY = _quality_table({
+    'low': (arlo.messages.RA_PARAMS_LOW_QUALITY, arlo.messages.REGISTER_SET_LOW_QUALITY),
+    'medium': (arlo.messages.RA_PARAMS_MEDIUM_QUALITY, arlo.messages.REGISTER_SET_MEDIUM_QUALITY),
+    'high': (arlo.messages.RA_PARAMS_HIGH_QUALITY, arlo.messages.REGISTER_SET_HIGH_QUALITY),
+    'subscription': (arlo.messages.RA_PARAMS_SUBSCRIPTION_QUALITY, arlo.messages.REGISTER_SET_SUBSCRIPTION_QUALITY),
+    'insane': (arlo.messages.RA_PARAMS_INSANE_QUALITY, arlo.messages.REGISTER_SET_INSANE_QUALITY),
+})
+
+FLOODLIGHT_QUALITY = _quality_table({
+    'low': (arlo.messages.RA_PARAMS_FLOODLIGHT, arlo.messages.REGISTER_SET_LOW_QUALITY_FLOODLIGHT),
+    'medium': (arlo.messages.RA_PARAMS_FLOODLIGHT, arlo.messages.REGISTER_SET_MEDIUM_QUALITY_FLOODLIGHT),
+    'high': (arlo.messages.RA_PARAMS_FLOODLIGHT, arlo.messages.REGISTER_SET_HIGH_QUALITY_FLOODLIGHT),
+    'subscription': (arlo.messages.RA_PARAMS_FLOODLIGHT, arlo.messages.REGISTER_SET_HIGH_QUALITY_FLOODLIGHT),
+    'insane': (arlo.messages.RA_PARAMS_FLOODLIGHT, arlo.messages.REGISTER_SET_HIGH_QUALITY_FLOODLIGHT),
+})
+
+VIDEO_DOORBELL_QUALITY = _quality_table({
+    '720sq': (arlo.messages.RA_PARAMS_VID_DOORBELL, arlo.messages.REGISTER_SET_720SQ),
+    '1080sq': (arlo.messages.RA_PARAMS_VID_DOORBELL, arlo.messages.REGISTER_SET_1080SQ),
+    '1536sq': (arlo.messages.RA_PARAMS_VID_DOORBELL, arlo.messages.REGISTER_SET_1536SQ),
+})
+
+CAMERA = ModelProfile('camera', Camera, 4000, ((arlo.messages.REGISTER_SET_INITIAL_SUBSCRIPTION, None),),
+                      True, 'insane', CAMERA_QUALITY)
+ULTRA = CAMERA._replace(name='ultra', initial_register_sets=((arlo.messages.REGISTER_SET_INITIAL_ULTRA, None),),
+                        arm_on_register=False, rtsp_port=555)
+FLOODLIGHT = CAMERA._replace(name='floodlight', initial_register_sets=((arlo.messages.REGISTER_SET_INITIAL_FLOODLIGHT, None),),
+                             arm_on_register=False, quality=FLOODLIGHT_QUALITY)
+VIDEO_DOORBELL = ModelProfile('video_doorbell', VideoDoorbell, 4000,
+                              ((arlo.messages.REGISTER_SET_INITIAL_VID_DOORBELL, 4100),
+                               (arlo.messages.REGISTER_SET_INITIAL_2_VID_DOORBELL, None)),
+                              False, '1536sq', VIDEO_DOORBELL_QUALITY)
+AUDIO_DOORBELL = ModelProfile('audio_doorbell', AudioDoorbell, 4100,
+                              ((arlo.messages.AUDIO_DOORBELL_INITIAL_REGISTER_SET, None),
+                               (arlo.messages.AUDIO_DOORBELL_SECOND_REGISTER_SET, None)),
+                              False, None, _quality_table({}), None)
+
+# Model number prefix -> profile, the longest matching prefix wins. Support for a new
+# model is added here or with register_model().
+MODEL_TABLE = {
+    'VMC': CAMERA,
+    'VML': CAMERA,
+    'ABC': CAMERA,
+    'FB': CAMERA,
+    'VMC5040': ULTRA,
+    'FB1001': FLOODLIGHT,
+    'AVD': VIDEO_DOORBELL,
+    'AAD': AUDIO_DOORBELL,
+}
+
+
+class ModelRegistry:
+    def __init__(self, table):
+        self.lock = threading.Lock()
+        self.table = dict(table)
+        self.prefixes = ()
+        self.resolved = {}
+        self.rebuild()
+
+    def rebuild(self):
+        self.prefixes = tuple(sorted(self.table, key=len, reverse=True))
+        self.resolved = {}
+
+    def register(self, prefix, profile):
+        with self.lock:
+            self.table[prefix] = profile
+            self.rebuild()
+
+    def resolve(self, model_number):
+        """Profile for a model number or None, the prefix scan only runs once per model"""
+        try:
+            return self.resolved[model_number]
+        except KeyError:
+            pass
+        profile = None
+        for prefix in self.prefixes:
+            if model_number.startswith(prefix):
+                profile = self.table[prefix]
+                break
+        self.resolved[model_number] = profile
+        return profile
+
+
+model_registry = ModelRegistry(MODEL_TABLE)
+
+
+def register_model(prefix, profile):
+    model_registry.register(prefix, profile)
+
+
+def resolve_model(model_number):
+    return model_registry.resolve(model_number)
@@ -0,0 +1,121 @@
+import queue
+import threading
+import time
+from datetime import datetime
+
+from helpers.log import get_logger
+from helpers.timer_heap import TimerHeap
+
+presence_log = get_logger('presence')
+
+DEFAULT_TIMEOUT = 3600
+
+
+class DevicePresence:
+    def __init__(self, serial, ip):
+        self.serial = serial
+        self.ip = ip
+        self.online = False
+        self.last_seen = None
+
+    def to_dict(self):
+        return {
+            "online": self.online,
+            "last_seen": datetime.fromtimestamp(self.last_seen).isoformat() if self.last_seen else None,
+        }
+
+
+class PresenceTracker:
+    """Tracks when each device was last heard from and marks it offline after a timeout.
+
+    Every inbound frame and every acked outbound message bumps last_seen. Only one expiry
+    timer exists per device: when it fires early because the device was seen in the
+    meantime, it is re-armed for the remainder instead of being rescheduled on every frame.
+    Listeners are called with (presence, online) on each transition from a dedicated
+    thread so slow webhooks never delay expiry.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.serials_by_ip = {}
+        self.timeout = DEFAULT_TIMEOUT
+        self.timers = TimerHeap('presence')
+        self.listeners = []
+        self.events = queue.SimpleQueue()
+        self.dispatcher = threading.Thread(target=self.dispatch, name='presence-events', daemon=True)
+
+    def configure(self, config):
+        self.timeout = config.get('PresenceTimeout', DEFAULT_TIMEOUT)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        self.timers.start()
+        self.dispatcher.start()
+
+    def touch(self, serial=None, ip=None):
+        """Record activity, the serial is looked up from the ip when not known"""
+        now = time.time()
+        with self.lock:
+            if serial is None:
+                serial = self.serials_by_ip.get(ip)
+                if serial is None:
+                    return
+            presence = self.devices.get(serial)
+            if presence is None:
+                presence = self.devices[serial] = DevicePresence(serial, ip)
+            if ip is not None and presence.ip != ip:
+                self.serials_by_ip.pop(presence.ip, None)
+                presence.ip = ip
+            if ip is not None:
+                self.serials_by_ip[ip] = serial
+            presence.last_seen = now
+            came_online = not presence.online
+            presence.online = True
+        if came_online:
+            self.timers.schedule(serial, self.timeout, self.expire)
+            self.events.put((presence, True))
+
+    def expire(self, serial):
+        with self.lock:
+            presence = self.devices.get(serial)
+            if presence is None or not presence.online:
+                return
+            remaining = presence.last_seen + self.timeout - time.time()
+            if remaining <= 0:
+                presence.online = False
+        if remaining > 0:
+            self.timers.schedule(serial, remaining, self.expire)
+        else:
+            self.events.put((presence, False))
+
+    def stop(self, timeout):
+        """Stop expiring devices and deliver the transitions already queued, within `timeout` seconds"""
+        self.timers.stop()
+        self.events.put(None)
+        if self.dispatcher.is_alive():
+            self.dispatcher.join(timeout)
+        return not self.dispatcher.is_alive()
+
+    def dispatch(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            presence, online = event
+            presence_log.info("Device is %s", "online" if online else "offline", ip=presence.ip, serial=presence.serial)
+            for listener in self.listeners:
+                try:
+                    listener(presence, online)
+                except Exception as e:
+                    presence_log.exception("Presence listener failed: %s", e, serial=presence.serial)
+
+    def get(self, serial):
+        with self.lock:
+            presence = self.devices.get(serial)
+            return presence.to_dict() if presence is not None else None
+
+
+presence_tracker = PresenceTracker()
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+registration_log = get_logger('register')
+
+DEFAULT_MAX_CONCURRENT = 4
+
+
+class RegistrationQueue:
+    """Admission queue for the initial configuration pushed to a device after it registers.
+
+    At most `max_concurrent` devices are configured at once, the rest wait in arrival
+    order. A device that registers again while still waiting keeps its place in the
+    queue, only the work to run is replaced.
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT):
+        self.max_concurrent = max_concurrent
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()
+        self.active = set()
+        self.stopped = False
+        self.workers = []
+
+    def configure(self, config):
+        self.max_concurrent = max(int(config.get('RegistrationMaxConcurrent', DEFAULT_MAX_CONCURRENT)), 1)
+
+    def start(self):
+        for i in range(self.max_concurrent):
+            worker = threading.Thread(target=self.run, name=f'registration-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, serial, work):
+        """Queue `work()` for `serial`"""
+        with self.condition:
+            if serial in self.pending:
+                enqueued, _ = self.pending[serial]
+                self.pending[serial] = (enqueued, work)
+                metrics.increment('registration_requeued', serial=serial)
+            else:
+                self.pending[serial] = (time.monotonic(), work)
+            metrics.set_gauge('registration_queue_depth', len(self.pending))
+            self.condition.notify()
+
+    def take(self):
+        with self.condition:
+            while not self.stopped:
+                # A device already being configured waits for that to finish first
+                for serial in self.pending:
+                    if serial not in self.active:
+                        enqueued, work = self.pending.pop(serial)
+                        self.active.add(serial)
+                        metrics.set_gauge('registration_queue_depth', len(self.pending))
+                        return serial, enqueued, work
+                self.condition.wait()
+            return None
+
+    def done(self, serial):
+        with self.condition:
+            self.active.discard(serial)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            job = self.take()
+            if job is None:
+                return
+            serial, enqueued, work = job
+            started = time.monotonic()
+            waited = started - enqueued
+            metrics.observe('registration_queue_wait_seconds', waited)
+            registration_log.info("Configuring after %.2fs in queue", waited, serial=serial)
+            try:
+                work()
+            except Exception as e:
+                registration_log.exception("Initial configuration failed: %s", e, serial=serial)
+                metrics.increment('registration_config_failed', serial=serial)
+            finally:
+                self.done(serial)
+            metrics.observe('registration_config_seconds', time.monotonic() - started)
+
+    def depth(self):
+        with self.condition:
+            return len(self.pending)
+
+    def stop(self, timeout=None):
+        """Let the configurations in progress finish, within `timeout` seconds, and drop the
+        waiting ones: those devices are configured when they register again"""
+        with self.condition:
+            self.stopped = True
+            dropped = len(self.pending)
+            self.pending.clear()
+            self.condition.notify_all()
+        if dropped:
+            registration_log.warning("%d queued configuration(s) dropped", dropped)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        return not any(worker.is_alive() for worker in self.workers)
+
+
+registration_queue = RegistrationQueue()
@@ -0,0 +1,115 @@
+import struct
+import time
+
+RTCP_SR = 200
+RTCP_RR = 201
+RTCP_SDES = 202
+SDES_CNAME = 1
+# Seconds between the NTP epoch (1900) and the Unix epoch
+NTP_OFFSET = 2208988800
+MAX_DROPOUT = 3000
+
+
+class ReceiverStats:
+    """Reception statistics of one RTP source as RFC 3550 defines them, enough to fill in a
+    receiver report block: extended highest sequence number, loss, jitter and the last SR."""
+
+    def __init__(self, clock_rate=None):
+        self.clock_rate = clock_rate
+        self.ssrc = None
+        self.base_seq = 0
+        self.max_seq = 0
+        self.cycles = 0
+        self.received = 0
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.fraction_lost = 0
+        self.transit = None
+        self.jitter = 0.0
+        self.last_sr = 0
+        self.last_sr_arrival = None
+        self.senders_reports = 0
+
+    def rtp(self, packet, arrival=None):
+        if len(packet) < 12 or packet[0] >> 6 != 2:
+            return
+        arrival = time.time() if arrival is None else arrival
+        seq, timestamp, ssrc = struct.unpack_from('!HII', packet, 2)
+        if ssrc != self.ssrc:
+            # New or restarted source
+            self.ssrc = ssrc
+            self.base_seq = self.max_seq = seq
+            self.cycles = self.received = self.expected_prior = self.received_prior = 0
+            self.transit = None
+            self.jitter = 0.0
+        else:
+            delta = (seq - self.max_seq) & 0xFFFF
+            if delta < MAX_DROPOUT:
+                if seq < self.max_seq:
+                    self.cycles += 1 << 16
+                self.max_seq = seq
+        self.received += 1
+
+        if self.clock_rate:
+            transit = int(arrival * self.clock_rate) - timestamp
+            if self.transit is not None:
+                difference = abs(transit - self.transit)
+                # A timestamp wrap or jump is not jitter
+                if difference < self.clock_rate * 10:
+                    self.jitter += (difference - self.jitter) / 16
+            self.transit = transit
+
+    def rtcp(self, packet, arrival=None):
+        """Take the NTP timestamp of a sender report from a (compound) RTCP packet"""
+        arrival = time.time() if arrival is None else arrival
+        offset = 0
+        while offset + 4 <= len(packet):
+            packet_type = packet[offset + 1]
+            length = (struct.unpack_from('!H', packet, offset + 2)[0] + 1) * 4
+            if packet_type == RTCP_SR and offset + 16 <= len(packet):
+                ntp_seconds, ntp_fraction = struct.unpack_from('!II', packet, offset + 8)
+                self.last_sr = ((ntp_seconds & 0xFFFF) << 16) | (ntp_fraction >> 16)
+                self.last_sr_arrival = arrival
+                self.senders_reports += 1
+            offset += length
+
+    @property
+    def extended_max(self):
+        return self.cycles + self.max_seq
+
+    @property
+    def lost(self):
+        return self.extended_max - self.base_seq + 1 - self.received if self.ssrc is not None else 0
+
+    def report_block(self, now=None):
+        now = time.time() if now is None else now
+        expected = self.extended_max - self.base_seq + 1
+        expected_interval = expected - self.expected_prior
+        lost_interval = expected_interval - (self.received - self.received_prior)
+        self.expected_prior = expected
+        self.received_prior = self.received
+        self.fraction_lost = (lost_interval << 8) // expected_interval if expected_interval > 0 and lost_interval > 0 else 0
+        lost = max(min(self.lost, 0x7FFFFF), -0x800000)
+        dlsr = int((now - self.last_sr_arrival) * 65536) if self.last_sr_arrival is not None else 0
+        return struct.pack('!IB3sIIII', self.ssrc, self.fraction_lost, lost.to_bytes(3, 'big', signed=True),
+                           self.extended_max & 0xFFFFFFFF, int(self.jitter), self.last_sr, dlsr & 0xFFFFFFFF)
+
+    def to_dict(self):
+        return {
+            "ssrc": self.ssrc,
+            "received": self.received,
+            "lost": self.lost,
+            "fraction_lost": self.fraction_lost / 256,
+            "jitter_ms": self.jitter * 1000 / self.clock_rate if self.clock_rate else None,
+            "sender_reports": self.senders_reports,
+        }
+
+
+def receiver_report(ssrc, blocks, cname):
+    """Compound RTCP packet: a receiver report with `blocks` and an SDES CNAME"""
+    report = struct.pack('!BBHI', 0x80 | len(blocks), RTCP_RR, len(blocks) * 6 + 1, ssrc) + b''.join(blocks)
+    name = cname.encode()[:255]
+    chunk = struct.pack('!IBB', ssrc, SDES_CNAME, len(name)) + name + b'\x00'
+    chunk += b'\x00' * (-len(chunk) % 4)
+    sdes = struct.pack('!BBH', 0x81, RTCP_SDES, len(chunk) // 4) + chunk
+    return report + sdes
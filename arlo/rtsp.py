@@ -0,0 +1,203 @@
+import re
+from urllib.parse import urlsplit
+
+RTSP_VERSION = 'RTSP/1.0'
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    453: 'Not Enough Bandwidth',
+    454: 'Session Not Found',
+    455: 'Method Not Valid in This State',
+    461: 'Unsupported Transport',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+}
+
+_CONTROL = re.compile(r'^a=control:(.*)$')
+
+
+class RtspError(Exception):
+    pass
+
+
+class RtspMessage:
+    """A request (`method`, `url`) or a response (`status`, `reason`) with headers and body"""
+
+    def __init__(self, start_line, headers, body=b''):
+        self.start_line = start_line
+        self.headers = headers
+        self.body = body
+        parts = start_line.split(' ', 2)
+        if parts[0].startswith('RTSP/'):
+            self.method = self.url = None
+            try:
+                self.status = int(parts[1])
+            except (IndexError, ValueError):
+                raise RtspError(f"Malformed status line: {start_line!r}") from None
+            self.reason = parts[2] if len(parts) > 2 else ''
+        else:
+            if len(parts) != 3:
+                raise RtspError(f"Malformed request line: {start_line!r}")
+            self.method, self.url, _ = parts
+            self.status = self.reason = None
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def session(self):
+        """Session id without the ;timeout parameter"""
+        session = self.header('Session')
+        return session.split(';')[0].strip() if session else None
+
+    @property
+    def session_timeout(self):
+        session = self.header('Session') or ''
+        match = re.search(r';\s*timeout=(\d+)', session)
+        return int(match.group(1)) if match else None
+
+
+def format_request(method, url, cseq, headers=None, body=b''):
+    lines = [f"{method} {url} {RTSP_VERSION}", f"CSeq: {cseq}"]
+    return _format(lines, headers, body)
+
+
+def format_response(status, cseq, headers=None, body=b''):
+    lines = [f"{RTSP_VERSION} {status} {REASONS.get(status, 'Unknown')}"]
+    if cseq is not None:
+        lines.append(f"CSeq: {cseq}")
+    return _format(lines, headers, body)
+
+
+def _format(lines, headers, body):
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    if body:
+        lines.append(f"Content-Length: {len(body)}")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+def interleaved_frame(channel, payload):
+    return b'$' + bytes((channel,)) + len(payload).to_bytes(2, 'big') + payload
+
+
+class RtspReader:
+    """Incremental parser for an RTSP connection, which carries both messages and
+    interleaved ($) RTP/RTCP frames. Feed it received bytes, then drain `items()`."""
+
+    MAX_HEADER = 16384
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def items(self):
+        """Yields ('frame', channel, payload) and ('message', RtspMessage) for every complete item"""
+        while self.buffer:
+            if self.buffer[0] == 0x24:
+                if len(self.buffer) < 4:
+                    return
+                length = int.from_bytes(self.buffer[2:4], 'big')
+                if len(self.buffer) < 4 + length:
+                    return
+                channel = self.buffer[1]
+                payload = bytes(self.buffer[4:4 + length])
+                del self.buffer[:4 + length]
+                yield 'frame', channel, payload
+                continue
+
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > self.MAX_HEADER:
+                    raise RtspError("RTSP header too long")
+                return
+            lines = self.buffer[:end].decode('utf-8', 'replace').split('\r\n')
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0) or 0)
+            if len(self.buffer) < end + 4 + length:
+                return
+            body = bytes(self.buffer[end + 4:end + 4 + length])
+            del self.buffer[:end + 4 + length]
+            yield 'message', RtspMessage(lines[0], headers, body)
+
+
+def parse_transport(transport):
+    """First transport spec of a Transport header as (protocol, {parameter: value})"""
+    spec = transport.split(',')[0]
+    parts = [part.strip() for part in spec.split(';')]
+    parameters = {}
+    for part in parts[1:]:
+        name, _, value = part.partition('=')
+        parameters[name.lower()] = value
+    return parts[0].upper(), parameters
+
+
+def port_pair(value):
+    """'5000-5001' or '5000' -> (5000, 5001)"""
+    first, _, second = value.partition('-')
+    return int(first), int(second) if second else int(first) + 1
+
+
+def media_controls(sdp):
+    """Control attribute of every media section of an SDP, in order (None when missing)"""
+    controls = []
+    for line in sdp.splitlines():
+        if line.startswith('m='):
+            controls.append(None)
+        elif controls and controls[-1] is None:
+            match = _CONTROL.match(line)
+            if match:
+                controls[-1] = match.group(1).strip()
+    return controls
+
+
+def media_clock_rates(sdp):
+    """RTP clock rate of the first payload type of every media section, None when not in an rtpmap"""
+    rates = []
+    rtpmaps = {}
+    payload_types = []
+    for line in sdp.splitlines():
+        if line.startswith('m='):
+            fields = line.split()
+            payload_types.append(fields[3] if len(fields) > 3 else None)
+        elif line.startswith('a=rtpmap:') and payload_types:
+            payload_type, _, encoding = line[len('a=rtpmap:'):].partition(' ')
+            rtpmaps[(len(payload_types) - 1, payload_type)] = encoding
+    for index, payload_type in enumerate(payload_types):
+        encoding = rtpmaps.get((index, payload_type), '').split('/')
+        rates.append(int(encoding[1]) if len(encoding) > 1 and encoding[1].isdigit() else None)
+    return rates
+
+
+def control_url(base, control):
+    """Absolute URL for a media control attribute, relative to the Content-Base"""
+    if not control or control == '*':
+        return base.rstrip('/')
+    if urlsplit(control).scheme:
+        return control
+    return base + control if base.endswith('/') else f"{base}/{control}"
+
+
+def rewrite_sdp(sdp):
+    """SDP for relay consumers: media are controlled as trackID=<n>, session level control is dropped"""
+    lines = []
+    track = -1
+    for line in sdp.splitlines():
+        if line.startswith('m='):
+            track += 1
+            lines.append(line)
+            lines.append(f"a=control:trackID={track}")
+        elif line.startswith('a=control:'):
+            continue
+        else:
+            lines.append(line)
+    return '\r\n'.join(lines) + '\r\n'
@@ -0,0 +1,845 @@
+import collections
+import select
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from arlo.device_db import DeviceDB
+from arlo.rtcp import ReceiverStats, receiver_report
+from arlo.rtsp import (RtspError, RtspReader, format_request, format_response, interleaved_frame, parse_transport,
+                       port_pair, media_controls, media_clock_rates, control_url, rewrite_sdp)
+from helpers.log import get_logger
+from helpers.metrics import metrics
+
+relay_log = get_logger('relay')
+
+DEFAULT_PORT = 8554
+DEFAULT_UPSTREAM_TRANSPORT = 'udp'
+DEFAULT_LINGER = 2
+DEFAULT_MAX_CONSUMERS = 8
+DEFAULT_CONSUMER_QUEUE = 512
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_KEEPALIVE_INTERVAL = 30
+DEFAULT_RTCP_INTERVAL = 2
+DEFAULT_CONSUMER_TIMEOUT = 60
+DEFAULT_TEARDOWN_ATTEMPTS = 3
+DEFAULT_PACKET_TIMEOUT = 10
+DEFAULT_STALL_TIMEOUT = 10
+WATCHDOG_INTERVAL = 1
+TEARDOWN_TIMEOUT = 2
+ENDED_HISTORY = 20
+USER_AGENT = 'arlo-cam-api'
+RECV_SIZE = 65536
+PUBLIC_METHODS = 'OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER, SET_PARAMETER'
+CNAME = f"{USER_AGENT}@{socket.gethostname()}"
+
+
+class RelayFull(RtspError):
+    pass
+
+
+def bind_port_pair(host=''):
+    """UDP sockets on an even RTP port and the RTCP port above it"""
+    for _ in range(32):
+        rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtp.bind((host, 0))
+        port = rtp.getsockname()[1]
+        if port % 2 == 0:
+            rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                rtcp.bind((host, port + 1))
+                return rtp, rtcp
+            except OSError:
+                rtcp.close()
+        rtp.close()
+    raise RtspError("No free UDP port pair")
+
+
+class UpstreamSession:
+    """The one RTSP session held to a camera.
+
+    open() runs the OPTIONS/DESCRIBE/SETUP/PLAY handshake and starts a reader thread,
+    which hands every RTP and RTCP packet to `on_packet(track, rtcp, payload)` unchanged.
+    The reader thread also sends the camera an RTCP receiver report per track every
+    `rtcp_interval` seconds, cameras drop a stream whose receiver stays quiet.
+    `on_closed(session, error)` is called when the session fails, but not after close().
+    """
+
+    def __init__(self, serial, url, transport, connect_timeout, on_packet, on_closed,
+                 rtcp_interval=DEFAULT_RTCP_INTERVAL, teardown_attempts=DEFAULT_TEARDOWN_ATTEMPTS):
+        self.serial = serial
+        self.url = url
+        self.host = urlsplit(url).hostname
+        self.transport = transport
+        self.connect_timeout = connect_timeout
+        self.keepalive_interval = DEFAULT_KEEPALIVE_INTERVAL
+        self.rtcp_interval = rtcp_interval
+        self.teardown_attempts = teardown_attempts
+        self.on_packet = on_packet
+        self.on_closed = on_closed
+        self.ssrc = int.from_bytes(uuid.uuid4().bytes[:4], 'big')
+        self.state = 'connecting'
+        self.sock = None
+        self.reader = RtspReader()
+        self.send_lock = threading.Lock()
+        self.cseq = 0
+        self.session_id = None
+        self.base_url = url
+        self.sdp = None
+        self.tracks = []
+        self.receivers = []
+        self.channels = {}
+        self.udp = {}
+        self.packets = 0
+        self.bytes = 0
+        self.started = None
+        self.last_packet = None
+        self.last_keepalive = 0
+        self.last_report = None
+        self.reports_sent = 0
+        self.ended = None
+        self.end_reason = None
+        self.teardown_result = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def send_request(self, method, url, headers=None):
+        self.cseq += 1
+        headers = dict(headers or {})
+        headers['User-Agent'] = USER_AGENT
+        if self.session_id is not None:
+            headers['Session'] = self.session_id
+        with self.send_lock:
+            self.sock.sendall(format_request(method, url, self.cseq, headers))
+        return self.cseq
+
+    def wait_response(self, method, cseq):
+        """Response to request `cseq`, packets arriving meanwhile are delivered"""
+        while True:
+            for item in self.reader.items():
+                if item[0] == 'frame':
+                    self.frame_received(item[1], item[2])
+                elif item[1].header('CSeq') == str(cseq):
+                    return item[1]
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                raise RtspError(f"Connection closed during {method}")
+            self.reader.feed(data)
+
+    def request(self, method, url, headers=None):
+        """Send a request and wait for its successful response"""
+        response = self.wait_response(method, self.send_request(method, url, headers))
+        if response.status != 200:
+            raise RtspError(f"{method} {url}: {response.status} {response.reason}")
+        return response
+
+    def connect(self, timeout):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = socket.create_connection((self.host, urlsplit(self.url).port or 554), timeout=timeout)
+        self.reader = RtspReader()
+
+    def open(self):
+        self.connect(self.connect_timeout)
+        self.request('OPTIONS', self.url)
+        describe = self.request('DESCRIBE', self.url, {'Accept': 'application/sdp'})
+        self.base_url = describe.header('Content-Base') or describe.header('Content-Location') or self.url
+        self.sdp = describe.body.decode('utf-8', 'replace')
+        controls = media_controls(self.sdp)
+        if not controls:
+            raise RtspError("DESCRIBE returned no media")
+        self.receivers = [ReceiverStats(rate) for rate in media_clock_rates(self.sdp)]
+        for track, control in enumerate(controls):
+            self.setup(track, control_url(self.base_url, control))
+        session = self.request('PLAY', control_url(self.base_url, '*'), {'Range': 'npt=0.000-'})
+        timeout = session.session_timeout
+        if timeout:
+            self.keepalive_interval = max(timeout / 2, 1)
+        self.sock.settimeout(None)
+        self.state = 'playing'
+        self.started = self.last_keepalive = self.last_report = time.time()
+        self.thread = threading.Thread(target=self.run, name=f"relay-{self.serial}", daemon=True)
+        self.thread.start()
+
+    def setup(self, track, url):
+        if self.transport == 'tcp':
+            response = self.request('SETUP', url, {'Transport': f"RTP/AVP/TCP;unicast;interleaved={2 * track}-{2 * track + 1}"})
+            _, parameters = parse_transport(response.header('Transport', ''))
+            rtp_channel, rtcp_channel = port_pair(parameters.get('interleaved', f"{2 * track}-{2 * track + 1}"))
+            self.channels[rtp_channel] = (track, False)
+            self.channels[rtcp_channel] = (track, True)
+            self.tracks.append({"url": url, "interleaved": (rtp_channel, rtcp_channel)})
+        else:
+            rtp, rtcp = bind_port_pair()
+            self.udp[rtp] = (track, False)
+            self.udp[rtcp] = (track, True)
+            client_port = rtp.getsockname()[1]
+            response = self.request('SETUP', url, {'Transport': f"RTP/AVP;unicast;client_port={client_port}-{client_port + 1}"})
+            _, parameters = parse_transport(response.header('Transport', ''))
+            server_port = port_pair(parameters['server_port']) if 'server_port' in parameters else None
+            self.tracks.append({"url": url, "client_port": (client_port, client_port + 1), "server_port": server_port,
+                                "rtcp_socket": rtcp})
+        if self.session_id is None:
+            self.session_id = response.session
+
+    def frame_received(self, channel, payload):
+        track = self.channels.get(channel)
+        if track is not None:
+            self.packet_received(track[0], track[1], payload)
+
+    def packet_received(self, track, rtcp, payload):
+        now = time.time()
+        self.packets += 1
+        self.bytes += len(payload)
+        self.last_packet = now
+        if track < len(self.receivers):
+            if rtcp:
+                self.receivers[track].rtcp(payload, now)
+            else:
+                self.receivers[track].rtp(payload, now)
+        self.on_packet(track, rtcp, payload)
+
+    def send_reports(self, now):
+        """One RTCP receiver report per track, over the transport the track's packets use"""
+        for track, receiver in enumerate(self.receivers[:len(self.tracks)]):
+            blocks = [receiver.report_block(now)] if receiver.ssrc is not None else []
+            report = receiver_report(self.ssrc, blocks, CNAME)
+            details = self.tracks[track]
+            if self.transport == 'tcp':
+                with self.send_lock:
+                    self.sock.sendall(interleaved_frame(details['interleaved'][1], report))
+            elif details['server_port'] is not None:
+                details['rtcp_socket'].sendto(report, (self.host, details['server_port'][1]))
+        self.reports_sent += 1
+        self.last_report = now
+
+    def run(self):
+        error = None
+        sockets = [self.sock] + list(self.udp)
+        try:
+            while not self.stop_event.is_set():
+                readable, _, _ = select.select(sockets, [], [], min(self.rtcp_interval, 1))
+                for ready in readable:
+                    if ready is self.sock:
+                        data = self.sock.recv(RECV_SIZE)
+                        if not data:
+                            raise RtspError("Camera closed the RTSP connection")
+                        self.reader.feed(data)
+                        for item in self.reader.items():
+                            # Responses are only keepalives, nothing waits for them
+                            if item[0] == 'frame':
+                                self.frame_received(item[1], item[2])
+                    else:
+                        track, rtcp = self.udp[ready]
+                        self.packet_received(track, rtcp, ready.recv(RECV_SIZE))
+                now = time.time()
+                if self.rtcp_interval and now - self.last_report >= self.rtcp_interval:
+                    self.send_reports(now)
+                if now - self.last_keepalive >= self.keepalive_interval:
+                    self.last_keepalive = now
+                    self.send_request('OPTIONS', self.url)
+        except (OSError, ValueError, RtspError) as e:
+            error = e
+        if not self.stop_event.is_set():
+            self.state = 'failed'
+            self.on_closed(self, error)
+
+    def close(self, reason='closed', deadline=None):
+        """Stop the reader, TEARDOWN and release the sockets, no on_closed() callback follows.
+        With a `deadline` (time.monotonic()) nothing waits past it."""
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(2 if deadline is None else min(max(deadline - time.monotonic(), 0), 2))
+        if self.session_id is not None:
+            self.teardown(deadline)
+        self.state = 'closed'
+        self.end_reason = reason
+        self.ended = time.time()
+        self.release()
+
+    def teardown(self, deadline=None):
+        """TEARDOWN until the camera answers, over a new connection when the session's own
+        one is gone, so a camera is never left streaming to nobody. Given up on at `deadline`."""
+        url = control_url(self.base_url, '*')
+        error = None
+        attempts = 0
+        for attempt in range(self.teardown_attempts):
+            timeout = TEARDOWN_TIMEOUT
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    error = RtspError("shutdown timeout reached")
+                    break
+            attempts += 1
+            try:
+                if attempt > 0:
+                    self.connect(timeout)
+                self.sock.settimeout(timeout)
+                response = self.wait_response('TEARDOWN', self.send_request('TEARDOWN', url))
+                # Any answer will do, 454 means the camera already dropped the session
+                self.teardown_result = f"{response.status} {response.reason}"
+                metrics.increment('relay_teardowns', outcome='answered')
+                return True
+            except (OSError, RtspError) as e:
+                error = e
+        self.teardown_result = f"failed: {error}"
+        metrics.increment('relay_teardowns', outcome='failed')
+        relay_log.warning("TEARDOWN to %s failed after %d attempt(s): %s", self.url, attempts, error,
+                          serial=self.serial)
+        return False
+
+    def release(self):
+        for sock in [self.sock] + list(self.udp):
+            if sock is not None:
+                sock.close()
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "transport": self.transport,
+            "state": self.state,
+            "session": self.session_id,
+            "tracks": len(self.tracks),
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "started": self.started,
+            "last_packet": self.last_packet,
+        }
+
+    def health(self, now):
+        silent = now - (self.last_packet or self.started or now)
+        return dict(self.to_dict(),
+                    serial=self.serial,
+                    seconds_since_packet=silent,
+                    rtcp={"reports_sent": self.reports_sent, "last_report": self.last_report,
+                          "interval": self.rtcp_interval},
+                    receivers=[receiver.to_dict() for receiver in self.receivers],
+                    ended=self.ended,
+                    end_reason=self.end_reason,
+                    teardown=self.teardown_result)
+
+
+class RelayStream:
+    """Consumers of one camera sharing its upstream session.
+
+    The upstream session is opened for the first consumer and torn down `linger` seconds
+    after the last one left.
+    """
+
+    def __init__(self, relay, serial, url):
+        self.relay = relay
+        self.serial = serial
+        self.url = url
+        self.lock = threading.Lock()
+        self.consumers = set()
+        self.targets = ()
+        self.upstream = None
+        self.ready = threading.Event()
+        self.error = None
+        self.linger_timer = None
+
+    def join(self, consumer):
+        """Add a consumer and return the SDP, the upstream session is opened if needed"""
+        with self.lock:
+            if consumer not in self.consumers and len(self.consumers) >= self.relay.max_consumers:
+                metrics.increment('relay_consumers_rejected')
+                raise RelayFull(f"More than {self.relay.max_consumers} consumers")
+            self.consumers.add(consumer)
+            if self.linger_timer is not None:
+                self.linger_timer.cancel()
+                self.linger_timer = None
+            upstream = None
+            if self.upstream is None:
+                upstream = self.upstream = UpstreamSession(self.serial, self.url, self.relay.upstream_transport,
+                                                           self.relay.connect_timeout, self.packet, self.upstream_failed,
+                                                           self.relay.rtcp_interval, self.relay.teardown_attempts)
+                self.error = None
+                self.ready.clear()
+        self.relay.update_gauges()
+
+        if upstream is not None:
+            self.open(upstream)
+        self.ready.wait(self.relay.connect_timeout * 2)
+        with self.lock:
+            current = self.upstream
+        if current is None or current.sdp is None or current.state != 'playing':
+            self.leave(consumer)
+            raise RtspError(f"Upstream unavailable: {self.error}")
+        return current.sdp
+
+    def open(self, upstream):
+        try:
+            upstream.open()
+            metrics.increment('relay_upstream_sessions', outcome='opened')
+            relay_log.info("Upstream session to %s opened (%s, %d track(s))", upstream.url, upstream.transport,
+                           len(upstream.tracks), serial=self.serial)
+        except (OSError, RtspError) as e:
+            metrics.increment('relay_upstream_sessions', outcome='failed')
+            relay_log.warning("Upstream session to %s failed: %s", upstream.url, e, serial=self.serial)
+            upstream.release()
+            with self.lock:
+                self.error = e
+                if self.upstream is upstream:
+                    self.upstream = None
+        finally:
+            self.ready.set()
+
+    def leave(self, consumer):
+        with self.lock:
+            if consumer not in self.consumers:
+                return
+            self.consumers.discard(consumer)
+            self.targets = tuple(c for c in self.targets if c is not consumer)
+            if not self.consumers and self.upstream is not None and self.linger_timer is None:
+                if self.relay.linger > 0:
+                    self.linger_timer = threading.Timer(self.relay.linger, self.close_idle)
+                    self.linger_timer.daemon = True
+                    self.linger_timer.start()
+                else:
+                    threading.Thread(target=self.close_idle, daemon=True).start()
+        self.relay.update_gauges()
+
+    def play(self, consumer):
+        with self.lock:
+            if consumer in self.consumers and consumer not in self.targets:
+                self.targets = self.targets + (consumer,)
+
+    def close_idle(self, deadline=None):
+        with self.lock:
+            self.linger_timer = None
+            if self.consumers or self.upstream is None:
+                return
+            upstream, self.upstream = self.upstream, None
+        upstream.close('no consumers', deadline)
+        self.relay.session_ended(upstream)
+        metrics.increment('relay_upstream_sessions', outcome='closed')
+        relay_log.info("Upstream session to %s torn down after %d packets, no consumers left (%s)", upstream.url,
+                       upstream.packets, upstream.teardown_result, serial=self.serial)
+
+    def packet(self, track, rtcp, payload):
+        for consumer in self.targets:
+            consumer.deliver(track, rtcp, payload)
+
+    def upstream_failed(self, upstream, error):
+        """Drop the consumers of a failed or silent upstream session, then tear it down"""
+        with self.lock:
+            if self.upstream is not upstream:
+                return
+            self.upstream = None
+            consumers = list(self.consumers)
+        metrics.increment('relay_upstream_sessions', outcome='lost')
+        relay_log.warning("Upstream session lost: %s, closing %d consumer(s)", error or "connection closed",
+                          len(consumers), serial=self.serial)
+        for consumer in consumers:
+            consumer.close()
+        upstream.close(str(error or "connection closed"))
+        self.relay.session_ended(upstream)
+
+    def to_dict(self):
+        with self.lock:
+            upstream = self.upstream
+            consumers = list(self.consumers)
+        return {
+            "serial": self.serial,
+            "path": f"/{self.serial}",
+            "upstream": upstream.to_dict() if upstream is not None else None,
+            "consumers": [consumer.to_dict() for consumer in consumers],
+        }
+
+    def health(self, now):
+        with self.lock:
+            upstream = self.upstream
+            consumers = list(self.consumers)
+        return {
+            "serial": self.serial,
+            "upstream": upstream.health(now) if upstream is not None else None,
+            "consumers": [dict(consumer.to_dict(), seconds_since_activity=now - consumer.last_activity,
+                               seconds_stalled=now - consumer.full_since if consumer.full_since else 0)
+                          for consumer in consumers],
+        }
+
+
+class RelayClient(threading.Thread):
+    """One consumer connection to the relay. Only RTP over the RTSP connection (interleaved TCP) is offered."""
+
+    def __init__(self, relay, sock, address):
+        threading.Thread.__init__(self, name=f"relay-client-{address[0]}:{address[1]}", daemon=True)
+        self.relay = relay
+        self.sock = sock
+        self.address = address
+        self.reader = RtspReader()
+        self.send_lock = threading.Lock()
+        self.queue = collections.deque()
+        self.queue_ready = threading.Condition()
+        self.session_id = uuid.uuid4().hex[:16]
+        self.stream = None
+        self.channels = {}
+        self.playing = False
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.connected = self.last_activity = time.time()
+        self.full_since = None
+        self.writer = threading.Thread(target=self.write, name=f"{self.name}-writer", daemon=True)
+
+    ### PACKETS ###
+
+    def deliver(self, track, rtcp, payload):
+        channel = self.channels.get(track)
+        if channel is None:
+            return
+        with self.queue_ready:
+            if len(self.queue) >= self.relay.consumer_queue:
+                # A slow consumer loses packets, it never holds up the others
+                self.dropped += 1
+                if self.full_since is None:
+                    self.full_since = time.time()
+                return
+            self.queue.append(interleaved_frame(channel + 1 if rtcp else channel, payload))
+            self.queue_ready.notify()
+
+    def write(self):
+        while True:
+            with self.queue_ready:
+                while not self.queue and not self.closed:
+                    self.queue_ready.wait()
+                if self.closed:
+                    return
+                frames = b''.join(self.queue)
+                count = len(self.queue)
+                self.queue.clear()
+                self.full_since = None
+            try:
+                with self.send_lock:
+                    self.sock.sendall(frames)
+                self.sent += count
+            except OSError:
+                self.close()
+                return
+
+    ### RTSP ###
+
+    def run(self):
+        self.writer.start()
+        try:
+            while not self.closed:
+                data = self.sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                self.last_activity = time.time()
+                self.reader.feed(data)
+                for item in self.reader.items():
+                    # Interleaved frames from a consumer are its RTCP reports, the camera never sees them
+                    if item[0] == 'message':
+                        self.handle(item[1])
+        except (OSError, RtspError) as e:
+            if not self.closed:
+                relay_log.debug("Consumer %s:%d failed: %s", self.address[0], self.address[1], e)
+        finally:
+            self.close()
+
+    def respond(self, request, status, headers=None, body=b''):
+        headers = dict(headers or {})
+        if self.stream is not None and request.method not in ('OPTIONS', 'DESCRIBE'):
+            headers['Session'] = f"{self.session_id};timeout={int(self.relay.consumer_timeout)}"
+        with self.send_lock:
+            self.sock.sendall(format_response(status, request.header('CSeq'), headers, body))
+
+    def handle(self, request):
+        if request.status is not None:
+            return
+        session = request.session
+        if session is not None and self.stream is not None and session != self.session_id:
+            return self.respond(request, 454)
+        handler = getattr(self, f"handle_{request.method.lower()}", None)
+        if handler is None:
+            return self.respond(request, 501)
+        handler(request)
+
+    def path(self, request):
+        """(serial, track or None) from the request URL"""
+        segments = [segment for segment in urlsplit(request.url).path.split('/') if segment]
+        if not segments:
+            return None, None
+        track = None
+        if len(segments) > 1 and segments[-1].startswith('trackID='):
+            try:
+                track = int(segments[-1][len('trackID='):])
+            except ValueError:
+                pass
+            segments = segments[:-1]
+        return segments[0], track
+
+    def handle_options(self, request):
+        self.respond(request, 200, {'Public': PUBLIC_METHODS})
+
+    def handle_get_parameter(self, request):
+        self.respond(request, 200)
+
+    handle_set_parameter = handle_get_parameter
+
+    def attach(self, serial):
+        if self.stream is not None:
+            return self.stream.serial == serial
+        stream = self.relay.stream(serial)
+        if stream is None:
+            return False
+        self.stream = stream
+        return True
+
+    def handle_describe(self, request):
+        serial, _ = self.path(request)
+        if serial is None or not self.attach(serial):
+            return self.respond(request, 404)
+        try:
+            sdp = self.stream.join(self)
+        except RtspError as e:
+            relay_log.warning("DESCRIBE from %s: %s", self.address[0], e, serial=serial)
+            return self.respond(request, 453 if isinstance(e, RelayFull) else 503)
+        base = request.url.rstrip('/') + '/'
+        self.respond(request, 200, {'Content-Type': 'application/sdp', 'Content-Base': base},
+                     rewrite_sdp(sdp).encode())
+
+    def handle_setup(self, request):
+        serial, track = self.path(request)
+        if serial is None or not self.attach(serial):
+            return self.respond(request, 404)
+        protocol, parameters = parse_transport(request.header('Transport', ''))
+        if protocol != 'RTP/AVP/TCP':
+            # Clients such as FFmpeg fall back to TCP when UDP is refused
+            return self.respond(request, 461)
+        try:
+            sdp = self.stream.join(self)
+        except RtspError as e:
+            return self.respond(request, 453 if isinstance(e, RelayFull) else 503)
+        track = track if track is not None else 0
+        if track >= len(media_controls(sdp)):
+            return self.respond(request, 404)
+        rtp_channel, rtcp_channel = port_pair(parameters.get('interleaved', f"{2 * track}-{2 * track + 1}"))
+        self.channels[track] = rtp_channel
+        self.respond(request, 200, {'Transport': f"RTP/AVP/TCP;unicast;interleaved={rtp_channel}-{rtcp_channel}"})
+
+    def handle_play(self, request):
+        if self.stream is None or not self.channels:
+            return self.respond(request, 455)
+        self.playing = True
+        self.stream.play(self)
+        self.respond(request, 200, {'Range': 'npt=0.000-'})
+        relay_log.info("Consumer %s:%d playing %d track(s)", self.address[0], self.address[1], len(self.channels),
+                       serial=self.stream.serial)
+
+    def handle_teardown(self, request):
+        self.respond(request, 200)
+        self.close()
+
+    def expired(self, now):
+        """Why the watchdog should drop this consumer, None while it is healthy"""
+        if now - self.last_activity > self.relay.consumer_timeout:
+            # No RTSP keepalive and no RTCP report, the consumer died without a TEARDOWN
+            return 'inactive'
+        if self.full_since is not None and now - self.full_since > self.relay.stall_timeout:
+            return 'stalled'
+        return None
+
+    def close(self):
+        with self.queue_ready:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue_ready.notify()
+        self.relay.clients.discard(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if self.stream is not None:
+            self.stream.leave(self)
+            relay_log.info("Consumer %s:%d left after %d packets (%d dropped)", self.address[0], self.address[1],
+                           self.sent, self.dropped, serial=self.stream.serial)
+        if self.dropped:
+            metrics.increment('relay_packets_dropped', self.dropped)
+
+    def to_dict(self):
+        return {
+            "address": f"{self.address[0]}:{self.address[1]}",
+            "playing": self.playing,
+            "connected": self.connected,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "queued": len(self.queue),
+        }
+
+
+class RtspRelay:
+    """Optional RTSP relay: one upstream session per camera fanned out to local consumers.
+
+    Consumers connect to rtsp://<server>:<RelayPort>/<serial>. Packets are copied, never
+    re-encoded. A watchdog thread tears down upstream sessions that stop delivering packets
+    and drops consumers that went silent or stopped reading, so a camera is never left
+    streaming to a dead client.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.port = DEFAULT_PORT
+        self.upstream_transport = DEFAULT_UPSTREAM_TRANSPORT
+        self.linger = DEFAULT_LINGER
+        self.max_consumers = DEFAULT_MAX_CONSUMERS
+        self.consumer_queue = DEFAULT_CONSUMER_QUEUE
+        self.connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        self.rtcp_interval = DEFAULT_RTCP_INTERVAL
+        self.teardown_attempts = DEFAULT_TEARDOWN_ATTEMPTS
+        self.packet_timeout = DEFAULT_PACKET_TIMEOUT
+        self.consumer_timeout = DEFAULT_CONSUMER_TIMEOUT
+        self.stall_timeout = DEFAULT_STALL_TIMEOUT
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.clients = set()
+        self.ended = collections.deque(maxlen=ENDED_HISTORY)
+        self.stop_event = threading.Event()
+        self.listener = None
+        self.thread = None
+        self.watchdog = None
+
+    def configure(self, config):
+        self.enabled = bool(config.get('RelayEnabled', False)) if self.thread is None else self.enabled
+        self.port = int(config.get('RelayPort', DEFAULT_PORT)) if self.thread is None else self.port
+        transport = str(config.get('RelayUpstreamTransport', DEFAULT_UPSTREAM_TRANSPORT)).lower()
+        if transport not in ('udp', 'tcp'):
+            relay_log.warning("Unknown RelayUpstreamTransport %r, using %s", transport, DEFAULT_UPSTREAM_TRANSPORT)
+            transport = DEFAULT_UPSTREAM_TRANSPORT
+        self.upstream_transport = transport
+        self.linger = float(config.get('RelayLinger', DEFAULT_LINGER))
+        self.max_consumers = max(int(config.get('RelayMaxConsumers', DEFAULT_MAX_CONSUMERS)), 1)
+        self.consumer_queue = max(int(config.get('RelayConsumerQueue', DEFAULT_CONSUMER_QUEUE)), 1)
+        self.connect_timeout = float(config.get('RelayConnectTimeout', DEFAULT_CONNECT_TIMEOUT))
+        self.rtcp_interval = max(float(config.get('RelayRtcpInterval', DEFAULT_RTCP_INTERVAL)), 0)
+        self.teardown_attempts = max(int(config.get('RelayTeardownAttempts', DEFAULT_TEARDOWN_ATTEMPTS)), 1)
+        self.packet_timeout = float(config.get('RelayPacketTimeout', DEFAULT_PACKET_TIMEOUT))
+        self.consumer_timeout = max(float(config.get('RelayConsumerTimeout', DEFAULT_CONSUMER_TIMEOUT)), 1)
+        self.stall_timeout = float(config.get('RelayStallTimeout', DEFAULT_STALL_TIMEOUT))
+        self.sources = {str(serial): url for serial, url in (config.get('RelaySources') or {}).items()}
+
+    def upstream_url(self, serial):
+        if serial in self.sources:
+            return self.sources[serial]
+        device = DeviceDB.from_db_serial(serial)
+        if device is None or device.model.rtsp_port is None:
+            return None
+        return f"rtsp://{device.ip}:{device.model.rtsp_port}/live"
+
+    def stream(self, serial):
+        """The stream of a camera, None for unknown cameras and models without video"""
+        url = self.upstream_url(serial)
+        if url is None:
+            return None
+        with self.lock:
+            stream = self.streams.get(serial)
+            if stream is None or (stream.url != url and not stream.consumers):
+                stream = self.streams[serial] = RelayStream(self, serial, url)
+            return stream
+
+    def update_gauges(self):
+        with self.lock:
+            streams = list(self.streams.values())
+        metrics.set_gauge('relay_consumers', sum(len(stream.consumers) for stream in streams))
+        metrics.set_gauge('relay_upstream_sessions_open', sum(1 for stream in streams if stream.upstream is not None))
+
+    def status(self):
+        with self.lock:
+            streams = list(self.streams.values())
+        return [stream.to_dict() for stream in streams]
+
+    def session_ended(self, upstream):
+        with self.lock:
+            self.ended.append(upstream)
+
+    def health(self):
+        """Health of every relayed stream and of the upstream sessions that ended recently"""
+        now = time.time()
+        with self.lock:
+            streams = list(self.streams.values())
+            ended = list(self.ended)
+        return {
+            "streams": [stream.health(now) for stream in streams],
+            "ended": [upstream.health(now) for upstream in reversed(ended)],
+        }
+
+    def check(self, now):
+        """One watchdog pass over the upstream sessions and consumers"""
+        with self.lock:
+            streams = list(self.streams.values())
+        for stream in streams:
+            upstream = stream.upstream
+            if upstream is None or upstream.state != 'playing' or self.packet_timeout <= 0:
+                continue
+            silent = now - (upstream.last_packet or upstream.started)
+            if silent > self.packet_timeout:
+                metrics.increment('relay_watchdog', reason='upstream_silent')
+                # The TEARDOWN may take a few attempts, the watchdog keeps watching meanwhile
+                threading.Thread(target=stream.upstream_failed, args=(upstream, f"no packets for {silent:.0f}s"),
+                                 daemon=True).start()
+        for client in list(self.clients):
+            reason = client.expired(now)
+            if reason is not None:
+                metrics.increment('relay_watchdog', reason=f"consumer_{reason}")
+                relay_log.warning("Dropping %s consumer %s:%d", reason, client.address[0], client.address[1],
+                                  serial=client.stream.serial if client.stream is not None else None)
+                client.close()
+
+    def supervise(self):
+        while not self.stop_event.wait(WATCHDOG_INTERVAL):
+            try:
+                self.check(time.time())
+            except Exception as e:
+                relay_log.error("Relay watchdog failed: %s", e)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', self.port))
+        self.listener.listen(16)
+        self.thread = threading.Thread(target=self.run, name='rtsp-relay', daemon=True)
+        self.thread.start()
+        self.watchdog = threading.Thread(target=self.supervise, name='rtsp-relay-watchdog', daemon=True)
+        self.watchdog.start()
+        relay_log.info("RTSP relay listening on port %d", self.port)
+
+    def stop(self, timeout=None):
+        """Close every consumer and TEARDOWN every upstream session, the TEARDOWNs still
+        unanswered after `timeout` seconds are given up on"""
+        if self.thread is None or self.stop_event.is_set():
+            return
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self.stop_event.set()
+        self.listener.close()
+        for client in list(self.clients):
+            client.close()
+        with self.lock:
+            streams = list(self.streams.values())
+        for stream in streams:
+            stream.close_idle(deadline)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                sock, address = self.listener.accept()
+            except OSError as e:
+                if not self.stop_event.is_set():
+                    relay_log.error("Relay accept failed: %s", e)
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = RelayClient(self, sock, address)
+            self.clients.add(client)
+            client.start()
+
+
+rtsp_relay = RtspRelay()
@@ -1,49 +1,153 @@
 import socket
-import json
+import time
 
-from arlo.messages import Message
+from arlo.messages import LazyMessage
+
+RECV_SIZE = 4096
+# "L:<length> " never gets longer than this
+MAX_HEADER = 16
+
+
+class ConnectionClosed(RuntimeError):
+    """The peer closed the connection between two frames"""
+
+
+class IoTimeout(socket.timeout):
+    """A budget ran out, `stage` names which: idle, connect, send, header, body or total"""
+
+    def __init__(self, stage):
+        socket.timeout.__init__(self, f"{stage} timed out")
+        self.stage = stage
+
+
+class Deadline:
+    """The total time budget of one operation, each step gets at most what is left of it"""
+
+    def __init__(self, budget=None):
+        self.expires = time.monotonic() + budget if budget else None
+
+    def remaining(self):
+        return None if self.expires is None else self.expires - time.monotonic()
+
+    def timeout(self, limit, stage, started=None):
+        """(seconds, stage) for the next step: `limit` seconds from `started` (or now) for `stage`,
+        unless less than that is left of the whole budget, then the rest of it for 'total'"""
+        step = None
+        if limit:
+            step = limit - (time.monotonic() - started if started is not None else 0)
+        left = self.remaining()
+        if left is not None and (step is None or left < step):
+            return left, 'total'
+        return step, stage
 
 
 class ArloSocket:
+    """Frames are "L:<length> <json>". Bytes read past the end of a frame are kept for the
+    next receive(), so several frames can follow each other on one connection.
+
+    Without budgets every read blocks for as long as the socket's own timeout allows. With
+    them each read waits only for what is left of its stage and of the Deadline, and a
+    budget running out raises IoTimeout, so a half-open connection cannot hold a thread."""
 
     def __init__(self, sock=None):
         if sock is None:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         else:
             self.sock = sock
+        self.buffer = bytearray()
+        # Waiting for the first byte of a frame, nothing is lost by closing it now
+        self.idle = False
+        self.stage = None
 
     def connect(self, host, port):
         self.sock.connect((host, port))
 
-    def send(self, message):
-        self.sock.sendall(message.toNetworkMessage())
+    def send(self, message, deadline=None):
+        if deadline is not None:
+            self.settimeout(*deadline.timeout(None, 'send'))
+        try:
+            self.sock.sendall(message.toNetworkMessage())
+        except socket.timeout:
+            if deadline is None:
+                raise
+            raise IoTimeout(self.stage) from None
+
+    def settimeout(self, timeout, stage):
+        if timeout is not None and timeout <= 0:
+            raise IoTimeout(stage)
+        self.sock.settimeout(timeout)
+        self.stage = stage
 
-    def receive(self):
-        chunk = self.sock.recv(1024)
+    def fill(self, budget=None):
+        """Read what has arrived, `budget` is the (seconds, stage) it may wait at most"""
+        if budget is not None:
+            self.settimeout(*budget)
+        try:
+            chunk = self.sock.recv(RECV_SIZE)
+        except socket.timeout:
+            if budget is None:
+                raise
+            raise IoTimeout(self.stage) from None
         if chunk == b'':
+            broken = bool(self.buffer)
             self.close()
-            raise RuntimeError("socket connection closed")
+            if broken:
+                raise RuntimeError("socket connection broken")
+            raise ConnectionClosed("socket connection closed")
+        self.buffer += chunk
 
-        data = chunk.decode(encoding="utf-8")
-        if data.startswith("L:"):
-            delimiter = data.index(" ")
-            dataLength = int(data[2:delimiter])
-            json_data = data[delimiter+1:delimiter+1+dataLength]
-        else:
+    def wait(self, idle=None):
+        """Wait up to `idle` seconds (None for as long as it takes) for the next frame to start,
+        IoTimeout('idle') when it does not. A budget left on the socket by the last frame never applies."""
+        self.idle = True
+        try:
+            while not self.buffer:
+                self.fill((idle or None, 'idle'))
+        finally:
+            self.idle = False
+
+    def receive(self, header=None, body=None, deadline=None):
+        """The next frame, None when what was read is not a frame and was dropped.
+
+        `header` is the budget in seconds from the call until the frame's length is known,
+        `body` from then until the rest of it arrived, and `deadline` the Deadline of the
+        whole operation. None of them given, reads are bounded by the socket's timeout only."""
+        budgeted = header or body or deadline
+        deadline = deadline or Deadline()
+        started = time.monotonic()
+
+        def budget(limit, stage):
+            return deadline.timeout(limit, stage, started) if budgeted else None
+
+        while len(self.buffer) < 2:
+            self.fill(budget(header, 'header'))
+        if not self.buffer.startswith(b'L:'):
+            # Skip to the next frame header, if any was read
+            start = self.buffer.find(b'L:', 1)
+            del self.buffer[:start if start > 0 else len(self.buffer)]
             return None
 
-        read = len(json_data)
-        while read < dataLength:
-            to_read = min(dataLength - read, 1024)
-            chunk = self.sock.recv(to_read)
-            if chunk == b'':
-                self.close()
-                raise RuntimeError("socket connection broken")
-            chunk_str = chunk.decode(encoding="utf-8")
-            json_data += chunk_str
-            read = read + len(chunk_str)
+        delimiter = self.buffer.find(b' ')
+        while delimiter < 0:
+            if len(self.buffer) > MAX_HEADER:
+                del self.buffer[:]
+                return None
+            self.fill(budget(header, 'header'))
+            delimiter = self.buffer.find(b' ')
+        try:
+            dataLength = int(self.buffer[2:delimiter])
+        except ValueError:
+            del self.buffer[:delimiter + 1]
+            return None
 
-        return Message(json.loads(json_data))
+        # The devices' JSON is ASCII, the length counts bytes as much as characters
+        end = delimiter + 1 + dataLength
+        started = time.monotonic()
+        while len(self.buffer) < end:
+            self.fill(budget(body, 'body'))
+        json_data = self.buffer[delimiter + 1:end].decode(encoding="utf-8")
+        del self.buffer[:end]
+        return LazyMessage(json_data)
 
     def close(self):
         self.sock.close()
@@ -0,0 +1,93 @@
+import threading
+import time
+
+# Never compared, they change on every frame
+DEFAULT_IGNORED_KEYS = ['ID', 'Type']
+
+# Compared, but a change in these alone does not justify a write or a webhook
+DEFAULT_VOLATILE_KEYS = [
+    'Bat1Volt',
+    'Battery1CaliVoltage',
+    'PoweredOn',
+    'CameraOnline',
+    'CameraOffline',
+    'ISPOn',
+]
+
+# Force a write after this many seconds so volatile values do not go stale forever
+DEFAULT_PERSIST_INTERVAL = 3600
+
+
+class StatusChange:
+    def __init__(self, changed, volatile_keys, force):
+        # {key: (old_value, new_value)}, removed keys have a new value of None
+        self.changed = changed
+        self.meaningful = [key for key in changed if key not in volatile_keys]
+        self.persist = force or len(self.meaningful) > 0
+        self.notify = len(self.meaningful) > 0
+
+    def delta(self):
+        """The new values of all changed fields"""
+        return {key: new for key, (_, new) in self.changed.items()}
+
+
+class StatusTracker:
+    """Diffs each incoming status frame against the last one seen for the device"""
+
+    def __init__(self, ignored_keys=None, volatile_keys=None, persist_interval=DEFAULT_PERSIST_INTERVAL):
+        self.ignored_keys = frozenset(DEFAULT_IGNORED_KEYS if ignored_keys is None else ignored_keys)
+        self.volatile_keys = frozenset(DEFAULT_VOLATILE_KEYS if volatile_keys is None else volatile_keys)
+        self.persist_interval = persist_interval
+        self.lock = threading.Lock()
+        self.last_status = {}
+        self.last_persisted = {}
+
+    @staticmethod
+    def from_config(config):
+        tracker = StatusTracker()
+        tracker.configure(config)
+        return tracker
+
+    def configure(self, config):
+        """Apply the key lists and interval from the configuration, the status seen so far is kept"""
+        ignored_keys = config.get('StatusIgnoredKeys')
+        volatile_keys = config.get('StatusVolatileKeys')
+        self.ignored_keys = frozenset(DEFAULT_IGNORED_KEYS if ignored_keys is None else ignored_keys)
+        self.volatile_keys = frozenset(DEFAULT_VOLATILE_KEYS if volatile_keys is None else volatile_keys)
+        self.persist_interval = config.get('StatusPersistInterval', DEFAULT_PERSIST_INTERVAL)
+
+    def diff(self, previous, current):
+        changed = {}
+        for key, value in current.items():
+            if key in self.ignored_keys:
+                continue
+            old = previous.get(key)
+            if key not in previous or old != value:
+                changed[key] = (old, value)
+        for key, old in previous.items():
+            if key not in current and key not in self.ignored_keys:
+                changed[key] = (old, None)
+        return changed
+
+    def update(self, serial, stored_status, status):
+        """Compare `status` with the last known status of `serial`.
+
+        `stored_status` is the persisted status and is only used when nothing has been
+        seen for the device since startup.
+        """
+        current = status.dictionary if hasattr(status, 'dictionary') else status
+        now = time.monotonic()
+        with self.lock:
+            previous = self.last_status.get(serial)
+            if previous is None and stored_status:
+                previous = stored_status.dictionary if hasattr(stored_status, 'dictionary') else stored_status
+            last_persisted = self.last_persisted.get(serial)
+            force = previous is None or last_persisted is None \
+                or (self.persist_interval and now - last_persisted >= self.persist_interval)
+
+            change = StatusChange(self.diff(previous or {}, current), self.volatile_keys, force)
+            self.last_status[serial] = current
+            if change.persist:
+                self.last_persisted[serial] = now
+            return change
+
@@ -0,0 +1,150 @@
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from arlo.device_db import DeviceDB, DB_PATH
+from helpers.log import get_logger
+from helpers.metrics import metrics
+from helpers.timer_heap import TimerHeap
+
+poll_log = get_logger('poller')
+
+DEFAULT_INTERVAL = 0
+DEFAULT_JITTER = 0.2
+DEFAULT_MAX_IN_FLIGHT = 4
+
+
+class StatusPoller:
+    """Periodically sends statusRequest to every registered device.
+
+    Each device gets its own timer, spread over the interval and jittered on every
+    cycle so that cameras are not all woken at the same moment. Requests run on a
+    bounded pool, a device that is still being polled or that reported status
+    recently is skipped for that cycle.
+    """
+
+    def __init__(self):
+        self.interval = DEFAULT_INTERVAL
+        self.jitter = DEFAULT_JITTER
+        self.max_in_flight = DEFAULT_MAX_IN_FLIGHT
+        self.skip_recent = 0
+        self.lock = threading.Lock()
+        self.last_status = {}
+        self.in_flight = set()
+        # Devices with a poll timer
+        self.enrolled = set()
+        self.timers = TimerHeap('status-poller')
+        self.executor = None
+        self.started = False
+
+    def configure(self, config):
+        previous = self.interval
+        self.interval = config.get('StatusPollInterval', DEFAULT_INTERVAL)
+        self.jitter = min(max(config.get('StatusPollJitter', DEFAULT_JITTER), 0), 1)
+        self.max_in_flight = config.get('StatusPollMaxInFlight', DEFAULT_MAX_IN_FLIGHT)
+        self.skip_recent = config.get('StatusPollSkipRecent', self.interval / 2)
+        if self.started and self.interval != previous:
+            self.reschedule()
+
+    def reschedule(self):
+        """Re-arm every timer for a new interval, or cancel them all when polling was turned off"""
+        if self.executor is None:
+            if self.enabled:
+                poll_log.warning("Status polling was off at startup, turning it on takes effect after a restart")
+            return
+        with self.lock:
+            serials = list(self.enrolled)
+        for serial in serials:
+            if self.enabled:
+                self.timers.schedule(serial, random.uniform(0, self.interval), self.due)
+            else:
+                self.timers.cancel(serial)
+        poll_log.info("Status poll interval is now %ss for %d device(s)", self.interval, len(serials))
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        self.started = True
+        if not self.enabled:
+            return
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='status-poll')
+        self.timers.start()
+        # Nothing has registered in this boot yet, devices that stayed connected across the
+        # restart would not register again, so every known device is polled
+        with sqlite3.connect(DB_PATH) as conn:
+            serials = [row[0] for row in conn.execute("SELECT serialnumber FROM devices")]
+        for serial in serials:
+            self.add(serial)
+        poll_log.info("Polling status every %ss (jitter %d%%, at most %d in flight)",
+                      self.interval, self.jitter * 100, self.max_in_flight)
+
+    def add(self, serial):
+        """Start polling a device, the first poll lands at a random point of the interval"""
+        # Turning polling on needs a restart, the timers and pool only exist once started
+        if self.executor is None:
+            return
+        with self.lock:
+            self.enrolled.add(serial)
+        # Polling turned off since, the device is polled again once it is turned back on
+        if self.enabled:
+            self.timers.schedule(serial, random.uniform(0, self.interval), self.due)
+
+    def status_received(self, serial):
+        with self.lock:
+            self.last_status[serial] = time.monotonic()
+            enrolled = serial in self.enrolled
+        if not enrolled:
+            self.add(serial)
+
+    def next_delay(self):
+        spread = self.interval * self.jitter
+        return max(self.interval + random.uniform(-spread, spread), 1)
+
+    def due(self, serial):
+        if not self.enabled:
+            return
+        self.timers.schedule(serial, self.next_delay(), self.due)
+        with self.lock:
+            last_status = self.last_status.get(serial)
+            if last_status is not None and time.monotonic() - last_status < self.skip_recent:
+                metrics.increment('status_poll', outcome='skipped_recent', serial=serial)
+                return
+            if serial in self.in_flight:
+                metrics.increment('status_poll', outcome='skipped_in_flight', serial=serial)
+                return
+            self.in_flight.add(serial)
+        self.executor.submit(self.poll, serial)
+
+    def stop(self):
+        if self.executor is not None:
+            self.timers.stop()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def poll(self, serial):
+        started = time.monotonic()
+        try:
+            device = DeviceDB.from_db_serial(serial)
+            if device is None:
+                self.timers.cancel(serial)
+                with self.lock:
+                    self.enrolled.discard(serial)
+                outcome = 'unknown_device'
+            else:
+                outcome = 'ok' if device.status_request() else 'failed'
+        except Exception as e:
+            poll_log.error("Status poll failed: %s", e, serial=serial)
+            outcome = 'error'
+        finally:
+            with self.lock:
+                self.in_flight.discard(serial)
+        elapsed = time.monotonic() - started
+        metrics.increment('status_poll', outcome=outcome, serial=serial)
+        metrics.observe('status_poll_seconds', elapsed, serial=serial)
+        poll_log.debug("Status poll %s in %.2fs", outcome, elapsed, serial=serial)
+
+
+status_poller = StatusPoller()
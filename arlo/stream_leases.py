@@ -0,0 +1,249 @@
+import queue
+import threading
+import time
+import uuid
+
+from arlo.camera import Camera
+from arlo.device_db import DeviceDB
+from helpers.log import get_logger
+from helpers.metrics import metrics
+from helpers.timer_heap import TimerHeap
+
+lease_log = get_logger('leases')
+
+DEFAULT_TTL = 30
+DEFAULT_MAX_TTL = 300
+DEFAULT_GRACE = 10
+# Seconds before clearing UserStreamActive is tried again, doubled up to the maximum
+CLEAR_RETRY_BACKOFF = 5
+CLEAR_RETRY_MAX_BACKOFF = 300
+
+
+class StreamLease:
+    def __init__(self, serial, holder, ttl):
+        self.id = uuid.uuid4().hex
+        self.serial = serial
+        self.holder = holder
+        self.ttl = ttl
+        self.acquired = time.time()
+        self.expires = self.acquired + ttl
+        self.heartbeats = 0
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "serial": self.serial,
+            "holder": self.holder,
+            "ttl": self.ttl,
+            "acquired": self.acquired,
+            "expires": self.expires,
+            "heartbeats": self.heartbeats,
+        }
+
+
+class CameraStreams:
+    """The leases on one camera and what the camera was last told"""
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.leases = {}
+        # UserStreamActive the camera acknowledged last, None before the first command
+        self.active = None
+        self.changed = None
+        self.idle_since = None
+        # Unacknowledged attempts to clear UserStreamActive in a row
+        self.clear_failures = 0
+
+    def to_dict(self):
+        return {
+            "serial": self.serial,
+            "user_stream_active": self.active,
+            "changed": self.changed,
+            "idle_since": self.idle_since,
+            "leases": [lease.to_dict() for lease in self.leases.values()],
+        }
+
+
+class StreamLeaseManager:
+    """Reference counts the consumers of each camera's stream through leases.
+
+    A consumer acquires a lease and keeps it alive with heartbeats, each one pushing the
+    expiry `ttl` seconds out. The first lease on a camera sets UserStreamActive, and once
+    the last lease is released or expires the camera is given `grace` seconds for a new
+    consumer before UserStreamActive is cleared, so a client reconnecting does not toggle
+    the camera. Expiry uses one timer per lease, a heartbeat only moves the deadline and
+    the timer re-arms itself for the remainder when it fires early. The registerSets are
+    sent from a dedicated thread, in order, never from the timer thread. A clear the camera
+    does not acknowledge, e.g. while it is asleep, is tried again with backoff until it is.
+    """
+
+    def __init__(self):
+        self.default_ttl = DEFAULT_TTL
+        self.max_ttl = DEFAULT_MAX_TTL
+        self.grace = DEFAULT_GRACE
+        self.lock = threading.Lock()
+        self.cameras = {}
+        self.leases = {}
+        self.timers = TimerHeap('stream-leases')
+        self.commands = queue.SimpleQueue()
+        self.worker = threading.Thread(target=self.run, name='stream-lease-commands', daemon=True)
+
+    def configure(self, config):
+        self.default_ttl = config.get('StreamLeaseTTL', DEFAULT_TTL)
+        self.max_ttl = config.get('StreamLeaseMaxTTL', DEFAULT_MAX_TTL)
+        self.grace = config.get('StreamLeaseGrace', DEFAULT_GRACE)
+
+    def start(self):
+        self.timers.start()
+        self.worker.start()
+
+    def stop(self):
+        """Leases are not kept across restarts"""
+        self.timers.stop()
+
+    def ttl(self, ttl):
+        if ttl is None:
+            return self.default_ttl
+        ttl = float(ttl)
+        if not 0 < ttl <= self.max_ttl:
+            raise ValueError(f"ttl must be between 0 and {self.max_ttl} seconds")
+        return ttl
+
+    def acquire(self, serial, holder=None, ttl=None):
+        lease = StreamLease(serial, holder, self.ttl(ttl))
+        with self.lock:
+            camera = self.cameras.get(serial)
+            if camera is None:
+                camera = self.cameras[serial] = CameraStreams(serial)
+            camera.leases[lease.id] = lease
+            camera.idle_since = None
+            camera.clear_failures = 0
+            self.leases[lease.id] = lease
+            first = len(camera.leases) == 1
+        # A grace timer from the previous consumers is void now
+        self.timers.cancel(('grace', serial))
+        self.timers.schedule(lease.id, lease.ttl, self.expire)
+        metrics.increment('stream_leases', outcome='acquired')
+        self.update_gauges()
+        lease_log.info("Lease %s acquired by %s for %ss", lease.id, holder or "anonymous", lease.ttl, serial=serial)
+        if first:
+            self.commands.put(serial)
+        return lease
+
+    def heartbeat(self, lease_id, ttl=None):
+        """Extend a lease, None when it is unknown or already expired"""
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return None
+            if ttl is not None:
+                lease.ttl = self.ttl(ttl)
+            lease.expires = time.time() + lease.ttl
+            lease.heartbeats += 1
+            camera = self.cameras[lease.serial]
+            retry = camera.active is not True
+        if retry:
+            # The camera did not acknowledge UserStreamActive yet, e.g. it was asleep
+            self.commands.put(lease.serial)
+        return lease
+
+    def release(self, lease_id, reason='released'):
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return False
+            camera = self.cameras[lease.serial]
+            del camera.leases[lease_id]
+            last = not camera.leases
+            if last:
+                camera.idle_since = time.time()
+        self.timers.cancel(lease_id)
+        metrics.increment('stream_leases', outcome=reason)
+        self.update_gauges()
+        lease_log.info("Lease %s %s", lease.id, reason, serial=lease.serial)
+        if last:
+            self.timers.schedule(('grace', lease.serial), self.grace, self.grace_over)
+        return True
+
+    def expire(self, lease_id):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return
+            remaining = lease.expires - time.time()
+        if remaining > 0:
+            self.timers.schedule(lease_id, remaining, self.expire)
+        else:
+            self.release(lease_id, 'expired')
+
+    def grace_over(self, key):
+        self.commands.put(key[1])
+
+    def run(self):
+        while True:
+            serial = self.commands.get()
+            try:
+                self.apply(serial)
+            except Exception as e:
+                lease_log.exception("Updating UserStreamActive failed: %s", e, serial=serial)
+
+    def apply(self, serial):
+        """Bring the camera's UserStreamActive in line with its leases"""
+        with self.lock:
+            camera = self.cameras.get(serial)
+            if camera is None:
+                return
+            wanted = bool(camera.leases)
+            if camera.active == wanted:
+                return
+        device = DeviceDB.from_db_serial(serial)
+        if not isinstance(device, Camera):
+            lease_log.warning("Not a known camera, UserStreamActive not sent", serial=serial)
+            return
+        result = device.set_user_stream_active(wanted)
+        metrics.increment('user_stream_active_updates', outcome='ok' if result else 'failed')
+        retry = None
+        with self.lock:
+            if result:
+                camera.active = wanted
+                camera.changed = time.time()
+                camera.clear_failures = 0
+            elif not wanted and not camera.leases:
+                # No heartbeat is left to retry it, the camera would keep streaming
+                retry = min(CLEAR_RETRY_BACKOFF * 2 ** camera.clear_failures, CLEAR_RETRY_MAX_BACKOFF)
+                camera.clear_failures += 1
+            if not camera.leases and camera.active is False:
+                # Nothing left to track
+                del self.cameras[serial]
+        if retry is not None:
+            self.timers.schedule(('grace', serial), retry, self.grace_over)
+        lease_log.info("UserStreamActive %s %s", int(wanted), "set" if result else "not acknowledged", ip=device.ip,
+                       serial=serial)
+
+    def override(self, device, active):
+        """Send UserStreamActive outside of the leases, the next lease change applies them again"""
+        result = device.set_user_stream_active(active)
+        if result:
+            with self.lock:
+                camera = self.cameras.get(device.serial_number)
+                if camera is not None:
+                    camera.active = bool(active)
+                    camera.changed = time.time()
+        return result
+
+    def update_gauges(self):
+        with self.lock:
+            metrics.set_gauge('stream_leases_active', len(self.leases))
+
+    def status(self, serial=None):
+        with self.lock:
+            cameras = [self.cameras[serial]] if serial in self.cameras else [] if serial else list(self.cameras.values())
+            return [camera.to_dict() for camera in cameras]
+
+    def get(self, lease_id):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            return lease.to_dict() if lease is not None else None
+
+
+stream_leases = StreamLeaseManager()
@@ -0,0 +1,321 @@
+import array
+import bisect
+import sqlite3
+import struct
+import threading
+import time
+
+from arlo.device_db import DB_PATH
+from helpers.log import get_logger
+
+telemetry_log = get_logger('telemetry')
+
+DEFAULT_FIELDS = [
+    'BatPercent',
+    'SignalStrengthIndicator',
+    'Temperature',
+    'ChargingState',
+    'Bat1Volt',
+]
+
+# String valued fields are stored as their index in here, unknown values are skipped
+ENUM_VALUES = {
+    'ChargingState': {'Off': 0, 'On': 1, 'Complete': 2, 'Fault': 3},
+}
+
+# Tier name -> (bucket width in seconds, default retention in seconds). Raw is not bucketed.
+TIERS = {
+    'raw': (0, 7 * 86400),
+    '1m': (60, 31 * 86400),
+    '1h': (3600, 400 * 86400),
+}
+TIER_ORDER = ['raw', '1m', '1h']
+
+SEGMENT_SIZE = 1024
+DEFAULT_FLUSH_INTERVAL = 300
+
+
+class Segment:
+    """Fixed capacity, column oriented block of points.
+
+    Raw points have min == max == value; downsampled points hold the bucket mean in
+    `values` and the bucket extremes in `minimums`/`maximums`.
+    """
+    HEADER = struct.Struct('<I')
+
+    def __init__(self):
+        self.times = array.array('d')
+        self.values = array.array('f')
+        self.minimums = array.array('f')
+        self.maximums = array.array('f')
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def full(self):
+        return len(self.times) >= SEGMENT_SIZE
+
+    @property
+    def start(self):
+        return self.times[0]
+
+    @property
+    def end(self):
+        return self.times[-1]
+
+    def append(self, timestamp, value, minimum, maximum):
+        self.times.append(timestamp)
+        self.values.append(value)
+        self.minimums.append(minimum)
+        self.maximums.append(maximum)
+        self.dirty = True
+
+    def to_bytes(self):
+        return self.HEADER.pack(len(self.times)) + self.times.tobytes() + self.values.tobytes() \
+            + self.minimums.tobytes() + self.maximums.tobytes()
+
+    @staticmethod
+    def from_bytes(data):
+        segment = Segment()
+        (count,) = Segment.HEADER.unpack_from(data)
+        offset = Segment.HEADER.size
+        for column in (segment.times, segment.values, segment.minimums, segment.maximums):
+            length = count * column.itemsize
+            column.frombytes(data[offset:offset + length])
+            offset += length
+        segment.dirty = False
+        return segment
+
+
+class Bucket:
+    """Running aggregate of the points that fall into one downsampling interval"""
+
+    def __init__(self, start):
+        self.start = start
+        self.total = 0.0
+        self.count = 0
+        self.minimum = float('inf')
+        self.maximum = float('-inf')
+        self.dirty = True
+
+    def add(self, value):
+        self.dirty = True
+        self.total += value
+        self.count += 1
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+
+class Series:
+    def __init__(self):
+        self.tiers = {tier: [] for tier in TIER_ORDER}
+        self.buckets = {}
+
+    def _append(self, tier, timestamp, value, minimum, maximum):
+        segments = self.tiers[tier]
+        if not segments or segments[-1].full:
+            segments.append(Segment())
+        segments[-1].append(timestamp, value, minimum, maximum)
+
+    def add(self, timestamp, value):
+        raw = self.tiers['raw']
+        if raw and len(raw[-1]) and timestamp < raw[-1].end:
+            # Out of order point, downsampled tiers would already be closed for it
+            return False
+        self._append('raw', timestamp, value, value, value)
+
+        for tier in TIER_ORDER[1:]:
+            width = TIERS[tier][0]
+            start = timestamp - timestamp % width
+            bucket = self.buckets.get(tier)
+            if bucket is not None and bucket.start != start:
+                self._close(tier, bucket)
+                bucket = None
+            if bucket is None:
+                bucket = self.buckets[tier] = Bucket(start)
+            bucket.add(value)
+        return True
+
+    def _close(self, tier, bucket):
+        self._append(tier, bucket.start, bucket.total / bucket.count, bucket.minimum, bucket.maximum)
+
+    def expire(self, tier, cutoff):
+        """Drop whole segments that end before the cutoff, returns their start times"""
+        segments = self.tiers[tier]
+        expired = []
+        while len(segments) > 1 and segments[0].end < cutoff:
+            expired.append(segments.pop(0).start)
+        return expired
+
+    def query(self, tier, start, end):
+        times, values, minimums, maximums = [], [], [], []
+        segments = self.tiers[tier]
+        first = max(bisect.bisect_right([s.start for s in segments], start) - 1, 0)
+        for segment in segments[first:]:
+            if not len(segment) or segment.start > end:
+                break
+            lo = bisect.bisect_left(segment.times, start)
+            hi = bisect.bisect_right(segment.times, end)
+            times.extend(segment.times[lo:hi])
+            values.extend(segment.values[lo:hi])
+            minimums.extend(segment.minimums[lo:hi])
+            maximums.extend(segment.maximums[lo:hi])
+
+        # Include the still open bucket so the newest data is visible in downsampled tiers
+        bucket = self.buckets.get(tier)
+        if bucket is not None and start <= bucket.start <= end:
+            times.append(bucket.start)
+            values.append(bucket.total / bucket.count)
+            minimums.append(bucket.minimum)
+            maximums.append(bucket.maximum)
+        return {"time": times, "value": values, "min": minimums, "max": maximums}
+
+    def oldest(self, tier):
+        segments = self.tiers[tier]
+        return segments[0].start if segments and len(segments[0]) else None
+
+
+class TelemetryStore:
+    """In-memory, segment based time series of numeric status fields, flushed to SQLite"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+        self.fields = list(DEFAULT_FIELDS)
+        self.retention = {tier: TIERS[tier][1] for tier in TIER_ORDER}
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def configure(self, config):
+        self.fields = list(config.get('TelemetryFields', DEFAULT_FIELDS))
+        retention = config.get('TelemetryRetention') or {}
+        for tier in TIER_ORDER:
+            if tier in retention:
+                self.retention[tier] = int(retention[tier])
+        self.flush_interval = config.get('TelemetryFlushInterval', DEFAULT_FLUSH_INTERVAL)
+
+    @staticmethod
+    def to_number(field, value):
+        if isinstance(value, bool):
+            return float(value)
+        if isinstance(value, (int, float)):
+            return float(value)
+        if field in ENUM_VALUES and value in ENUM_VALUES[field]:
+            return float(ENUM_VALUES[field][value])
+        return None
+
+    def record(self, serial, message, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            for field in self.fields:
+                if field not in message:
+                    continue
+                value = self.to_number(field, message[field])
+                if value is None:
+                    continue
+                series = self.series.get((serial, field))
+                if series is None:
+                    series = self.series[(serial, field)] = Series()
+                series.add(timestamp, value)
+
+    def fields_for(self, serial):
+        with self.lock:
+            return sorted(field for (_serial, field) in self.series if _serial == serial)
+
+    def pick_tier(self, series, start):
+        for tier in TIER_ORDER:
+            oldest = series.oldest(tier)
+            if oldest is not None and oldest <= start:
+                return tier
+        return TIER_ORDER[0] if series.oldest('raw') is not None else TIER_ORDER[-1]
+
+    def query(self, serial, fields, start, end, resolution='auto'):
+        result = {}
+        with self.lock:
+            for field in fields:
+                series = self.series.get((serial, field))
+                if series is None:
+                    continue
+                tier = self.pick_tier(series, start) if resolution == 'auto' else resolution
+                result[field] = dict(series.query(tier, start, end), resolution=tier)
+        return result
+
+    ### PERSISTENCE ###
+
+    def load(self):
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.execute("SELECT serialnumber, field, tier, data FROM telemetry_segments ORDER BY serialnumber, field, tier, start_time")
+            with self.lock:
+                for serial, field, tier, data in c.fetchall():
+                    if tier not in self.retention:
+                        continue
+                    series = self.series.get((serial, field))
+                    if series is None:
+                        series = self.series[(serial, field)] = Series()
+                    series.tiers[tier].append(Segment.from_bytes(data))
+            # Buckets still open at the last flush carry on, the next point closes them as usual
+            c.execute("SELECT serialnumber, field, tier, start_time, total, count, minimum, maximum FROM telemetry_buckets")
+            with self.lock:
+                for serial, field, tier, start, total, count, minimum, maximum in c.fetchall():
+                    if tier not in self.retention or not count:
+                        continue
+                    series = self.series.get((serial, field))
+                    if series is None:
+                        series = self.series[(serial, field)] = Series()
+                    bucket = series.buckets[tier] = Bucket(start)
+                    bucket.total, bucket.count, bucket.minimum, bucket.maximum = total, count, minimum, maximum
+                    bucket.dirty = False
+        telemetry_log.info("Loaded %d telemetry series", len(self.series))
+
+    def flush(self):
+        now = time.time()
+        rows = []
+        buckets = []
+        expired = []
+        with self.lock:
+            for (serial, field), series in self.series.items():
+                for tier in TIER_ORDER:
+                    for start in series.expire(tier, now - self.retention[tier]):
+                        expired.append((serial, field, tier, start))
+                    for segment in series.tiers[tier]:
+                        if segment.dirty and len(segment):
+                            rows.append((serial, field, tier, segment.start, segment.end, segment.to_bytes()))
+                            segment.dirty = False
+                for tier, bucket in series.buckets.items():
+                    if bucket.dirty:
+                        buckets.append((serial, field, tier, bucket.start, bucket.total, bucket.count,
+                                        bucket.minimum, bucket.maximum))
+                        bucket.dirty = False
+        if not rows and not buckets and not expired:
+            return
+        with sqlite3.connect(DB_PATH) as conn:
+            c = conn.cursor()
+            c.executemany("DELETE FROM telemetry_segments WHERE serialnumber = ? AND field = ? AND tier = ? AND start_time = ?", expired)
+            c.executemany("REPLACE INTO telemetry_segments VALUES (?,?,?,?,?,?)", rows)
+            c.executemany("REPLACE INTO telemetry_buckets VALUES (?,?,?,?,?,?,?,?)", buckets)
+            conn.commit()
+        telemetry_log.debug("Flushed %d telemetry segment(s) and %d open bucket(s), expired %d", len(rows),
+                            len(buckets), len(expired))
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                telemetry_log.error("Telemetry flush failed: %s", e)
+
+    def start(self):
+        self.load()
+        self.thread = threading.Thread(target=self.run, name='telemetry', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.flush()
+
+
+telemetry_store = TelemetryStore()
@@ -4,47 +4,27 @@ from arlo.messages import Message
 import arlo.messages
 from arlo.camera import Camera
 
-DEVICE_PREFIXES = [
-    'AVD'
-]
+class VideoDoorbell(Camera):
+    def initial_config(self, profile):
+        (first_template, first_port), (template, port) = self.model.initial_register_sets
+        firstRegisterSet = Message(copy.deepcopy(first_template))
 
+        registerSet = Message(copy.deepcopy(template))
+        registerSet['SetValues']['WifiCountryCode'] = profile.wifi_country_code
+        registerSet['SetValues']['VideoAntiFlickerRate'] = profile.video_anti_flicker_rate
+        steps = [('register_set', [(firstRegisterSet, first_port), (registerSet, port)])]
 
-class VideoDoorbell(Camera):
-    @property
-    def port(self):
-        return 4000
-
-    def send_initial_register_set(self, wifi_country_code, video_anti_flicker_rate=None, video_quality_default='default'):
-        registerSet = Message(copy.deepcopy(arlo.messages.REGISTER_SET_INITIAL_VID_DOORBELL))
-        self.send_message(registerSet, 4100)
-
-        registerSet = Message(copy.deepcopy(arlo.messages.REGISTER_SET_INITIAL_2_VID_DOORBELL))
-        registerSet['SetValues']['WifiCountryCode'] = wifi_country_code
-        registerSet['SetValues']['VideoAntiFlickerRate'] = video_anti_flicker_rate
-        self.send_message(registerSet)
-
-        if video_quality_default == 'default':
-            video_quality_default = '1536sq'
-
-        self.set_quality({'quality': video_quality_default})
-
-    def set_quality(self, args):
-        quality = args['quality'].lower()
-        if quality == '720sq':
-            ra_params = Message(copy.deepcopy(arlo.messages.RA_PARAMS_VID_DOORBELL))
-            registerSet = Message(copy.deepcopy(arlo.messages.REGISTER_SET_720SQ))
-        elif quality == '1080sq':
-            ra_params = Message(copy.deepcopy(arlo.messages.RA_PARAMS_VID_DOORBELL))
-            registerSet = Message(copy.deepcopy(arlo.messages.REGISTER_SET_1080SQ))
-        elif quality == '1536sq':
-            ra_params = Message(copy.deepcopy(arlo.messages.RA_PARAMS_VID_DOORBELL))
-            registerSet = Message(copy.deepcopy(arlo.messages.REGISTER_SET_1536SQ))
-        else:
-            return False
-
-        return self.send_message(ra_params) and self.send_message(registerSet)
-
-    def arm(self, args):
+        quality = profile.video_quality
+        if quality == 'default':
+            quality = self.model.default_quality
+
+        quality_messages = self.quality_messages(quality)
+        if quality_messages is not None:
+            steps.append(('quality', [(message, None) for message in quality_messages]))
+
+        return steps
+
+    def arm_message(self, args):
         register_set = Message(copy.deepcopy(arlo.messages.REGISTER_SET))
 
         pir_target_state = args['PIRTargetState']
@@ -55,4 +35,4 @@ class VideoDoorbell(Camera):
             'PIRStartSensitivity': pir_start_sensitivity,
         }
 
-        return self.send_message(register_set)
+        return register_set
@@ -0,0 +1,180 @@
+import os
+import threading
+import types
+from collections import namedtuple
+
+import yaml
+
+from helpers.log import get_logger
+
+config_log = get_logger('config')
+
+DEFAULT_PATH = 'arlo.yaml'
+DEFAULT_RELOAD_INTERVAL = 5
+
+# Read once when a subsystem starts, a change is logged and takes effect after a restart
+RESTART_KEYS = ('RegistrationMaxConcurrent', 'JobWorkers', 'StatusPollMaxInFlight', 'RelayEnabled', 'RelayPort',
+                'ListenerWorkers', 'ListenerHandlers', 'ListenerBacklog')
+
+
+def freeze(value):
+    """Read-only copy of parsed YAML: dicts become mapping proxies and lists tuples"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """Mutable copy of a frozen value, e.g. to put it into a message"""
+    if isinstance(value, types.MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class DeviceProfile(namedtuple('DeviceProfile', ['friendly_name', 'wifi_country_code', 'video_anti_flicker_rate',
+                                                 'video_quality', 'pir_led', 'set_values', 'quality_range'])):
+    """Everything the initial configuration of one device needs, resolved from the global
+    defaults and its DeviceSettings when the configuration is loaded. `quality_range` is the
+    (MinVideoQuality, MaxVideoQuality) the adaptive quality controller stays within, either
+    may be None."""
+    __slots__ = ()
+
+    def register_set_values(self):
+        return thaw(self.set_values)
+
+
+class ConfigSnapshot:
+    """One immutable, fully resolved version of the configuration"""
+
+    def __init__(self, raw, version):
+        raw = raw or {}
+        self.version = version
+        self.raw = freeze(raw)
+        self.wifi_country_code = raw.get('WifiCountryCode', "US")
+        self.video_anti_flicker_rate = raw.get('VideoAntiFlickerRate', 60)
+        self.video_quality_default = raw.get('VideoQualityDefault', 'default')
+        self.notify_on_motion_alert = raw.get('NotifyOnMotionAlert', True)
+        self.notify_on_motion_timeout_alert = raw.get('NotifyOnMotionTimeoutAlert', False)
+        self.notify_on_audio_alert = raw.get('NotifyOnAudioAlert', False)
+        self.notify_on_button_press_alert = raw.get('NotifyOnButtonPressAlert', True)
+        self.notify_registered_and_status_update = raw.get('NotifyRegisteredAndStatusUpdate', True)
+        self.notify_on_presence_change = raw.get('NotifyOnPresenceChange', False)
+        self.status_webhook_payload = raw.get('StatusWebhookPayload', 'full')
+
+        self.default_profile = self.compile_profile({})
+        profiles = {}
+        for serial, settings in (raw.get('DeviceSettings') or {}).items():
+            if isinstance(settings, dict):
+                profiles[str(serial)] = self.compile_profile(settings)
+            else:
+                config_log.warning("Ignoring DeviceSettings for %s, expected a mapping", serial)
+        self.profiles = types.MappingProxyType(profiles)
+
+    def compile_profile(self, settings):
+        settings = dict(settings)
+        friendly_name = settings.pop('FriendlyName', None)
+        video_quality = settings.pop('VideoQuality', self.video_quality_default)
+        pir_enabled = settings.pop('PIREnableLED', None)
+        pir_sensitivity = settings.pop('PIRLEDSensitivity', None)
+        pir_led = (pir_enabled, pir_sensitivity) if pir_enabled is not None and pir_sensitivity is not None else None
+        quality_range = (settings.pop('MinVideoQuality', None), settings.pop('MaxVideoQuality', None))
+        # Whatever is left is sent as-is in the initial registerSet
+        return DeviceProfile(friendly_name, self.wifi_country_code, self.video_anti_flicker_rate,
+                             video_quality, pir_led, freeze(settings), quality_range)
+
+    def profile(self, serial):
+        return self.profiles.get(serial, self.default_profile)
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __contains__(self, key):
+        return key in self.raw
+
+
+class ConfigManager:
+    """Loads the configuration file and swaps in a new snapshot whenever it changes.
+
+    Readers take `config_manager.snapshot` once per unit of work and use that object
+    throughout, a reload never changes a snapshot already handed out. A file that fails
+    to parse is logged and the previous snapshot stays in use.
+    """
+
+    def __init__(self):
+        self.path = DEFAULT_PATH
+        self.snapshot = None
+        self.listeners = []
+        self.file_state = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='config-reload', daemon=True)
+
+    def read(self):
+        state = self.stat()
+        with open(self.path) as file:
+            raw = yaml.load(file, Loader=yaml.FullLoader)
+        version = self.snapshot.version + 1 if self.snapshot else 1
+        return ConfigSnapshot(raw, version), state
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self, path=DEFAULT_PATH):
+        """Initial load, errors are raised"""
+        self.path = path
+        self.snapshot, self.file_state = self.read()
+        return self.snapshot
+
+    def subscribe(self, listener):
+        """Call `listener(snapshot)` now and after every reload"""
+        self.listeners.append(listener)
+        if self.snapshot is not None:
+            listener(self.snapshot)
+
+    def reload(self, force=False):
+        with self.lock:
+            if not force and self.stat() == self.file_state:
+                return False
+            try:
+                snapshot, self.file_state = self.read()
+            except Exception as e:
+                self.file_state = self.stat()
+                config_log.error("Failed to reload %s, keeping version %d: %s", self.path, self.snapshot.version, e)
+                return False
+            previous, self.snapshot = self.snapshot, snapshot
+
+        for key in RESTART_KEYS:
+            if previous.get(key) != snapshot.get(key):
+                config_log.warning("%s changed, it takes effect after a restart", key)
+        config_log.info("Loaded configuration version %d from %s", snapshot.version, self.path)
+        for listener in self.listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                config_log.exception("Applying configuration version %d failed: %s", snapshot.version, e)
+        return True
+
+    def start(self):
+        if self.snapshot.get('ConfigReloadInterval', DEFAULT_RELOAD_INTERVAL):
+            self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.snapshot.get('ConfigReloadInterval', DEFAULT_RELOAD_INTERVAL) or DEFAULT_RELOAD_INTERVAL):
+            self.reload()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+config_manager = ConfigManager()
@@ -0,0 +1,115 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)-8s %(category)-8s %(message)s%(context)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOGGER_PREFIX = 'arlo'
+
+# Structured fields accepted as keyword arguments by StructuredLogger
+CONTEXT_FIELDS = ('ip', 'serial', 'msg_id', 'type')
+
+# Lines per LogRateLimitInterval before high-frequency categories get summarised
+DEFAULT_RATE_LIMITS = {
+    'ack': 120,
+    'persist': 30,
+}
+DEFAULT_RATE_LIMIT_INTERVAL = 60
+
+_log_queue = queue.SimpleQueue()
+_listener = None
+_rate_limit_filters = {}
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """Logger for one category that renders ip/serial/msg_id/type keyword arguments as fields."""
+
+    def __init__(self, category):
+        super().__init__(logging.getLogger(f"{LOGGER_PREFIX}.{category}"), {})
+        self.category = category
+
+    def process(self, msg, kwargs):
+        fields = [(key, kwargs.pop(key)) for key in CONTEXT_FIELDS if key in kwargs]
+        context = ''.join(f" {key}={value}" for key, value in fields if value is not None)
+        kwargs['extra'] = {'category': self.category, 'context': context}
+        return msg, kwargs
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `limit` records through per interval and folds the rest into a count.
+
+    The number of dropped records is appended to the first record of the next interval.
+    """
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.count = 0
+        self.suppressed = 0
+
+    def filter(self, record):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.interval:
+                self.window_start = now
+                self.count = 0
+                suppressed, self.suppressed = self.suppressed, 0
+                if suppressed:
+                    record.msg = f"{record.getMessage()} ({suppressed} similar line(s) suppressed in the last {self.interval}s)"
+                    record.args = None
+            self.count += 1
+            if self.count > self.limit:
+                self.suppressed += 1
+                return False
+            return True
+
+
+def get_logger(category):
+    return StructuredLogger(category)
+
+
+def _start():
+    global _listener
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT,
+                                           defaults={'category': '-', 'context': ''}))
+    _listener = logging.handlers.QueueListener(_log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(_log_queue)]
+    root.setLevel(logging.INFO)
+
+
+def configure_logging(config):
+    """Apply LogLevel, LogLevels (per category) and LogRateLimits from the configuration"""
+    logging.getLogger().setLevel(config.get('LogLevel', 'INFO').upper())
+
+    for category, level in (config.get('LogLevels') or {}).items():
+        logging.getLogger(f"{LOGGER_PREFIX}.{category}").setLevel(str(level).upper())
+
+    interval = config.get('LogRateLimitInterval', DEFAULT_RATE_LIMIT_INTERVAL)
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+    rate_limits.update(config.get('LogRateLimits') or {})
+    for category, limit in rate_limits.items():
+        logger = logging.getLogger(f"{LOGGER_PREFIX}.{category}")
+        if category in _rate_limit_filters:
+            logger.removeFilter(_rate_limit_filters.pop(category))
+        if limit:
+            _rate_limit_filters[category] = RateLimitFilter(limit, interval)
+            logger.addFilter(_rate_limit_filters[category])
+
+
+def stop_logging():
+    """Flush queued records, used on shutdown"""
+    if _listener is not None:
+        _listener.stop()
+
+
+_start()
+configure_logging({})
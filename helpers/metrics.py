@@ -0,0 +1,80 @@
+import threading
+import time
+
+
+class Summary:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.last = None
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.last = value
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "avg": self.total / self.count if self.count else None,
+            "min": self.minimum,
+            "max": self.maximum,
+            "last": self.last,
+        }
+
+
+class Metrics:
+    """Process wide counters, gauges and summaries, optionally labelled (e.g. by serial)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+        self.started = time.time()
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def increment(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                summary = self.summaries[key] = Summary()
+            summary.observe(value)
+
+    def snapshot(self, name_prefix=None):
+        def render(items, convert):
+            result = []
+            for (name, labels), value in sorted(items, key=lambda item: item[0]):
+                if name_prefix is None or name.startswith(name_prefix):
+                    result.append({"name": name, "labels": dict(labels), "value": convert(value)})
+            return result
+
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started,
+                "counters": render(self.counters.items(), lambda value: value),
+                "gauges": render(self.gauges.items(), lambda value: value),
+                "summaries": render(self.summaries.items(), lambda value: value.to_dict()),
+            }
+
+
+metrics = Metrics()
@@ -1,14 +1,8 @@
-import threading
-import sys
-import logging
-s_print_lock = threading.Lock()
+from helpers.log import get_logger
+
+_log = get_logger('server')
 
-logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
-        level=logging.INFO,
-        datefmt='%Y-%m-%d %H:%M:%S')
 
 def s_print(*a, **b):
-    """Thread safe print function"""
-    with s_print_lock:
-        logging.info(*a)
-        #print(*a, **b, flush=True)
+    """Thread safe print function, records are handed to the background log writer"""
+    _log.info(*a, **b)
@@ -0,0 +1,69 @@
+import heapq
+import itertools
+import threading
+import time
+
+from helpers.log import get_logger
+
+timer_log = get_logger('timers')
+
+
+class TimerHeap:
+    """Keyed one-shot timers on a single thread.
+
+    Rescheduling a key is O(log n): the new entry is pushed and the stale one is
+    skipped when it reaches the top of the heap, so nothing ever scans all timers.
+    """
+
+    def __init__(self, name='timers'):
+        self.heap = []
+        self.generations = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def schedule(self, key, delay, callback):
+        """(Re)arm the timer for `key`, `callback(key)` runs `delay` seconds from now"""
+        with self.condition:
+            generation = next(self.counter)
+            self.generations[key] = generation
+            heapq.heappush(self.heap, (time.monotonic() + delay, generation, key, callback))
+            if self.heap[0][1] == generation:
+                self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            self.generations.pop(key, None)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    deadline, generation, key, callback = self.heap[0]
+                    if self.generations.get(key) != generation:
+                        heapq.heappop(self.heap)
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        heapq.heappop(self.heap)
+                        del self.generations[key]
+                        break
+                    self.condition.wait(remaining)
+                if self.stopped:
+                    return
+            try:
+                callback(key)
+            except Exception as e:
+                timer_log.exception("Timer callback for %s failed: %s", key, e)
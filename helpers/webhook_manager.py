@@ -1,19 +1,25 @@
 import time
-from helpers.safe_print import s_print
+from helpers.log import get_logger
 from webhooks import webhook
 from webhooks.senders import targeted
 
 
+webhook_log = get_logger('webhook')
+
+
 class WebHookManager:
     def __init__(self, config):
         self.config = config
 
+    def configure(self, config):
+        self.config = config
+
     ### REGISTRATION RECEIVED ###
 
     def registration_received(self, ip, friendly_name, hostname, serial_number, registration):
         r = self.__registration(ip, friendly_name, hostname, serial_number, registration, time.time(),
                               url=self.config['RegistrationWebHookUrl'], encoding="application/json", timeout=5)
-        s_print(str(r))
+        webhook_log.info("%s", r, serial=serial_number)
 
     @webhook(sender_callable=targeted.sender)
     def __registration(self, ip, friendly_name, hostname, serial_number, registration, _time, url, encoding, timeout):
@@ -24,18 +30,40 @@ class WebHookManager:
     def status_received(self, ip, friendly_name, hostname, serial_number, status):
         r = self.__status(ip, friendly_name, hostname, serial_number, status, time.time(),
                         url=self.config['StatusUpdateWebHookUrl'], encoding="application/json", timeout=5)
-        s_print(str(r))
+        webhook_log.info("%s", r, serial=serial_number)
 
     @webhook(sender_callable=targeted.sender)
     def __status(self, ip, friendly_name, hostname, serial_number, status, _time, url, encoding, timeout):
         return {"ip": ip, "friendly_name": friendly_name, "hostname": hostname, "serial_number": serial_number, "status": status, "time": _time}
 
+    ### STATUS CHANGED (DELTA) ###
+
+    def status_delta_received(self, ip, friendly_name, hostname, serial_number, delta, changed):
+        r = self.__status_delta(ip, friendly_name, hostname, serial_number, delta, changed, time.time(),
+                              url=self.config['StatusUpdateWebHookUrl'], encoding="application/json", timeout=5)
+        webhook_log.info("%s", r, serial=serial_number)
+
+    @webhook(sender_callable=targeted.sender)
+    def __status_delta(self, ip, friendly_name, hostname, serial_number, delta, changed, _time, url, encoding, timeout):
+        return {"ip": ip, "friendly_name": friendly_name, "hostname": hostname, "serial_number": serial_number, "status": delta, "changed": changed, "delta": True, "time": _time}
+
+    ### PRESENCE CHANGED ###
+
+    def presence_changed(self, ip, friendly_name, hostname, serial_number, online, last_seen):
+        r = self.__presence(ip, friendly_name, hostname, serial_number, online, last_seen, time.time(),
+                            url=self.config['PresenceWebHookUrl'], encoding="application/json", timeout=5)
+        webhook_log.info("%s", r, serial=serial_number)
+
+    @webhook(sender_callable=targeted.sender)
+    def __presence(self, ip, friendly_name, hostname, serial_number, online, last_seen, _time, url, encoding, timeout):
+        return {"ip": ip, "friendly_name": friendly_name, "hostname": hostname, "serial_number": serial_number, "online": online, "last_seen": last_seen, "time": _time}
+
     ### MOTION DETECTED ###
 
     def motion_detected(self, ip, friendly_name, hostname, serial_number, zone, file_name):
         r = self.__motion(ip, friendly_name, hostname, serial_number, zone, file_name, time.time(),
                         url=self.config['MotionRecordingWebHookUrl'], encoding="application/json", timeout=5)
-        s_print(str(r))
+        webhook_log.info("%s", r, serial=serial_number)
 
     @webhook(sender_callable=targeted.sender)
     def __motion(self, ip, friendly_name, hostname, serial_number, zone, file_name, _time, url, encoding, timeout):
@@ -46,7 +74,7 @@ class WebHookManager:
     def motion_timeout(self, ip, friendly_name, hostname, serial_number):
         r = self.__motion_timeout(ip, friendly_name, hostname, serial_number, time.time(),
                         url=self.config['MotionTimeoutWebHookUrl'], encoding="application/json", timeout=5)
-        s_print(str(r))
+        webhook_log.info("%s", r, serial=serial_number)
 
     @webhook(sender_callable=targeted.sender)
     def __motion_timeout(self, ip, friendly_name, hostname, serial_number, _time, url, encoding, timeout):
@@ -57,7 +85,7 @@ class WebHookManager:
     def button_pressed(self, ip, friendly_name, hostname, serial_number, triggered):
         r = self.__button_press(ip, friendly_name, hostname, serial_number, triggered, time.time(),
                               url=self.config['ButtonPressWebHookUrl'], encoding="application/json", timeout=5)
-        s_print(str(r))
+        webhook_log.info("%s", r, serial=serial_number)
 
     @webhook(sender_callable=targeted.sender)
     def __button_press(self, ip, friendly_name, hostname, serial_number, triggered, _time, url, encoding, timeout):
@@ -1,21 +1,33 @@
-import select
-import socket
+import signal
 import threading
-import sqlite3
-import yaml
-import copy
+import time
 import json
 import os
 from datetime import datetime
 
-from arlo.messages import Message
-from arlo.socket import ArloSocket
-import arlo.messages
-from helpers.safe_print import s_print
+from helpers.log import get_logger, configure_logging, stop_logging
+from helpers.config import config_manager
 from helpers.webhook_manager import WebHookManager
 import api.api
+from api.jobs import job_manager
 from arlo.device_db import DeviceDB
+from arlo.migrations import migrate
 from arlo.device_factory import DeviceFactory
+from arlo.status_delta import StatusTracker
+from arlo.telemetry import telemetry_store
+from arlo.presence import presence_tracker
+from arlo.status_poller import status_poller
+from arlo.registration_queue import registration_queue
+from arlo.applied_config import applied_config
+from arlo.command_queue import command_queues, CommandQueueFull
+from arlo.activity_zones import zone_analytics
+from arlo.event_log import event_log
+from arlo.rtsp_relay import rtsp_relay
+from arlo.doorbell_audio import doorbell_audio, CallError
+from arlo.audio_doorbell import AudioDoorbell
+from arlo.stream_leases import stream_leases
+from arlo.adaptive_quality import adaptive_quality
+from arlo.listeners import ServerThread, ListenerWorkers, connection_pool
 
 # Setup database path - use /data for Home Assistant addon, current directory otherwise
 DB_PATH = os.getenv('DB_PATH', '/data/arlo.db')
@@ -38,193 +50,252 @@ config = None
 if config is None:
     # Fallback to arlo.yaml for non-addon usage
     try:
-        with open(r'arlo.yaml') as file:
-            config = yaml.load(file, Loader=yaml.FullLoader)
-            print("[INFO] Loaded configuration from arlo.yaml")
+        config = config_manager.load(r'arlo.yaml')
+        print("[INFO] Loaded configuration from arlo.yaml")
     except Exception as e:
         print(f"[ERROR] Failed to load configuration: {e}")
         raise
 
+configure_logging(config)
 webhook_manager = WebHookManager(config)
 
-with sqlite3.connect(DB_PATH) as conn:
-    c = conn.cursor()
-    tables = c.execute("SELECT tbl_name FROM sqlite_schema WHERE type='table' AND tbl_name='camera'").fetchall()
-    if tables != []:
-        c.execute('DROP INDEX IF EXISTS idx_device_serialnumber')
-        c.execute('DROP INDEX IF EXISTS idx_device_ip')
-        c.execute('DROP INDEX IF EXISTS idx_device_friendlyname')
-        c.execute('DROP INDEX IF EXISTS idx_device_hostname')
-        c.execute('ALTER TABLE camera RENAME TO devices')
-
-    c.execute("CREATE TABLE IF NOT EXISTS devices (ip text, serialnumber text, hostname text, status text, register_set text, friendlyname text, registered integer DEFAULT 0, last_seen text)")
-    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_serialnumber ON devices (serialnumber)")
-    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_ip ON devices (ip)")
-    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_friendlyname ON devices (friendlyname)")
-    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_hostname ON devices (hostname)")
-    
-    # Add 'registered' and 'last_seen' columns if they don't exist (migration for existing databases)
-    c.execute("PRAGMA table_info(devices)")
-    columns = [col[1] for col in c.fetchall()]
-    if 'registered' not in columns:
-        c.execute("ALTER TABLE devices ADD COLUMN registered integer DEFAULT 0")
-    if 'last_seen' not in columns:
-        c.execute("ALTER TABLE devices ADD COLUMN last_seen text")
-    
-    # Reset all devices to registered=0 on startup
-    # This allows seeing which devices re-register after a reboot
-    print("[DB] Resetting all devices to registered=0 for reboot detection")
-    c.execute("UPDATE devices SET registered = 0")
-    conn.commit()
-
-
-WIFI_COUNTRY_CODE = config.get('WifiCountryCode', "US")
-VIDEO_ANTI_FLICKER_RATE = config.get('VideoAntiFlickerRate', 60)
-VIDEO_QUALITY_DEFAULT = config.get('VideoQualityDefault', 'default')
-NOTIFY_ON_MOTION_ALERT = config.get('NotifyOnMotionAlert', True)
-NOTIFY_ON_MOTION_TIMEOUT_ALERT = config.get('NotifyOnMotionTimeoutAlert', False)
-NOTIFY_ON_AUDIO_ALERT = config.get('NotifyOnAudioAlert', False)
-NOTIFY_ON_BUTTON_PRESS_ALERT = config.get('NotifyOnButtonPressAlert', True)
-NOTIFY_REGISTERD_AND_STATUS_UPDATE = config.get('NotifyRegisteredAndStatusUpdate', True)
-DEVICE_SETTINGS = config.get('DeviceSettings', {})
-
-
-class ConnectionThread(threading.Thread):
-    def __init__(self, connection, ip, port):
-        threading.Thread.__init__(self)
-        self.connection = ArloSocket(connection)
-        self.ip = ip
-        self.port = port
-
-    def run(self):
-        while True:
-            msg = self.connection.receive()
-            if msg != None:
-                ack = Message(copy.deepcopy(arlo.messages.RESPONSE))
-                ack['ID'] = msg['ID']
-                s_print(f">[{self.ip}][{msg['ID']}] Ack")
-                self.connection.send(ack)
-
-                if (msg['Type'] == "registration"):
-                    device = DeviceDB.from_db_serial(msg['SystemSerialNumber'])
-                    if device is None:
-                        device = DeviceFactory.createDevice(self.ip, msg)
-                    else:
-                        device.ip = self.ip
-                        device.registration = msg
-                    
-                    # Get device-specific settings from config
-                    device_settings = DEVICE_SETTINGS.get(msg['SystemSerialNumber'])
-                    
-                    # Apply FriendlyName if provided in device settings
-                    if device_settings and isinstance(device_settings, dict):
-                        friendly_name = device_settings.get('FriendlyName')
-                        if friendly_name:
-                            device.friendly_name = friendly_name
-                    
-                    # Mark device as registered and update last_seen timestamp
-                    device.registered = 1
-                    device.last_seen = datetime.now().isoformat()
-                    
-                    DeviceDB.persist(device)
-                    s_print(f"<[{self.ip}][{msg['ID']}] Registration from {msg['SystemSerialNumber']} - {device.hostname}")
-
-                    device.send_initial_register_set(WIFI_COUNTRY_CODE, VIDEO_ANTI_FLICKER_RATE, VIDEO_QUALITY_DEFAULT, device_settings)
-                    if NOTIFY_REGISTERD_AND_STATUS_UPDATE:
-                        webhook_manager.registration_received(
-                            device.ip, device.friendly_name, device.hostname, device.serial_number, device.registration)
-                elif (msg['Type'] == "status"):
-                    s_print(f"<[{self.ip}][{msg['ID']}] Status from {msg['SystemSerialNumber']}")
-                    device = DeviceDB.from_db_serial(msg['SystemSerialNumber'])
-                    device.ip = self.ip
-                    device.status = msg
-                    DeviceDB.persist(device)
-                    if NOTIFY_REGISTERD_AND_STATUS_UPDATE:
-                        webhook_manager.status_received(device.ip, device.friendly_name,
-                                                        device.hostname, device.serial_number, device.status)
-                    device.send_epoch_bs_time()
-                elif (msg['Type'] == "alert"):
-                    device = DeviceDB.from_db_ip(self.ip)
-                    alert_type = msg['AlertType']
-                    s_print(f"<[{self.ip}][{msg['ID']}] {msg['AlertType']}")
-                    if alert_type == "pirMotionAlert" :
-                        if NOTIFY_ON_MOTION_ALERT:
-                            webhook_manager.motion_detected(
-                                device.ip, device.friendly_name, device.hostname, device.serial_number,
-                                msg['PIRMotion'].get('zones', []),
-                                "")
-                    elif alert_type == "audioAlert":
-                        if NOTIFY_ON_AUDIO_ALERT:
-                            # TODO: implement this
-                            ...
-                    elif alert_type == "buttonPressAlert":
-                        if NOTIFY_ON_BUTTON_PRESS_ALERT:
-                            webhook_manager.button_pressed(
-                                device.ip, device.friendly_name, device.hostname, device.serial_number,
-                                msg['ButtonPress']['Triggered'])
-                    elif alert_type == "motionTimeoutAlert":
-                        if NOTIFY_ON_MOTION_TIMEOUT_ALERT:
-                            webhook_manager.motion_timeout(
-                                device.ip, device.friendly_name, device.hostname, device.serial_number)
-                    else:
-                        s_print(f"<[{self.ip}][{msg['ID']}] Unknown alert type")
-                        s_print(msg)
-                elif (msg['Type'] == "logMessage"):
-                    s_print(f"<[{self.ip}][{msg['ID']}] {msg['LogString']}")
-                else:
-                    s_print(f"<[{self.ip}][{msg['ID']}] Unknown message")
-                    s_print(msg)
-                self.connection.close()
-                break
-
-
-class ServerThread(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-
-    def run(self):
-        threads = []
-        servers = []
-
-        for port in [4000, 4100]:
-            server_address = ('', port)
-            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            server.bind(server_address)
-            server.listen(12)
-            servers.append(server)
-
-        while True:
-            try:
-                # Wait for any of the listening servers to get a client
-                # connection attempt
-                readable, _, _ = select.select(servers, [], [])
-                ready_server = readable[0]
-
-                connection, (ip, port) = ready_server.accept()
-
-                new_thread = ConnectionThread(connection, ip, port)
-                threads.append(new_thread)
-                new_thread.start()
-            except KeyboardInterrupt:
-                break
-            except Exception as e:
-                print(e)
-
-        for t in threads:
-            t.join()
-
-
-server_thread = ServerThread()
+# Apply pending schema migrations and start a new boot generation. Devices count as
+# registered again once they register during this boot, nothing is reset row by row.
+DeviceDB.boot = migrate(DB_PATH)
+
+
+status_tracker = StatusTracker()
+
+
+def apply_config(config):
+    """Reconfigure every subsystem, called at startup and whenever arlo.yaml changes"""
+    configure_logging(config)
+    webhook_manager.configure(config)
+    status_tracker.configure(config)
+    telemetry_store.configure(config)
+    presence_tracker.configure(config)
+    status_poller.configure(config)
+    registration_queue.configure(config)
+    applied_config.configure(config)
+    command_queues.configure(config)
+    job_manager.configure(config)
+    zone_analytics.configure(config)
+    event_log.configure(config)
+    rtsp_relay.configure(config)
+    doorbell_audio.configure(config)
+    stream_leases.configure(config)
+    adaptive_quality.configure(config)
+    connection_pool.configure(config)
+
+
+config_manager.subscribe(apply_config)
+
+
+def presence_changed(presence, online):
+    last_seen = presence.to_dict()['last_seen']
+    DeviceDB.update_last_seen(presence.serial, last_seen)
+    if config_manager.snapshot.notify_on_presence_change:
+        device = DeviceDB.from_db_serial(presence.serial)
+        if device is not None:
+            webhook_manager.presence_changed(device.ip, device.friendly_name, device.hostname,
+                                             device.serial_number, online, last_seen)
+
+
+presence_tracker.add_listener(presence_changed)
+
+
+frame_log = get_logger('frame')
+server_log = get_logger('server')
+
+DEFAULT_SHUTDOWN_TIMEOUT = 10
+
+
+def answer_doorbell(device):
+    try:
+        doorbell_audio.call(device)
+    except CallError:
+        pass
+
+
+def handle_frame(ip, msg):
+    """Dispatch one acked frame from the device at `ip`"""
+    # One snapshot for the whole frame, a reload meanwhile does not mix two versions
+    config = config_manager.snapshot
+    presence_tracker.touch(msg.peek('SystemSerialNumber'), ip)
+
+    if (msg['Type'] == "registration"):
+        device = DeviceDB.from_db_serial(msg['SystemSerialNumber'])
+        if device is None:
+            device = DeviceFactory.createDevice(ip, msg)
+        else:
+            device.ip = ip
+            device.registration = msg
+
+        # Device-specific settings, resolved when the config was loaded
+        profile = config.profile(msg['SystemSerialNumber'])
+
+        # Apply FriendlyName if provided in device settings
+        if profile.friendly_name:
+            device.friendly_name = profile.friendly_name
+
+        # Mark device as registered and update last_seen timestamp
+        device.registered = 1
+        device.last_seen = datetime.now().isoformat()
+
+        DeviceDB.persist(device)
+        telemetry_store.record(device.serial_number, msg)
+        adaptive_quality.registered(device.serial_number)
+        status_poller.add(device.serial_number)
+        frame_log.info("Registration from %s", device.hostname,
+                       ip=ip, serial=device.serial_number, msg_id=msg['ID'], type=msg['Type'])
+
+        # The initial configuration is queued so a fleet re-registering at once is configured a few at a time
+        def configure(device=device, profile=profile, config=config):
+            steps = device.initial_config(profile)
+            applied_config.apply(device, steps)
+            if config.notify_registered_and_status_update:
+                webhook_manager.registration_received(
+                    device.ip, device.friendly_name, device.hostname, device.serial_number, device.registration)
+
+        registration_queue.submit(device.serial_number, configure)
+    elif (msg['Type'] == "status"):
+        frame_log.info("Status", ip=ip, serial=msg['SystemSerialNumber'], msg_id=msg['ID'], type=msg['Type'])
+        device = DeviceDB.from_db_serial(msg['SystemSerialNumber'])
+        status_poller.status_received(device.serial_number)
+        change = status_tracker.update(device.serial_number, device.status, msg)
+        telemetry_store.record(device.serial_number, msg)
+        ip_changed = device.ip != ip
+        device.ip = ip
+        device.status = msg
+        if change.persist or ip_changed:
+            DeviceDB.update_status(device)
+        adaptive_quality.observe(device, msg.dictionary, config.profile(device.serial_number))
+        if config.notify_registered_and_status_update and change.notify:
+            if config.status_webhook_payload == 'delta':
+                webhook_manager.status_delta_received(device.ip, device.friendly_name, device.hostname,
+                                                      device.serial_number, change.delta(), list(change.changed))
+            else:
+                webhook_manager.status_received(device.ip, device.friendly_name,
+                                                device.hostname, device.serial_number, device.status)
+        # Queued without waiting, a listener thread must not sit behind the device's other commands
+        try:
+            device.send_epoch_bs_time()
+        except CommandQueueFull:
+            # Counted and logged already, the next status sends the time again
+            pass
+    elif (msg['Type'] == "alert"):
+        device = DeviceDB.from_db_ip(ip)
+        presence_tracker.touch(device.serial_number, ip)
+        alert_type = msg['AlertType']
+        frame_log.info(alert_type, ip=ip, serial=device.serial_number, msg_id=msg['ID'], type=msg['Type'])
+        event_log.record(device.serial_number, msg)
+        if alert_type == "pirMotionAlert" :
+            zone_analytics.record(device.serial_number, msg['PIRMotion'])
+            if config.notify_on_motion_alert:
+                webhook_manager.motion_detected(
+                    device.ip, device.friendly_name, device.hostname, device.serial_number,
+                    msg['PIRMotion'].get('zones', []),
+                    "")
+        elif alert_type == "audioAlert":
+            if config.notify_on_audio_alert:
+                # TODO: implement this
+                ...
+        elif alert_type == "buttonPressAlert":
+            if doorbell_audio.call_on_button_press and isinstance(device, AudioDoorbell):
+                # Calling waits for the doorbell's answers, this thread keeps reading frames
+                threading.Thread(target=answer_doorbell, args=(device,), daemon=True).start()
+            if config.notify_on_button_press_alert:
+                webhook_manager.button_pressed(
+                    device.ip, device.friendly_name, device.hostname, device.serial_number,
+                    msg['ButtonPress']['Triggered'])
+        elif alert_type == "motionTimeoutAlert":
+            if config.notify_on_motion_timeout_alert:
+                webhook_manager.motion_timeout(
+                    device.ip, device.friendly_name, device.hostname, device.serial_number)
+        else:
+            frame_log.warning("Unknown alert type: %r", msg, ip=ip, msg_id=msg['ID'])
+    elif (msg['Type'] == "rtpBye"):
+        # The doorbell hung up
+        device = DeviceDB.from_db_ip(ip)
+        frame_log.info("rtpBye %r", msg.peek('Streams'), ip=ip, msg_id=msg['ID'], type=msg['Type'])
+        if device is not None:
+            doorbell_audio.hang_up(device.serial_number, 'doorbell', notify=False)
+    elif (msg['Type'] == "logMessage"):
+        frame_log.info("%s", msg['LogString'], ip=ip, msg_id=msg['ID'], type=msg['Type'])
+    else:
+        frame_log.warning("Unknown message: %r", msg, ip=ip, msg_id=msg['ID'], type=msg['Type'])
+
+
+def shutdown(signum, frame):
+    """SIGTERM/SIGINT: stop accepting, let the frames and webhooks in progress finish within
+    ShutdownTimeout seconds, write out what is buffered, close the database and exit"""
+    if shutdown.started:
+        # A second signal does not wait any longer
+        os._exit(1)
+    shutdown.started = True
+    deadline = time.monotonic() + config_manager.snapshot.get('ShutdownTimeout', DEFAULT_SHUTDOWN_TIMEOUT)
+
+    def remaining():
+        return max(deadline - time.monotonic(), 0)
+
+    server_log.info("%s received, shutting down", signal.Signals(signum).name)
+    config_manager.stop()
+    status_poller.stop()
+    job_manager.stop()
+    stream_leases.stop()
+    drained = server_thread.stop(remaining())
+    # Registration webhooks go out at the end of the initial configuration, presence ones from the presence thread
+    drained = registration_queue.stop(remaining()) and drained
+    drained = presence_tracker.stop(remaining()) and drained
+    if not drained:
+        server_log.warning("Shutdown timeout reached with frames or webhooks still in progress")
+    # Both give up on cameras that do not answer once the timeout is used up
+    rtsp_relay.stop(remaining())
+    doorbell_audio.stop(remaining())
+    for subsystem in (telemetry_store, zone_analytics, event_log):
+        try:
+            subsystem.stop()
+        except Exception as e:
+            server_log.error("Flushing %s failed: %s", type(subsystem).__name__, e)
+    DeviceDB.close()
+    server_log.info("Shutdown complete")
+    stop_logging()
+    # Everything is flushed, the daemon threads left have nothing worth waiting for
+    os._exit(0)
+
+
+shutdown.started = False
+
+
+# ListenerWorkers > 0 moves accepting and acking into that many processes, read at startup only
+listener_workers = int(config.get('ListenerWorkers', 0) or 0)
+if listener_workers > 0:
+    server_thread = ListenerWorkers(handle_frame, listener_workers, config)
+else:
+    server_thread = ServerThread(handle_frame)
 print("\n" + "="*60)
 print("[STARTUP] Loading devices from database...")
 print("="*60)
-persisted_devices = DeviceDB.load_all_devices()
+persisted_devices = DeviceDB.list_summaries()
 print(f"[STARTUP] Found {len(persisted_devices)} device(s) in database:")
-for device in persisted_devices:
-    print(f"  - Serial: {device.serial_number}, Hostname: {device.hostname}, IP: {device.ip}, Friendly Name: {device.friendly_name}")
+for (serial_number, hostname, ip, friendly_name) in persisted_devices:
+    print(f"  - Serial: {serial_number}, Hostname: {hostname}, IP: {ip}, Friendly Name: {friendly_name}")
 print("="*60 + "\n")
+telemetry_store.start()
+zone_analytics.start()
+event_log.start()
+rtsp_relay.start()
+doorbell_audio.start()
+stream_leases.start()
+adaptive_quality.start()
+presence_tracker.start()
+status_poller.start()
+registration_queue.start()
+job_manager.start()
+config_manager.start()
 server_thread.start()
+signal.signal(signal.SIGTERM, shutdown)
+signal.signal(signal.SIGINT, shutdown)
 flask_thread = api.api.get_thread()
 server_thread.join()
 flask_thread.join()
@@ -0,0 +1,93 @@
+"""Event history queries on a large table: keyset pages against OFFSET pages.
+
+Fills a scratch database with alert events spread over many cameras and days, written
+through EventLog in batches, then times "all motion on one camera last night" and paging
+deep into one camera's history.
+
+    python tools/bench_events.py --events 1000000
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+WORKDIR = tempfile.mkdtemp(prefix='bench_events_')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'arlo.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arlo.messages  # noqa: E402
+from arlo.device_db import DB_PATH  # noqa: E402
+from arlo.event_log import EventLog  # noqa: E402
+from arlo.messages import Message  # noqa: E402
+from arlo.migrations import migrate  # noqa: E402
+from helpers.log import configure_logging  # noqa: E402
+
+ALERTS = [arlo.messages.ALERT, arlo.messages.ALERT_ZONE, arlo.messages.ALERT_TIMEOUT, arlo.messages.AUDIO_DOORBELL_BUTTON_PRESS]
+
+
+def fill(event_log, events, cameras, days, now):
+    random.seed(1)
+    started = time.perf_counter()
+    for _ in range(events):
+        serial = f"5{random.randrange(cameras):012d}"
+        event_log.record(serial, Message(dict(random.choice(ALERTS))), now - random.random() * days * 86400)
+        if len(event_log.pending) >= event_log.batch_size:
+            event_log.flush()
+    event_log.flush()
+    return time.perf_counter() - started
+
+
+def timed(function, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def offset_page(serial, offset, limit):
+    with sqlite3.connect(DB_PATH) as conn:
+        return conn.execute("SELECT id, serialnumber, type, time, data FROM events WHERE serialnumber = ? "
+                            "ORDER BY time DESC, id DESC LIMIT ? OFFSET ?", (serial, limit, offset)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--cameras', type=int, default=50)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    configure_logging({'LogLevel': 'WARNING'})
+
+    try:
+        migrate(DB_PATH)
+        event_log = EventLog()
+        now = time.time()
+        seconds = fill(event_log, args.events, args.cameras, args.days, now)
+        print(f"{args.events} events, {args.cameras} cameras, {args.days} days")
+        print(f"  {'batched insert:':34} {args.events / seconds:10.0f} events/s")
+
+        serial = f"5{0:012d}"
+        night_end = now - now % 86400 + 6 * 3600 - 86400
+        last_night = lambda: event_log.query(serial, ['motion'], night_end - 8 * 3600, night_end, limit=1000)
+        print(f"  {'motion on one camera last night:':34} {timed(last_night, args.runs):10.2f} ms")
+
+        depth = args.events // args.cameras // 2
+        cursor = None
+        for _ in range(depth // 100):
+            cursor = event_log.query(serial, cursor=cursor, limit=100)['next_cursor']
+        print(f"  {f'page at row {depth}, keyset:':34} {timed(lambda: event_log.query(serial, cursor=cursor, limit=100), args.runs):10.2f} ms")
+        print(f"  {f'page at row {depth}, OFFSET:':34} {timed(lambda: offset_page(serial, depth, 100), args.runs):10.2f} ms")
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Per-frame latency with one connection per frame against several frames per connection.
+
+A simulated fleet of cameras, spread over client processes, delivers bursts of frames
+(a status followed by alerts) to the listeners in this process. Each frame's latency runs
+from the moment the camera has it ready until its ack arrives. Every new connection costs
+`--handshake` seconds on top, standing in for the TCP handshake over Wi-Fi, which loopback
+does not have.
+
+    python tools/bench_frame_latency.py --cameras 100 --burst 3 --handshake 0.01
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arlo.messages  # noqa: E402
+from arlo.listeners import ServerThread, connection_pool  # noqa: E402
+from arlo.messages import Message  # noqa: E402
+from helpers.log import configure_logging  # noqa: E402
+
+
+def burst_frames(serial, burst, first_id):
+    frames = []
+    for index in range(burst):
+        message = dict(arlo.messages.STATUS if index == 0 else arlo.messages.ALERT)
+        message['SystemSerialNumber'] = serial
+        message['ID'] = first_id + index
+        frames.append(Message(message).toNetworkMessage())
+    return frames
+
+
+def read_ack(sock, pending):
+    pending += sock.recv(1024)
+    end = pending.find(b'}')
+    while end < 0:
+        chunk = sock.recv(1024)
+        if not chunk:
+            raise ConnectionError("closed before the ack")
+        pending += chunk
+        end = pending.find(b'}')
+    return pending[end + 1:]
+
+
+def open_connection(port, handshake):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    time.sleep(handshake)
+    return sock
+
+
+def fleet(client, cameras, port, args, reuse, started):
+    """One client process: its cameras deliver bursts until the run is over, returns the latencies"""
+    random.seed(client)
+    latencies = []
+    message_id = 0
+    while time.time() < started:
+        time.sleep(0.001)
+    while time.time() - started < args.duration:
+        frames = burst_frames(f"SIM{random.choice(cameras):09d}", args.burst, message_id)
+        message_id += args.burst
+        ready = time.perf_counter()
+        sock = None
+        try:
+            for frame in frames:
+                if sock is None:
+                    sock = open_connection(port, args.handshake)
+                    pending = b''
+                sock.sendall(frame)
+                pending = read_ack(sock, pending)
+                latencies.append(time.perf_counter() - ready)
+                if not reuse:
+                    sock.close()
+                    sock = None
+        except OSError:
+            pass
+        finally:
+            if sock is not None:
+                sock.close()
+        time.sleep(args.pause)
+    return latencies
+
+
+def run(args, label, port, reuse):
+    share = [range(client, args.cameras, args.clients) for client in range(args.clients)]
+    started = time.time() + 0.5
+    with multiprocessing.get_context('spawn').Pool(args.clients) as pool:
+        results = pool.starmap(fleet, [(client, share[client], port, args, reuse, started)
+                                       for client in range(args.clients)])
+    latencies = sorted(latency for result in results for latency in result)
+    if not latencies:
+        print(f"{label:>22}: no frames acked")
+        return
+    print(f"{label:>22}: {len(latencies):7d} frames, latency p50 {statistics.median(latencies) * 1000:7.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms, "
+          f"mean {statistics.fmean(latencies) * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cameras', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=4, help='client processes the fleet is spread over')
+    parser.add_argument('--burst', type=int, default=3, help='frames a camera has to deliver at once')
+    parser.add_argument('--handshake', type=float, default=0.01, help='seconds added to every new connection')
+    parser.add_argument('--pause', type=float, default=0.01, help='seconds between the bursts of a client')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--port', type=int, default=16000)
+    args = parser.parse_args()
+    # The whole fleet connects from 127.0.0.1, so no per-IP limits
+    config = {'LogLevel': 'WARNING', 'ListenerMaxPerIP': 0, 'ListenerRatePerIP': 0}
+    configure_logging(config)
+    connection_pool.configure(config)
+
+    handled = 0
+    lock = threading.Lock()
+
+    def handle(ip, msg):
+        nonlocal handled
+        with lock:
+            handled += 1
+
+    server = ServerThread(handle, (args.port,))
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+    print(f"{args.cameras} cameras over {args.clients} client process(es), bursts of {args.burst}, "
+          f"{args.handshake * 1000:.0f} ms per handshake")
+    run(args, 'connection per frame', args.port, reuse=False)
+    run(args, 'connection per burst', args.port, reuse=True)
+    server.stop(5)
+    print(f"{handled} frames handled")
+
+
+if __name__ == '__main__':
+    main()
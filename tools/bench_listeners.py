@@ -0,0 +1,159 @@
+"""Inbound frame throughput of the listeners in this process against 1, 2 and 4 ListenerWorkers.
+
+A simulated fleet of cameras, spread over client processes, sends status frames, one
+connection each like the cameras do, and waits for every ack. Frames are handled like a
+status report: the body is decoded and the status is written to a scratch database in
+WAL mode. Prints acked frames per second, the ack latency and the frames handled.
+
+    python tools/bench_listeners.py --cameras 200 --clients 4 --duration 10 --workers 1,2,4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arlo.messages  # noqa: E402
+from arlo.listeners import ListenerWorkers, ServerThread, connection_pool  # noqa: E402
+from arlo.messages import Message  # noqa: E402
+from helpers.log import configure_logging  # noqa: E402
+
+
+class Handler:
+    """Stands in for handle_frame: decode the body and persist the status"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.handled = 0
+
+    def __call__(self, ip, msg):
+        status = msg.dictionary
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("UPDATE devices SET status = ? WHERE serialnumber = ?",
+                             (json.dumps(status), status['SystemSerialNumber']))
+            self.handled += 1
+
+
+def create_db(path, cameras):
+    with sqlite3.connect(path) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE devices (serialnumber text PRIMARY KEY, status text)")
+        conn.executemany("INSERT INTO devices VALUES (?, NULL)", [(serial(i),) for i in range(cameras)])
+
+
+def serial(index):
+    return f"SIM{index:09d}"
+
+
+def exchange(port, frame):
+    with socket.create_connection(('127.0.0.1', port), timeout=10) as sock:
+        sock.sendall(frame)
+        reply = b''
+        while not reply.endswith(b'}'):
+            chunk = sock.recv(1024)
+            if not chunk:
+                raise ConnectionError("closed before the ack")
+            reply += chunk
+
+
+def fleet(client, cameras, ports, duration, started):
+    """One client process: its share of the cameras send status frames until `duration` is over"""
+    random.seed(client)
+    frames = []
+    for index in cameras:
+        status = dict(arlo.messages.STATUS)
+        status['SystemSerialNumber'] = serial(index)
+        frames.append(status)
+    latencies = []
+    errors = 0
+    message_id = 0
+    while time.time() < started:
+        time.sleep(0.001)
+    while time.time() - started < duration:
+        status = random.choice(frames)
+        message_id += 1
+        status['ID'] = message_id
+        frame = Message(status).toNetworkMessage()
+        sent = time.perf_counter()
+        try:
+            exchange(random.choice(ports), frame)
+        except OSError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - sent)
+    return latencies, errors
+
+
+def drive(args, ports):
+    share = [range(client, args.cameras, args.clients) for client in range(args.clients)]
+    started = time.time() + 0.5
+    with multiprocessing.get_context('spawn').Pool(args.clients) as pool:
+        results = pool.starmap(fleet, [(client, share[client], ports, args.duration, started)
+                                       for client in range(args.clients)])
+    latencies = sorted(latency for result, _ in results for latency in result)
+    return latencies, sum(errors for _, errors in results)
+
+
+def run(args, label, listeners, ports, handler):
+    listeners.daemon = True
+    listeners.start()
+    time.sleep(args.warmup)
+    before = handler.handled
+    started = time.perf_counter()
+    latencies, errors = drive(args, ports)
+    # Acked frames may still be waiting for the handler, the run ends once they are all handled
+    while handler.handled - before < len(latencies) and time.perf_counter() - started < args.duration * 10:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    if isinstance(listeners, ListenerWorkers):
+        listeners.stop()
+    print(f"{label:>12}: {len(latencies) / args.duration:8.0f} acks/s, "
+          f"ack p50 {statistics.median(latencies) * 1000 if latencies else 0:6.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0:7.2f} ms, "
+          f"{(handler.handled - before) / elapsed:8.0f} handled/s, {errors} error(s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cameras', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=4, help='client processes the fleet is spread over')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--workers', default='1,2,4', help='ListenerWorkers counts to compare')
+    parser.add_argument('--port', type=int, default=14000, help='first listening port, two per run')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds for the listeners to start')
+    args = parser.parse_args()
+    # The whole fleet connects from 127.0.0.1, so no per-IP limits
+    config = {'LogLevel': 'WARNING', 'ListenerMaxPerIP': 0, 'ListenerRatePerIP': 0}
+    configure_logging(config)
+    connection_pool.configure(config)
+
+    workdir = tempfile.mkdtemp(prefix='bench_listeners_')
+    try:
+        db_path = os.path.join(workdir, 'arlo.db')
+        create_db(db_path, args.cameras)
+        handler = Handler(db_path)
+        print(f"{args.cameras} cameras over {args.clients} client process(es), {os.cpu_count()} CPU(s)")
+
+        ports = (args.port, args.port + 1)
+        run(args, 'in-process', ServerThread(handler, ports), ports, handler)
+        for run_index, count in enumerate(int(count) for count in args.workers.split(',')):
+            ports = (args.port + 2 * (run_index + 1), args.port + 2 * (run_index + 1) + 1)
+            run(args, f'{count} worker(s)', ListenerWorkers(handler, count, config, ports), ports, handler)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Startup database work with many devices: the old per-boot routine against migrations.
+
+The old routine recreated the schema, reset `registered` on every row and parsed every
+stored device just to list it. The new one applies pending migrations, bumps the boot
+generation and lists devices from plain columns.
+
+    python tools/bench_startup.py --devices 1000
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+WORKDIR = tempfile.mkdtemp(prefix='bench_startup_')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'arlo.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arlo.messages  # noqa: E402
+from arlo.device_db import DeviceDB, DB_PATH  # noqa: E402
+from arlo.migrations import migrate  # noqa: E402
+from helpers.log import configure_logging  # noqa: E402
+
+
+def create_legacy_db(path, devices):
+    """A database as the server left it before migrations existed (user_version 0)"""
+    with sqlite3.connect(path) as conn:
+        c = conn.cursor()
+        c.execute("CREATE TABLE devices (ip text, serialnumber text, hostname text, status text, register_set text, friendlyname text, registered integer DEFAULT 0, last_seen text)")
+        c.execute("CREATE UNIQUE INDEX idx_device_serialnumber ON devices (serialnumber)")
+        c.execute("CREATE UNIQUE INDEX idx_device_ip ON devices (ip)")
+        c.execute("CREATE UNIQUE INDEX idx_device_friendlyname ON devices (friendlyname)")
+        c.execute("CREATE UNIQUE INDEX idx_device_hostname ON devices (hostname)")
+        rows = []
+        for i in range(devices):
+            serial = f"5{i:012d}"
+            registration = dict(arlo.messages.REGISTRATION, SystemSerialNumber=serial)
+            status = dict(arlo.messages.STATUS, SystemSerialNumber=serial)
+            rows.append((f"10.{i // 65536}.{i // 256 % 256}.{i % 256}", serial, f"{registration['SystemModelNumber']}-{serial[-5:]}",
+                         json.dumps(status), json.dumps(registration), f"Camera {i}", 1, None))
+        c.executemany("INSERT INTO devices VALUES (?,?,?,?,?,?,?,?)", rows)
+        conn.commit()
+
+
+def legacy_startup(path):
+    with sqlite3.connect(path) as conn:
+        c = conn.cursor()
+        c.execute("SELECT tbl_name FROM sqlite_master WHERE type='table' AND tbl_name='camera'").fetchall()
+        c.execute("CREATE TABLE IF NOT EXISTS devices (ip text, serialnumber text, hostname text, status text, register_set text, friendlyname text, registered integer DEFAULT 0, last_seen text)")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_serialnumber ON devices (serialnumber)")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_ip ON devices (ip)")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_friendlyname ON devices (friendlyname)")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_device_hostname ON devices (hostname)")
+        c.execute("PRAGMA table_info(devices)").fetchall()
+        c.execute("UPDATE devices SET registered = 0")
+        conn.commit()
+    return [device.serial_number for device in DeviceDB.load_all_devices()]
+
+
+def new_startup(path):
+    DeviceDB.boot = migrate(path)
+    return [serial for (serial, _, _, _) in DeviceDB.list_summaries()]
+
+
+def timed(function, template, runs, warm):
+    """Median milliseconds of `function` on fresh copies of `template` (warm: migrated once beforehand)"""
+    samples = []
+    for _ in range(runs):
+        shutil.copyfile(template, DB_PATH)
+        if warm:
+            function(DB_PATH)
+        started = time.perf_counter()
+        function(DB_PATH)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    configure_logging({'LogLevel': 'WARNING'})
+
+    template = os.path.join(WORKDIR, 'template.db')
+    create_legacy_db(template, args.devices)
+    try:
+        print(f"{args.devices} devices, median of {args.runs} runs")
+        for label, function, warm in (("old startup", legacy_startup, False),
+                                      ("new startup, first boot", new_startup, False),
+                                      ("new startup, later boots", new_startup, True)):
+            print(f"  {label + ':':26} {timed(function, template, args.runs, warm):8.1f} ms")
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
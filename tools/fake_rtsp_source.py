@@ -0,0 +1,199 @@
+"""A stand-in for a camera's RTSP server, to run the relay without hardware.
+
+Serves rtsp://127.0.0.1:<port>/live with one H.264 video track (and an audio track with
+--audio) of synthetic RTP packets, over UDP or interleaved TCP. Like a camera it allows a
+single session at a time and keeps sending UDP packets until it gets a TEARDOWN.
+
+    python tools/fake_rtsp_source.py --port 5554
+    # arlo.yaml: RelayEnabled: true, RelaySources: {<serial>: "rtsp://127.0.0.1:5554/live"}
+"""
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from arlo.rtsp import RtspReader, format_response, interleaved_frame, parse_transport, port_pair  # noqa: E402
+
+SDP_VIDEO = ("m=video 0 RTP/AVP 96\r\n"
+             "a=rtpmap:96 H264/90000\r\n"
+             "a=fmtp:96 packetization-mode=1\r\n"
+             "a=control:trackID=1\r\n")
+SDP_AUDIO = ("m=audio 0 RTP/AVP 97\r\n"
+             "a=rtpmap:97 MPEG4-GENERIC/16000/1\r\n"
+             "a=control:trackID=2\r\n")
+
+
+class Session:
+    def __init__(self, tracks):
+        self.id = uuid.uuid4().hex[:8].upper()
+        self.tracks = tracks
+        self.targets = {}
+        self.playing = threading.Event()
+        self.stopped = threading.Event()
+        self.packets = 0
+        self.rtcp_received = 0
+        self.last_heard = time.time()
+
+
+class FakeCamera:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.session = None
+        self.sessions = 0
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('', args.port + 1000))
+        self.udp_rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_rtcp.bind(('', args.port + 1001))
+
+    def sdp(self):
+        body = ("v=0\r\n"
+                f"o=- {int(time.time())} 1 IN IP4 127.0.0.1\r\n"
+                "s=Fake Arlo camera\r\n"
+                "t=0 0\r\n"
+                "a=control:*\r\n" + SDP_VIDEO + (SDP_AUDIO if self.args.audio else ""))
+        return body.encode()
+
+    def serve(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', self.args.port))
+        listener.listen(4)
+        threading.Thread(target=self.receive_rtcp, daemon=True).start()
+        print(f"Serving rtsp://127.0.0.1:{self.args.port}/live", flush=True)
+        while True:
+            sock, address = listener.accept()
+            threading.Thread(target=self.connection, args=(sock, address), daemon=True).start()
+
+    def receive_rtcp(self):
+        while True:
+            data, address = self.udp_rtcp.recvfrom(2048)
+            session = self.session
+            if session is not None:
+                session.rtcp_received += 1
+                session.last_heard = time.time()
+
+    def connection(self, sock, address):
+        reader = RtspReader()
+        session = None
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                reader.feed(data)
+                for item in reader.items():
+                    if item[0] == 'frame':
+                        if session is not None and item[1] % 2:
+                            session.rtcp_received += 1
+                            session.last_heard = time.time()
+                        continue
+                    session = self.handle(sock, item[1], session)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+            interleaved = session is not None and any(target[0] == 'interleaved' for target in session.targets.values())
+            if interleaved and not session.stopped.is_set():
+                # Interleaved packets have nowhere to go any more
+                self.end(session, "connection closed")
+            elif session is not None and not session.stopped.is_set():
+                print(f"Session {session.id}: connection closed without TEARDOWN, still sending", flush=True)
+
+    def handle(self, sock, request, session):
+        cseq = request.header('CSeq')
+        if session is not None:
+            session.last_heard = time.time()
+        if request.method == 'OPTIONS':
+            sock.sendall(format_response(200, cseq, {'Public': 'OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER'}))
+        elif request.method == 'DESCRIBE':
+            base = request.url.rstrip('/') + '/'
+            sock.sendall(format_response(200, cseq, {'Content-Type': 'application/sdp', 'Content-Base': base}, self.sdp()))
+        elif request.method == 'SETUP':
+            with self.lock:
+                if session is None:
+                    if self.session is not None and not self.session.stopped.is_set():
+                        sock.sendall(format_response(453, cseq))
+                        print("Refused a second session", flush=True)
+                        return None
+                    session = self.session = Session(2 if self.args.audio else 1)
+                    self.sessions += 1
+            track = 1 if request.url.rstrip('/').endswith('trackID=2') else 0
+            protocol, parameters = parse_transport(request.header('Transport', ''))
+            if protocol == 'RTP/AVP/TCP':
+                channel, _ = port_pair(parameters.get('interleaved', f"{2 * track}-{2 * track + 1}"))
+                session.targets[track] = ('interleaved', sock, channel)
+                transport = f"RTP/AVP/TCP;unicast;interleaved={channel}-{channel + 1}"
+            else:
+                client_port, _ = port_pair(parameters['client_port'])
+                session.targets[track] = ('udp', (sock.getpeername()[0], client_port))
+                transport = (f"RTP/AVP;unicast;client_port={client_port}-{client_port + 1};"
+                             f"server_port={self.args.port + 1000}-{self.args.port + 1001}")
+            sock.sendall(format_response(200, cseq, {'Transport': transport, 'Session': f"{session.id};timeout=60"}))
+        elif request.method == 'PLAY' and session is not None:
+            sock.sendall(format_response(200, cseq, {'Session': session.id, 'Range': 'npt=0.000-'}))
+            if not session.playing.is_set():
+                session.playing.set()
+                threading.Thread(target=self.send, args=(session,), daemon=True).start()
+                print(f"Session {session.id}: PLAY", flush=True)
+        elif request.method == 'TEARDOWN' and session is not None:
+            sock.sendall(format_response(200, cseq, {'Session': session.id}))
+            self.end(session, "TEARDOWN")
+        elif request.method == 'GET_PARAMETER':
+            sock.sendall(format_response(200, cseq))
+        else:
+            sock.sendall(format_response(455, cseq))
+        return session
+
+    def end(self, session, reason):
+        if session.stopped.is_set():
+            return
+        session.stopped.set()
+        print(f"Session {session.id}: ended by {reason} after {session.packets} packets, "
+              f"{session.rtcp_received} RTCP reports received", flush=True)
+
+    def send(self, session):
+        ssrc = 0x1234ABCD
+        sequence = 0
+        interval = 1 / self.args.rate
+        payload = bytes(self.args.size)
+        next_send = time.monotonic()
+        while not session.stopped.is_set():
+            if self.args.session_timeout and time.time() - session.last_heard > self.args.session_timeout:
+                self.end(session, f"no keepalive or RTCP for {self.args.session_timeout}s")
+                return
+            sequence = (sequence + 1) & 0xFFFF
+            header = struct.pack('!BBHII', 0x80, 96, sequence, int(time.monotonic() * 90000) & 0xFFFFFFFF, ssrc)
+            for target in list(session.targets.values()):
+                try:
+                    if target[0] == 'interleaved':
+                        target[1].sendall(interleaved_frame(target[2], header + payload))
+                    else:
+                        self.udp.sendto(header + payload, target[1])
+                except OSError:
+                    pass
+            session.packets += 1
+            next_send += interval
+            time.sleep(max(next_send - time.monotonic(), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=5554)
+    parser.add_argument('--rate', type=float, default=100, help="RTP packets per second")
+    parser.add_argument('--size', type=int, default=1200, help="RTP payload bytes")
+    parser.add_argument('--audio', action='store_true', help="also offer an audio track")
+    parser.add_argument('--session-timeout', type=float, default=0,
+                        help="stop sending after this many seconds without RTCP or RTSP requests, 0 never")
+    args = parser.parse_args()
+    FakeCamera(args).serve()
+
+
+if __name__ == '__main__':
+    main()
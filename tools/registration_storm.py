@@ -0,0 +1,145 @@
+"""Simulated registration storm: N cameras re-register at once after a power cut.
+
+Each camera needs a few messages pushed before it is configured. All messages share
+the Wi-Fi airtime, so every extra message in flight slows the others down; a message
+that takes longer than the camera's timeout fails and the camera registers again.
+
+Compares configuring every camera as soon as it registers (one thread each, the old
+behaviour) with the RegistrationQueue, and prints the time until all are configured.
+
+    python tools/registration_storm.py --cameras 50 --concurrency 4
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from arlo.registration_queue import RegistrationQueue  # noqa: E402
+from helpers.log import configure_logging  # noqa: E402
+from helpers.metrics import metrics  # noqa: E402
+
+
+class Airtime:
+    def __init__(self, base, capacity, timeout):
+        self.base = base
+        self.capacity = capacity
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self.sent = 0
+
+    def send(self):
+        with self.lock:
+            self.active += 1
+            self.sent += 1
+            duration = self.base * (1 + (self.active - 1) / self.capacity)
+        time.sleep(min(duration, self.timeout))
+        with self.lock:
+            self.active -= 1
+        return duration <= self.timeout
+
+
+class SimulatedCamera:
+    def __init__(self, serial, fleet):
+        self.serial = serial
+        self.fleet = fleet
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.registrations = 0
+        self.configured_at = None
+
+    def register(self):
+        with self.lock:
+            self.generation += 1
+            self.registrations += 1
+            self.configured_at = None
+            generation = self.generation
+        self.fleet.admit(self.serial, lambda: self.configure(generation))
+
+    def configure(self, generation):
+        for _ in range(self.fleet.messages):
+            if not self.fleet.airtime.send():
+                # The camera gives up on us and registers again a little later
+                self.fleet.later(self.fleet.reregister_delay, self.register)
+                return
+        with self.lock:
+            if generation == self.generation:
+                self.configured_at = time.monotonic()
+
+
+class Fleet:
+    def __init__(self, args, queue):
+        self.airtime = Airtime(args.latency, args.capacity, args.timeout)
+        self.messages = args.messages
+        self.reregister_delay = args.reregister_delay
+        self.queue = queue
+        self.cameras = [SimulatedCamera(f"SIM{i:05d}", self) for i in range(args.cameras)]
+
+    @staticmethod
+    def later(delay, function):
+        timer = threading.Timer(delay, function)
+        timer.daemon = True
+        timer.start()
+
+    def admit(self, serial, work):
+        if self.queue is None:
+            threading.Thread(target=work, daemon=True).start()
+        else:
+            self.queue.submit(serial, work)
+
+    def run(self, spread, limit):
+        started = time.monotonic()
+        for camera in self.cameras:
+            self.later(random.uniform(0, spread), camera.register)
+        while time.monotonic() - started < limit:
+            if all(camera.configured_at is not None for camera in self.cameras):
+                break
+            time.sleep(0.01)
+        done = [camera.configured_at - started for camera in self.cameras if camera.configured_at is not None]
+        return {
+            "configured": len(done),
+            "time_to_all_configured": max(done) if len(done) == len(self.cameras) else None,
+            "registrations": sum(camera.registrations for camera in self.cameras),
+            "messages_sent": self.airtime.sent,
+        }
+
+
+def queue_wait():
+    for summary in metrics.snapshot('registration_queue_wait_seconds')['summaries']:
+        return summary['value']
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cameras', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4, help='RegistrationMaxConcurrent')
+    parser.add_argument('--messages', type=int, default=4, help='messages in the initial configuration')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per message on an idle network')
+    parser.add_argument('--capacity', type=float, default=4, help='messages in flight before latency doubles')
+    parser.add_argument('--timeout', type=float, default=0.5, help='camera side message timeout')
+    parser.add_argument('--reregister-delay', type=float, default=0.5)
+    parser.add_argument('--spread', type=float, default=1.0, help='seconds over which the cameras register')
+    parser.add_argument('--limit', type=float, default=60.0, help='give up after this many seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    configure_logging({'LogLevel': 'WARNING'})
+
+    random.seed(args.seed)
+    print("unbounded:", Fleet(args, None).run(args.spread, args.limit))
+
+    random.seed(args.seed)
+    queue = RegistrationQueue(args.concurrency)
+    queue.start()
+    result = Fleet(args, queue).run(args.spread, args.limit)
+    result["queue_wait"] = queue_wait()
+    print(f"queue({args.concurrency}):", result)
+    queue.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Memory of the listeners over a long run of short camera connections.
+
+Client processes open connections to the listeners in this process as fast as they are
+acked, one frame each, alternating between both ports. Every `--samples`th of the run the
+resident memory, the thread count and the connections handled so far are printed: once
+the pool has warmed up, memory and threads stay flat however many connections went by.
+
+    python tools/soak_connections.py --connections 1000000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from arlo.listeners import ServerThread, connection_pool  # noqa: E402
+from helpers.log import configure_logging  # noqa: E402
+
+FRAME = json.dumps({"Type": "logMessage", "ID": 1, "LogString": "soak"}, separators=(',', ':'))
+
+
+def resident_kb():
+    """Current resident set size, the peak where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def connect(client, count, ports):
+    frame = f"L:{len(FRAME)} {FRAME}".encode()
+    failed = 0
+    for index in range(count):
+        try:
+            with socket.create_connection(('127.0.0.1', ports[(client + index) % 2]), timeout=10) as sock:
+                sock.sendall(frame)
+                while True:
+                    chunk = sock.recv(1024)
+                    if not chunk:
+                        # Rejected by the pool, closed without an ack
+                        raise ConnectionError("closed before the ack")
+                    if chunk.endswith(b'}'):
+                        break
+        except OSError:
+            failed += 1
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=1000000)
+    parser.add_argument('--clients', type=int, default=4, help='client processes')
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--port', type=int, default=15000, help='first of the two listening ports')
+    args = parser.parse_args()
+    # Every connection comes from 127.0.0.1, so no per-IP limits
+    config = {'LogLevel': 'WARNING', 'ListenerMaxPerIP': 0, 'ListenerRatePerIP': 0}
+    configure_logging(config)
+    connection_pool.configure(config)
+
+    handled = 0
+    lock = threading.Lock()
+
+    def handle(ip, msg):
+        nonlocal handled
+        with lock:
+            handled += 1
+
+    ports = (args.port, args.port + 1)
+    server = ServerThread(handle, ports)
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+
+    per_client = args.connections // args.clients
+    total = per_client * args.clients
+    started = time.perf_counter()
+    print(f"{'handled':>10} {'rss_kb':>8} {'threads':>7} {'conn/s':>8}")
+    print(f"{0:>10} {resident_kb():>8} {threading.active_count():>7} {'-':>8}")
+    with multiprocessing.get_context('spawn').Pool(args.clients) as pool:
+        result = pool.starmap_async(connect, [(client, per_client, ports) for client in range(args.clients)])
+        step = max(total // args.samples, 1)
+        mark = step
+        while not result.ready() or mark <= handled:
+            result.wait(0.2)
+            if handled >= mark:
+                print(f"{handled:>10} {resident_kb():>8} {threading.active_count():>7} "
+                      f"{handled / (time.perf_counter() - started):>8.0f}")
+                mark += step
+        failed = sum(result.get())
+    server.stop(5)
+    print(f"{handled} handled, {failed} failed, {threading.active_count()} threads left")
+
+
+if __name__ == '__main__':
+    main()